@@ -0,0 +1,98 @@
+"""Ачивки как декларативные правила над счётчиками пользователя.
+
+Событие (записанные шаги, выполненная задача) обновляет счётчики в
+user_counters одним upsert'ом, без пересчёта истории. Правило выдаётся, когда
+счётчик достиг порога; уникальный индекс (user_id, rule) в achievements
+гарантирует, что каждую ачивку пользователь получит один раз.
+"""
+from datetime import datetime
+from typing import NamedTuple
+
+import aiosqlite
+
+
+class Rule(NamedTuple):
+    id: str
+    title: str
+    counter: str
+    threshold: float
+
+
+# событие -> счётчики, которые оно двигает: sum копит значения, max хранит рекорд
+COUNTER_UPDATES = {
+    "steps": (("steps_best", "max"),),
+    "task_done": (("tasks_done", "sum"),),
+}
+
+RULES = (
+    Rule("steps_5000", "🎖 «Активный день»", "steps_best", 5000),
+    Rule("steps_10000", "🏅 «Легенда шагов»", "steps_best", 10000),
+    Rule("task_done_1", "🎓 «Фокус и дисциплина»", "tasks_done", 1),
+)
+
+# начальные значения счётчиков из истории — только для разовой миграции
+COUNTER_SOURCES = {
+    "steps_best": "SELECT user_id, MAX(steps) FROM steps_logs GROUP BY user_id",
+    "tasks_done": "SELECT user_id, COUNT(*) FROM tasks WHERE done = 1 GROUP BY user_id",
+}
+
+_RULES_BY_COUNTER: dict[str, list[Rule]] = {}
+for _rule in RULES:
+    _RULES_BY_COUNTER.setdefault(_rule.counter, []).append(_rule)
+
+_COUNTER_UPSERT = {
+    "sum": """
+        INSERT INTO user_counters (user_id, name, value) VALUES (?, ?, ?)
+        ON CONFLICT (user_id, name) DO UPDATE SET value = value + excluded.value
+        RETURNING value
+    """,
+    "max": """
+        INSERT INTO user_counters (user_id, name, value) VALUES (?, ?, ?)
+        ON CONFLICT (user_id, name) DO UPDATE SET value = max(value, excluded.value)
+        RETURNING value
+    """,
+}
+
+
+async def apply_event(db: aiosqlite.Connection, user_id: int, event: str, value: float) -> list[Rule]:
+    """Обновляет счётчики события и возвращает правила, выданные впервые."""
+    awarded = []
+    for counter, op in COUNTER_UPDATES.get(event, ()):
+        cur = await db.execute(_COUNTER_UPSERT[op], (user_id, counter, value))
+        total = (await cur.fetchone())[0]
+        await cur.close()
+        for rule in _RULES_BY_COUNTER.get(counter, ()):
+            if total < rule.threshold:
+                continue
+            cur = await db.execute(
+                "INSERT OR IGNORE INTO achievements (user_id, rule, title, created_at) VALUES (?, ?, ?, ?)",
+                (user_id, rule.id, rule.title, datetime.utcnow().isoformat()),
+            )
+            if cur.rowcount:
+                awarded.append(rule)
+    return awarded
+
+
+async def dedupe_achievements(db: aiosqlite.Connection):
+    # старые записи узнаём по названию; из повторов остаётся самая ранняя
+    await db.executemany(
+        "UPDATE achievements SET rule = ? WHERE title = ? AND rule IS NULL",
+        [(rule.id, rule.title) for rule in RULES],
+    )
+    await db.execute(
+        """
+        DELETE FROM achievements
+        WHERE rule IS NOT NULL AND id NOT IN (
+            SELECT MIN(id) FROM achievements WHERE rule IS NOT NULL GROUP BY user_id, rule
+        )
+        """
+    )
+
+
+async def rebuild_counters(db: aiosqlite.Connection):
+    await db.execute("DELETE FROM user_counters")
+    for name, query in COUNTER_SOURCES.items():
+        await db.execute(
+            f"INSERT INTO user_counters (user_id, value, name) SELECT *, ? FROM ({query})",
+            (name,),
+        )
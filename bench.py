@@ -0,0 +1,393 @@
+"""Нагрузочный бенчмарк без Telegram: python bench.py [--users N] [--updates N] ...
+
+Синтетические обновления (кнопки меню, ввод чисел, настроение, задачи) идут
+через dp.feed_update во временную базу, заполненную пользователями и логами.
+Сессия бота ничего не отправляет в сеть, а только считает вызовы API
+(--api-ms добавляет каждому вызову задержку, как у настоящей сети).
+Результат — обновлений в секунду, p50/p95/p99 по хендлерам, запросов к базе
+на обновление и время до ответа на колбэк; JSON сохраняется для сравнения
+прогонов (--baseline).
+
+С --workers N обновления идут через супервизор shards.py в N процессов-воркеров
+сырым JSON, как в боевом шардированном режиме. Задержка тогда считается от
+отдачи обновления супервизором до подтверждения воркера, по шардам; запросы к
+базе и вызовы API в воркерах не подсчитываются.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import AnswerCallbackQuery, SendDocument, SendPhoto, TelegramMethod
+from aiogram.types import CallbackQuery, Chat, Document, Message, PhotoSize, Update, User
+
+BENCH_TOKEN = "42:bench"
+
+
+class StubSession(BaseSession):
+    """Сессия без сети: запоминает число вызовов и возвращает правдоподобные ответы."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.calls: Counter[str] = Counter()
+        # имитация сетевой задержки одного вызова API, секунды
+        self.latency = latency
+        # id колбэка -> когда на него ответили (perf_counter)
+        self.acked: dict[str, float] = {}
+        self._ids = itertools.count(1)
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int | None = None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, AnswerCallbackQuery):
+            self.acked[method.callback_query_id] = time.perf_counter()
+        if method.__returning__ is bool:
+            return True
+        extra = {}
+        if isinstance(method, SendPhoto):
+            extra["photo"] = [PhotoSize(file_id=f"photo{next(self._ids)}", file_unique_id="p", width=1, height=1)]
+        elif isinstance(method, SendDocument):
+            extra["document"] = Document(file_id=f"doc{next(self._ids)}", file_unique_id="d")
+        chat_id = getattr(method, "chat_id", None) or 1
+        return Message(
+            message_id=next(self._ids),
+            date=datetime.now(),
+            chat=Chat(id=chat_id, type="private"),
+            text=getattr(method, "text", None),
+            **extra,
+        )
+
+
+def stub_bot() -> Bot:
+    # фабрика для воркеров shards.py: вызывается уже в дочернем процессе, после импорта main
+    logging.getLogger().setLevel(logging.WARNING)
+    return Bot(BENCH_TOKEN, session=StubSession())
+
+
+class UpdateFactory:
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> User:
+        return User(id=user_id, is_bot=False, first_name="bench")
+
+    def message(self, user_id: int, text: str) -> Update:
+        return Update(
+            update_id=next(self._ids),
+            message=Message(
+                message_id=next(self._ids),
+                date=datetime.now(),
+                chat=Chat(id=user_id, type="private"),
+                from_user=self._user(user_id),
+                text=text,
+            ),
+        )
+
+    def callback(self, user_id: int, data: str) -> Update:
+        bot_message = Message(
+            message_id=next(self._ids),
+            date=datetime.now(),
+            chat=Chat(id=user_id, type="private"),
+            from_user=User(id=42, is_bot=True, first_name="bot"),
+            text="…",
+        )
+        return Update(
+            update_id=next(self._ids),
+            callback_query=CallbackQuery(
+                id=str(next(self._ids)),
+                from_user=self._user(user_id),
+                chat_instance="bench",
+                message=bot_message,
+                data=data,
+            ),
+        )
+
+
+# сценарий -> шаги ("m", текст) или ("c", callback_data); вес — относительная частота
+FLOWS = {
+    "water": (5, [("m", "💧 Записать воду"), ("m", "{water}")]),
+    "sleep": (3, [("m", "😴 Сон"), ("m", "{sleep}")]),
+    "steps": (3, [("m", "🚶‍♂️ Шаги/спорт"), ("m", "{steps}")]),
+    "mood": (5, [("m", "📓 Дневник настроения"), ("c", "mood_{mood}")]),
+    "menus": (4, [("m", "🏃‍♂️ Тело"), ("m", "🧠 Душа"), ("m", "🚀 Развитие"), ("m", "⬅️ В меню")]),
+    "tasks": (2, [("c", "task_add"), ("m", "Прочитать главу {n}"), ("c", "task_list"), ("c", "task_done"), ("m", "{task_id}")]),
+    "reports": (1, [("m", "/week"), ("m", "/achievements")]),
+}
+
+
+def render_step(step: str, rng: random.Random, task_ids: list[int]) -> str:
+    return step.format(
+        water=rng.choice((150, 250, 330, 500)),
+        sleep=rng.choice(("6", "7.5", "8", "9")),
+        steps=rng.randint(1000, 14000),
+        mood=rng.randint(1, 5),
+        n=rng.randint(1, 99),
+        task_id=rng.choice(task_ids) if task_ids else 1,
+    )
+
+
+def generate(users: int, logs: int, tasks: int, rng: random.Random) -> tuple[list, dict, list]:
+    from rollups import LOG_TABLES
+
+    now = datetime.utcnow()
+    user_rows = [(user_id, now.isoformat()) for user_id in range(1, users + 1)]
+    # логи за последние 60 дней в порядке времени, как их пишет бот
+    moments = sorted(now - timedelta(minutes=rng.randint(1, 60 * 24 * 60)) for _ in range(logs))
+    by_kind = defaultdict(list)
+    for moment in moments:
+        kind = rng.choice(tuple(LOG_TABLES))
+        value = {"water": 250, "sleep": 7.5, "steps": 6000, "mood": rng.randint(1, 5)}[kind]
+        by_kind[kind].append((rng.randint(1, users), value, moment.isoformat()))
+    task_rows = [
+        (user_id, f"Задача {i}", (now - timedelta(hours=i)).isoformat())
+        for user_id in range(1, users + 1) for i in range(tasks)
+    ]
+    return user_rows, by_kind, task_rows
+
+
+async def seed(path: str, dataset: tuple[list, dict, list]):
+    from db import _db, close_db, init_db, open_db, rebuild_daily_rollups, rebuild_user_stats
+    from rollups import LOG_TABLES
+
+    user_rows, by_kind, task_rows = dataset
+    await open_db(path)
+    await init_db()
+    async with _db().write() as db:
+        await db.executemany("INSERT OR IGNORE INTO users (user_id, created_at) VALUES (?, ?)", user_rows)
+        for kind, rows in by_kind.items():
+            table, column = LOG_TABLES[kind]
+            await db.executemany(f"INSERT INTO {table} (user_id, {column}, created_at) VALUES (?, ?, ?)", rows)
+        await db.executemany("INSERT INTO tasks (user_id, title, created_at) VALUES (?, ?, ?)", task_rows)
+    await rebuild_daily_rollups()
+    await rebuild_user_stats()
+    await close_db()
+
+
+async def seed_memory(store, dataset: tuple[list, dict, list]):
+    user_rows, by_kind, task_rows = dataset
+    for user_id, _ in user_rows:
+        await store.add_user_if_not_exists(user_id)
+    for kind, rows in by_kind.items():
+        for user_id, value, created_at in rows:
+            store.add_log(kind, user_id, value, created_at)
+    # порядок вставки тот же, что в SQLite, поэтому и id задач совпадают
+    for user_id, title, created_at in task_rows:
+        await store.add_task(user_id, title, created_at)
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, round(q * (len(sorted_values) - 1)))]
+
+
+def summarize(
+    samples: list[tuple[str, float, int]], elapsed: float, api_calls: Counter, acks: list[float], args
+) -> dict:
+    by_handler: dict[str, list[float]] = defaultdict(list)
+    db_ops: dict[str, int] = Counter()
+    for handler, seconds, ops in samples:
+        by_handler[handler].append(seconds)
+        db_ops[handler] += ops
+    handlers = {}
+    for handler, values in sorted(by_handler.items()):
+        values.sort()
+        handlers[handler] = {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+            "db_ops_per_update": round(db_ops[handler] / len(values), 2),
+        }
+    everything = sorted(seconds for _, seconds, _ in samples)
+    acks = sorted(acks)
+    total = len(samples)
+    return {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "params": {
+            "users": args.users, "logs": args.logs, "tasks": args.tasks,
+            "updates": args.updates, "concurrency": args.concurrency, "seed": args.seed,
+            "workers": args.workers, "storage": args.storage, "api_ms": args.api_ms,
+        },
+        "updates": total,
+        "seconds": round(elapsed, 3),
+        "updates_per_sec": round(total / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(everything, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(everything, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(everything, 0.99) * 1000, 3),
+        "db_ops_per_update": round(sum(ops for _, _, ops in samples) / total, 2) if total else 0.0,
+        "api_calls_per_update": round(sum(api_calls.values()) / total, 2) if total else 0.0,
+        # от получения колбэка до answerCallbackQuery — сколько крутятся часики на кнопке
+        "ack_p50_ms": round(percentile(acks, 0.50) * 1000, 3),
+        "ack_p95_ms": round(percentile(acks, 0.95) * 1000, 3),
+        "handlers": handlers,
+    }
+
+
+def print_report(report: dict, baseline: dict | None):
+    print(
+        f"{report['updates']} обновлений за {report['seconds']} с — {report['updates_per_sec']} upd/s, "
+        f"p50 {report['p50_ms']} мс, p95 {report['p95_ms']} мс, p99 {report['p99_ms']} мс, "
+        f"БД {report['db_ops_per_update']} запросов/обновление"
+    )
+    if report["ack_p50_ms"]:
+        print(f"ответ на колбэк: p50 {report['ack_p50_ms']} мс, p95 {report['ack_p95_ms']} мс")
+    print(f"{'хендлер':<24}{'кол-во':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'БД/upd':>8}")
+    for handler, row in report["handlers"].items():
+        print(
+            f"{handler:<24}{row['count']:>8}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}"
+            f"{row['p99_ms']:>10.2f}{row['db_ops_per_update']:>8}"
+        )
+    if baseline:
+        for key in ("updates_per_sec", "p95_ms", "p99_ms", "db_ops_per_update", "ack_p95_ms"):
+            old, new = baseline.get(key), report[key]
+            if old:
+                print(f"{key}: {old} -> {new} ({(new - old) / old * 100:+.1f}%)")
+
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    os.makedirs("photos")
+    with open("photos/бот.jpg", "wb") as f:
+        f.write(b"\xff\xd8bench")
+    # фоновые задачи бота искажают замер и здесь не нужны
+    os.environ.update(
+        BROADCASTS_ENABLED="0", RETENTION_DAYS="0", METRICS_PORT="0", SLOW_UPDATE_MS="0", STORAGE=args.storage,
+        # виртуальные пользователи шлют обновления без пауз — защита от флуда отбросила бы большую часть
+        FLOOD_RATE="0", FLOOD_DUPLICATE_MS="0",
+    )
+
+    import main
+    from db import DB_PATH
+    from metrics import METRICS
+
+    logging.getLogger().setLevel(logging.WARNING)
+    dataset = generate(args.users, args.logs, args.tasks, rng)
+    if args.storage == "sqlite":
+        await seed(DB_PATH, dataset)
+
+    samples: list[tuple[str, float, int]] = []
+    calls: Counter[str] = Counter()
+    acks: list[float] = []
+    if args.workers:
+        from shards import Supervisor
+
+        supervisor = Supervisor(args.workers, make_bot=stub_bot, max_concurrency=args.concurrency)
+        pending_acks: dict[int, asyncio.Future] = {}
+
+        def on_ack(shard: int, update_id: int, seconds: float):
+            samples.append((f"shard-{shard}", seconds, 0))
+            pending_acks.pop(update_id).set_result(None)
+
+        supervisor.listeners.append(on_ack)
+        await supervisor.start()
+
+        async def send(update: Update):
+            # ждём подтверждения, как и в одном процессе: следующий шаг зависит от FSM-состояния
+            pending_acks[update.update_id] = asyncio.get_running_loop().create_future()
+            supervisor.dispatch(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+            await pending_acks[update.update_id]
+    else:
+        session = StubSession(args.api_ms / 1000)
+        calls = session.calls
+        bot = Bot(BENCH_TOKEN, session=session)
+        METRICS.listeners.append(
+            lambda _, record, seconds: samples.append((record.handler or "unhandled", seconds, record.db_ops))
+        )
+        await main.dp.emit_startup(bot=bot, dispatcher=main.dp, bots=[bot])
+        if args.storage == "memory":
+            await seed_memory(main.dp["storage"], dataset)
+
+        async def send(update: Update):
+            started = time.perf_counter()
+            await main.dp.feed_update(bot, update)
+            if update.callback_query is not None and update.callback_query.id in session.acked:
+                acks.append(session.acked.pop(update.callback_query.id) - started)
+
+    factory = UpdateFactory()
+    names = list(FLOWS)
+    weights = [FLOWS[name][0] for name in names]
+    budget = itertools.count()
+
+    async def virtual_user(user_id: int):
+        # у каждого пользователя свои шаги по порядку: FSM-состояние зависит от предыдущего
+        # задачи засеяны подряд по пользователям, поэтому их id известны заранее
+        task_ids = list(range((user_id - 1) * args.tasks + 1, user_id * args.tasks + 1))
+        while True:
+            flow = FLOWS[rng.choices(names, weights)[0]][1]
+            for kind, step in flow:
+                if next(budget) >= args.updates:
+                    return
+                text = render_step(step, rng, task_ids)
+                update = factory.message(user_id, text) if kind == "m" else factory.callback(user_id, text)
+                await send(update)
+
+    active = rng.sample(range(1, args.users + 1), min(args.concurrency, args.users))
+    started = time.perf_counter()
+    await asyncio.gather(*(virtual_user(user_id) for user_id in active))
+    elapsed = time.perf_counter() - started
+    if args.workers:
+        await supervisor.stop()
+    else:
+        await main.dp.emit_shutdown(bot=bot, dispatcher=main.dp, bots=[bot])
+    return summarize(samples, elapsed, calls, acks, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк диспетчера на синтетических обновлениях")
+    parser.add_argument("--users", type=int, default=1000, help="пользователей в базе")
+    parser.add_argument("--logs", type=int, default=100_000, help="строк логов в базе")
+    parser.add_argument("--tasks", type=int, default=20, help="задач у каждого пользователя")
+    parser.add_argument("--updates", type=int, default=5000, help="сколько обновлений прогнать")
+    parser.add_argument("--concurrency", type=int, default=50, help="пользователей, шлющих обновления одновременно")
+    parser.add_argument("--workers", type=int, default=0, help="воркеров shards.py; 0 — всё в одном процессе")
+    parser.add_argument("--storage", choices=("sqlite", "memory"), default="sqlite", help="хранилище данных пользователей")
+    parser.add_argument("--api-ms", type=float, default=0, help="задержка каждого вызова API, мс (без --workers)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default="bench.json", help="куда сохранить результат")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args()
+    if args.workers and args.storage == "memory":
+        # у каждого воркера своя память: заполнить её из бенчмарка нельзя
+        parser.error("--storage memory работает только без --workers")
+
+    out = os.path.abspath(args.out)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    # main и db импортируются после chdir во временный каталог: пути в них относительные
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        os.chdir(workdir)
+        try:
+            report = asyncio.run(run(args))
+        finally:
+            # из удаляемого каталога нужно выйти, база и фото уходят вместе с ним
+            os.chdir(cwd)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print_report(report, baseline)
+    print(f"Результат сохранён в {out}")
+
+
+if __name__ == "__main__":
+    main()
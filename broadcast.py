@@ -0,0 +1,163 @@
+"""Ежедневные напоминания (вода, настроение) всем пользователям из users.
+
+Получатели читаются из users порциями по возрастанию user_id (keyset), без
+OFFSET и без загрузки всей таблицы. Прогресс задания хранится в broadcast_jobs:
+после каждой порции сдвигается last_user_id, а каждая отправка сразу
+отмечается в broadcast_deliveries. После перезапуска задание продолжается с
+контрольной точки и не пишет повторно тем, кому уже отправило.
+
+Задание (напоминание за дату) при создании делится на диапазоны user_id, у
+каждого своя аренда и свой курсор. Воркеры shards.py берут свободные диапазоны
+по одному, так что имя задания и его прогресс не зависят от числа воркеров.
+"""
+import asyncio
+import logging
+import time
+from typing import NamedTuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError
+
+from db import (
+    advance_broadcast,
+    broadcast_recipients,
+    claim_broadcast,
+    finish_broadcast,
+    mark_delivered,
+    renew_broadcast_lease,
+    set_reminders,
+)
+from outbound import background
+from timeutil import local_now
+
+logger = logging.getLogger(__name__)
+
+
+class Reminder(NamedTuple):
+    name: str
+    hour: int
+    text: str
+
+
+REMINDERS = (
+    Reminder("water", 12, "💧 Ты уже записал(а) воду сегодня? Загляни в «🏃‍♂️ Тело» → «💧 Записать воду»."),
+    Reminder("mood", 20, "📓 Как твоё настроение сегодня? Отметь его в «🧠 Душа» → «📓 Дневник настроения»."),
+)
+
+
+class BroadcastEngine:
+    def __init__(
+        self,
+        bot: Bot,
+        reminders: tuple[Reminder, ...] = REMINDERS,
+        chunk_size: int = 500,
+        concurrency: int = 10,
+        window_hours: int = 4,
+        lease_seconds: int = 120,
+        ranges: int = 16,
+    ):
+        self.bot = bot
+        self.reminders = reminders
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        # если бот поднялся сильно позже часа напоминания, сегодняшнюю рассылку пропускаем
+        self.window_hours = window_hours
+        self.lease_seconds = lease_seconds
+        # на сколько диапазонов делится новое задание; у уже созданного границы не меняются
+        self.ranges = ranges
+        self.progress: dict[str, dict] = {}
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            now = local_now()
+            for reminder in self.reminders:
+                if reminder.hour <= now.hour < reminder.hour + self.window_hours:
+                    try:
+                        await self.run_job(reminder, now.date().isoformat())
+                    except Exception:
+                        logger.exception("Рассылка %s прервалась", reminder.name)
+            await asyncio.sleep(60)
+
+    async def run_job(self, reminder: Reminder, run_date: str):
+        # claim_broadcast вернёт None, когда задание завершено, а остальные диапазоны ведут другие процессы
+        while True:
+            part = await claim_broadcast(reminder.name, run_date, time.time() + self.lease_seconds, self.ranges)
+            if part is None:
+                return
+            await self._run_range(reminder, run_date, part)
+
+    async def _run_range(self, reminder: Reminder, run_date: str, part):
+        key = f"{reminder.name}:{run_date}:{part['after_user_id']}"
+        stats = {"sent": part["sent"], "failed": part["failed"], "last_user_id": part["last_user_id"]}
+        self.progress[key] = stats
+        started = time.monotonic()
+        sent_before = stats["sent"]
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(user_id: int):
+            async with slots:
+                try:
+                    with background():
+                        await self.bot.send_message(user_id, reminder.text)
+                except TelegramForbiddenError:
+                    # пользователь заблокировал бота — больше не пишем ему
+                    await set_reminders(user_id, False)
+                    stats["failed"] += 1
+                    return
+                except Exception:
+                    logger.exception("Напоминание %s не доставлено пользователю %d", reminder.name, user_id)
+                    stats["failed"] += 1
+                    return
+                await mark_delivered(part["job_id"], user_id)
+                stats["sent"] += 1
+
+        # порция при лимитах Telegram может идти дольше аренды: продлеваем её по таймеру, а не только между порциями
+        heartbeat = asyncio.create_task(self._heartbeat(part["id"]))
+        try:
+            while True:
+                user_ids = await broadcast_recipients(
+                    part["job_id"], stats["last_user_id"], part["until_user_id"], local_now().hour, self.chunk_size
+                )
+                if not user_ids:
+                    break
+                await asyncio.gather(*(deliver(user_id) for user_id in user_ids))
+                stats["last_user_id"] = user_ids[-1]
+                await advance_broadcast(
+                    part["id"], stats["last_user_id"], stats["sent"], stats["failed"],
+                    time.time() + self.lease_seconds,
+                )
+                elapsed = time.monotonic() - started
+                logger.info(
+                    "Рассылка %s: отправлено %d, ошибок %d, дошли до user_id %d, %.1f сообщ/с",
+                    key, stats["sent"], stats["failed"], stats["last_user_id"],
+                    (stats["sent"] - sent_before) / elapsed if elapsed else 0.0,
+                )
+        finally:
+            heartbeat.cancel()
+        finished = await finish_broadcast(part["id"])
+        stats["done"] = True
+        logger.info("Рассылка %s завершена: отправлено %d, ошибок %d", key, stats["sent"], stats["failed"])
+        if finished:
+            logger.info("Рассылка %s:%s завершена по всем диапазонам", reminder.name, run_date)
+
+    async def _heartbeat(self, range_id: int):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await renew_broadcast_lease(range_id, time.time() + self.lease_seconds)
+            except Exception:
+                # следующая попытка через треть аренды: одна неудача её ещё не теряет
+                logger.exception("Не удалось продлить аренду диапазона рассылки %d", range_id)
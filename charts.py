@@ -0,0 +1,278 @@
+"""Графики по дневным агрегатам без тяжёлых библиотек: PNG рисуется на чистом Python.
+
+Готовый график хранится на диске и как Telegram file_id в таблице chart_cache по
+ключу (пользователь, метрика, число дней) вместе с последним днём периода.
+Запись удаляет хук сброса очереди, когда у пользователя появляется новый лог
+этой метрики, поэтому повторный просмотр — это один SELECT и отправка file_id.
+"""
+import asyncio
+import logging
+import math
+import os
+import struct
+import tempfile
+import zlib
+from datetime import date, timedelta
+from typing import NamedTuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+
+from db import get_chart, reserve_chart, save_chart_file_id, save_chart_render
+from media_cache import is_file_id_error
+from rollups import day_value
+from storage import Storage
+from timeutil import local_now
+
+logger = logging.getLogger(__name__)
+
+Color = tuple[int, int, int]
+
+BACKGROUND: Color = (255, 255, 255)
+GRID: Color = (226, 230, 236)
+AXIS: Color = (120, 128, 140)
+LABEL: Color = (70, 76, 86)
+
+
+class ChartMetric(NamedTuple):
+    icon: str
+    title: str
+    unit: str
+    style: str  # bar | line
+    color: Color
+    # фиксированный верх шкалы; None — подбирается по данным
+    y_max: float | None = None
+
+
+CHART_METRICS = {
+    "mood": ChartMetric("📓", "Настроение", "/5", "line", (236, 142, 40), 5),
+    "sleep": ChartMetric("😴", "Сон", " ч", "line", (94, 92, 230)),
+    "steps": ChartMetric("🚶", "Шаги", "", "bar", (52, 168, 83)),
+    "water": ChartMetric("💧", "Вода", " мл", "bar", (33, 150, 243)),
+}
+
+# ========= Растровый шрифт 3x5 для подписей осей =========
+
+_GLYPHS = {
+    "0": ("111", "101", "101", "101", "111"),
+    "1": ("010", "110", "010", "010", "111"),
+    "2": ("111", "001", "111", "100", "111"),
+    "3": ("111", "001", "111", "001", "111"),
+    "4": ("101", "101", "111", "001", "001"),
+    "5": ("111", "100", "111", "001", "111"),
+    "6": ("111", "100", "111", "101", "111"),
+    "7": ("111", "001", "001", "001", "001"),
+    "8": ("111", "101", "111", "101", "111"),
+    "9": ("111", "101", "111", "001", "111"),
+    ".": ("000", "000", "000", "000", "010"),
+    "-": ("000", "000", "111", "000", "000"),
+    " ": ("000", "000", "000", "000", "000"),
+}
+
+
+def text_width(text: str, scale: int = 2) -> int:
+    return len(text) * 4 * scale - scale if text else 0
+
+
+class Canvas:
+    def __init__(self, width: int, height: int, background: Color = BACKGROUND):
+        self.width = width
+        self.height = height
+        self.pixels = bytearray(bytes(background) * (width * height))
+
+    def rect(self, x0: int, y0: int, x1: int, y1: int, color: Color):
+        # заливка прямоугольника [x0, x1) x [y0, y1) с обрезкой по краям холста
+        x0, x1 = max(0, x0), min(self.width, x1)
+        y0, y1 = max(0, y0), min(self.height, y1)
+        if x0 >= x1 or y0 >= y1:
+            return
+        row = bytes(color) * (x1 - x0)
+        for y in range(y0, y1):
+            offset = (y * self.width + x0) * 3
+            self.pixels[offset:offset + len(row)] = row
+
+    def line(self, x0: int, y0: int, x1: int, y1: int, color: Color, width: int = 1):
+        # Брезенхем с квадратной кистью заданной толщины
+        r = width // 2
+        dx, dy = abs(x1 - x0), -abs(y1 - y0)
+        sx, sy = (1 if x0 < x1 else -1), (1 if y0 < y1 else -1)
+        err = dx + dy
+        while True:
+            self.rect(x0 - r, y0 - r, x0 - r + width, y0 - r + width, color)
+            if x0 == x1 and y0 == y1:
+                return
+            e2 = 2 * err
+            if e2 >= dy:
+                err += dy
+                x0 += sx
+            if e2 <= dx:
+                err += dx
+                y0 += sy
+
+    def text(self, x: int, y: int, text: str, color: Color, scale: int = 2):
+        for char in text:
+            for row, bits in enumerate(_GLYPHS.get(char, _GLYPHS[" "])):
+                for col, bit in enumerate(bits):
+                    if bit == "1":
+                        px, py = x + col * scale, y + row * scale
+                        self.rect(px, py, px + scale, py + scale, color)
+            x += 4 * scale
+
+    def png(self) -> bytes:
+        stride = self.width * 3
+        # каждая строка с фильтром 0 (None): deflate и так хорошо жмёт однотонный фон
+        raw = b"".join(
+            b"\x00" + self.pixels[y * stride:(y + 1) * stride] for y in range(self.height)
+        )
+
+        def chunk(tag: bytes, data: bytes) -> bytes:
+            return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+        header = struct.pack(">IIBBBBB", self.width, self.height, 8, 2, 0, 0, 0)
+        return (
+            b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(raw, 6))
+            + chunk(b"IEND", b"")
+        )
+
+
+def _nice_step(peak: float, ticks: int = 4) -> float:
+    raw = peak / ticks
+    magnitude = 10 ** math.floor(math.log10(raw))
+    for factor in (1, 2, 2.5, 5, 10):
+        if raw <= factor * magnitude:
+            return factor * magnitude
+    return 10 * magnitude
+
+
+def render_chart(
+    values: list[float | None],
+    labels: list[str],
+    metric: ChartMetric,
+    width: int = 640,
+    height: int = 360,
+) -> bytes:
+    canvas = Canvas(width, height)
+    left, right, top, bottom = 64, width - 16, 16, height - 36
+    peak = max((v for v in values if v is not None), default=0)
+    if metric.y_max is not None:
+        step, y_max = 1.0, float(metric.y_max)
+    else:
+        step = _nice_step(peak or 1)
+        y_max = step * max(1, math.ceil(peak / step))
+
+    def y_of(value: float) -> int:
+        return bottom - round((bottom - top) * value / y_max)
+
+    tick = 0.0
+    while tick <= y_max + 1e-9:
+        y = y_of(tick)
+        canvas.rect(left, y, right, y + 1, GRID)
+        label = f"{tick:g}"
+        canvas.text(left - 8 - text_width(label), y - 5, label, LABEL)
+        tick += step
+    canvas.rect(left, top, left + 1, bottom + 1, AXIS)
+    canvas.rect(left, bottom, right, bottom + 1, AXIS)
+
+    slot = (right - left) / len(values)
+    centers = [round(left + slot * (i + 0.5)) for i in range(len(values))]
+    # подписываем не каждый день, а так, чтобы подписи не налезали; последний день — всегда
+    every = max(1, math.ceil(len(values) / max(1, (right - left) // (text_width("00.00") + 12))))
+    for i in range(len(values) - 1, -1, -every):
+        label = labels[i]
+        canvas.text(centers[i] - text_width(label) // 2, bottom + 10, label, LABEL)
+
+    if metric.style == "bar":
+        half = max(1, round(slot * 0.35))
+        for x, value in zip(centers, values):
+            if value:
+                canvas.rect(x - half, y_of(value), x + half, bottom, metric.color)
+    else:
+        previous = None
+        for x, value in zip(centers, values):
+            if value is None:
+                # пропущенный день разрывает линию, а не соединяет соседние точки
+                previous = None
+                continue
+            point = (x, y_of(value))
+            if previous is not None:
+                canvas.line(*previous, *point, metric.color, width=3)
+            canvas.rect(point[0] - 4, point[1] - 4, point[0] + 5, point[1] + 5, metric.color)
+            previous = point
+    return canvas.png()
+
+
+def _caption(metric: ChartMetric, days: int, first_day: date, end_day: date, values: list[float | None]) -> str:
+    present = [v for v in values if v is not None]
+    text = f"{metric.icon} {metric.title} за {days} дн. ({first_day:%d.%m}–{end_day:%d.%m})"
+    if present:
+        fmt = ".1f" if metric.style == "line" else ".0f"
+        text += f"\nВ среднем за день: {sum(present) / len(present):{fmt}}{metric.unit} · дней с записями: {len(present)}"
+    return text
+
+
+class ChartService:
+    def __init__(self, directory: str, storage: Storage, cache: bool = True):
+        self.directory = directory
+        self.storage = storage
+        # кэш в chart_cache сбрасывает хук записи логов в SQLite; для других хранилищ его выключают
+        self.cache = cache
+        os.makedirs(directory, exist_ok=True)
+
+    async def send_chart(self, bot: Bot, chat_id: int, user_id: int, metric: str, days: int, **kwargs) -> Message:
+        # шлём в чат, а не ответом на сообщение: кнопка под сообщением старше 48 часов его не отдаёт
+        end_day = local_now().date()
+        cached = await get_chart(user_id, metric, days) if self.cache else None
+        if cached and cached["end_day"] == end_day.isoformat() and cached["path"]:
+            if cached["file_id"]:
+                try:
+                    return await bot.send_photo(chat_id, photo=cached["file_id"], caption=cached["caption"], **kwargs)
+                except TelegramBadRequest as e:
+                    if not is_file_id_error(e):
+                        raise
+                    logger.warning("file_id графика %s больше не принимается, загружаю заново", cached["path"])
+            if os.path.exists(cached["path"]):
+                return await self._upload(
+                    bot, chat_id, user_id, metric, days, end_day, cached["path"], cached["caption"], **kwargs
+                )
+
+        # запись создаётся до чтения агрегатов: если между чтением и сохранением
+        # придёт новый лог, хук удалит её и устаревший график не попадёт в кэш
+        if self.cache:
+            await reserve_chart(user_id, metric, days, end_day.isoformat())
+        first_day = end_day - timedelta(days=days - 1)
+        rows = await self.storage.get_daily_rollups(user_id, first_day.isoformat(), end_day.isoformat())
+        by_day = {row["day"]: row for row in rows}
+        spec = CHART_METRICS[metric]
+        period = [first_day + timedelta(days=i) for i in range(days)]
+        values = [day_value(by_day.get(day.isoformat()), metric) for day in period]
+        if all(v is None for v in values):
+            return await bot.send_message(chat_id, f"{spec.icon} За последние {days} дн. записей пока нет.")
+
+        path = os.path.join(self.directory, f"{user_id}_{metric}_{days}.png")
+        labels = [f"{day:%d.%m}" for day in period]
+        await asyncio.to_thread(self._render_to_file, path, values, labels, spec)
+        caption = _caption(spec, days, first_day, end_day, values)
+        if not self.cache:
+            return await bot.send_photo(chat_id, photo=FSInputFile(path), caption=caption, **kwargs)
+        await save_chart_render(user_id, metric, days, end_day.isoformat(), path, caption)
+        return await self._upload(bot, chat_id, user_id, metric, days, end_day, path, caption, **kwargs)
+
+    async def _upload(
+        self, bot: Bot, chat_id: int, user_id: int, metric: str, days: int, end_day: date, path: str, caption: str,
+        **kwargs,
+    ) -> Message:
+        sent = await bot.send_photo(chat_id, photo=FSInputFile(path), caption=caption, **kwargs)
+        await save_chart_file_id(user_id, metric, days, end_day.isoformat(), sent.photo[-1].file_id)
+        return sent
+
+    @staticmethod
+    def _render_to_file(path: str, values: list[float | None], labels: list[str], spec: ChartMetric):
+        data = render_chart(values, labels, spec)
+        # через временный файл, чтобы параллельная отправка не прочитала недописанный PNG
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
@@ -0,0 +1,79 @@
+"""Компакция сырых логов воды, сна, шагов и настроения.
+
+Каждая запись лога уже учтена в daily_rollups и user_stats в той же транзакции,
+что и вставка, поэтому логи старше retention_days можно просто удалять. Граница
+выравнивается по началу локального дня и сохраняется в meta как
+compacted_before: пересборка дневных агрегатов не трогает дни до неё. Удаление
+идёт пачками по batch_rows строк, каждая в своей короткой транзакции, после
+чего освободившиеся страницы возвращаются системе через incremental_vacuum.
+"""
+import asyncio
+import logging
+from datetime import timedelta
+
+from db import advance_compaction, delete_old_logs, incremental_vacuum
+from rollups import LOG_TABLES
+from timeutil import day_start_utc, local_now
+
+logger = logging.getLogger(__name__)
+
+
+class Compactor:
+    def __init__(
+        self,
+        retention_days: int = 90,
+        batch_rows: int = 1000,
+        vacuum_pages: int = 1000,
+        interval_hours: float = 24,
+    ):
+        self.retention_days = retention_days
+        self.batch_rows = batch_rows
+        self.vacuum_pages = vacuum_pages
+        self.interval_hours = interval_hours
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Компакция логов прервалась")
+            await asyncio.sleep(self.interval_hours * 3600)
+
+    async def run_once(self) -> dict[str, int]:
+        before_day = (local_now().date() - timedelta(days=self.retention_days)).isoformat()
+        before_day = await advance_compaction(before_day)
+        before = day_start_utc(before_day)
+        deleted: dict[str, int] = {}
+        for kind in LOG_TABLES:
+            deleted[kind] = 0
+            last_id = 0
+            while True:
+                count, last_id = await delete_old_logs(kind, before, last_id, self.batch_rows)
+                deleted[kind] += count
+                # окно целиком из свежих строк — дальше по id старых уже нет
+                if last_id is None or not count:
+                    break
+                # отпускаем писателя между пачками, чтобы запись логов не ждала всю компакцию
+                await asyncio.sleep(0)
+        freed = 0
+        while pages := await incremental_vacuum(self.vacuum_pages):
+            freed += pages
+            await asyncio.sleep(0)
+        logger.info(
+            "Компакция до %s: удалено строк %s, освобождено страниц %d",
+            before_day, ", ".join(f"{kind}={count}" for kind, count in deleted.items()), freed,
+        )
+        return deleted
@@ -1,162 +1,709 @@
-import aiosqlite
+import time
+from collections import OrderedDict
 from datetime import datetime
 
+from achievements import Rule, apply_event
+from db_pool import ConnectionPool
+from metrics import timed
+from migrations import migrate
+from paging import Page, decode_cursor
+from rollups import LOG_TABLES, apply_daily_rollups, apply_user_stats, invalidate_charts
+from rollups import overlay_daily_rollups, pending_stats
+from rollups import rebuild_daily_rollups as _rebuild_daily_rollups, rebuild_user_stats as _rebuild_user_stats
+from search import BACKFILL_BATCH, BACKFILL_FROM, BACKFILL_TO, MAX_MATCHES, TASKS_FTS_REBUILD
+from search import fts_query, query_words, rank_page
+from write_behind import LogEvent, WriteBehindQueue
+
 DB_PATH = "data/wellbeing.db"
 
+class _KnownUsers:
+    """Ограниченное LRU-множество user_id, для которых строка в users уже есть."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._ids: OrderedDict[int, None] = OrderedDict()
+
+    def __contains__(self, user_id: int) -> bool:
+        if user_id in self._ids:
+            self._ids.move_to_end(user_id)
+            return True
+        return False
+
+    def add(self, user_id: int):
+        self._ids[user_id] = None
+        self._ids.move_to_end(user_id)
+        if len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+
+_pool: ConnectionPool | None = None
+_writes: WriteBehindQueue | None = None
+_known_users = _KnownUsers(100_000)
+
+async def open_db(
+    path: str = DB_PATH,
+    readers: int = 4,
+    flush_interval_ms: int = 200,
+    flush_max_rows: int = 500,
+    known_users: int = 100_000,
+):
+    global _pool, _writes, _known_users
+    pool = ConnectionPool(path, readers)
+    await pool.open()
+    statements = {
+        kind: f"INSERT INTO {table} (user_id, {column}, created_at) VALUES (?, ?, ?)"
+        for kind, (table, column) in LOG_TABLES.items()
+    }
+    # что не удалось записать после всех повторов, ложится рядом с базой, как её -wal
+    writes = WriteBehindQueue(
+        pool, statements, flush_interval_ms, flush_max_rows, dead_letter_path=f"{path}-dead-letters.jsonl"
+    )
+    writes.add_hook(apply_user_stats)
+    writes.add_hook(apply_daily_rollups)
+    writes.add_hook(invalidate_charts)
+    writes.start()
+    _pool, _writes = pool, writes
+    _known_users = _KnownUsers(known_users)
+
+async def close_db():
+    global _pool, _writes
+    if _writes is not None:
+        await _writes.stop()
+        _writes = None
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+def _db() -> ConnectionPool:
+    if _pool is None:
+        raise RuntimeError("База данных не открыта: сначала вызовите open_db()")
+    return _pool
+
+def _queue() -> WriteBehindQueue:
+    if _writes is None:
+        raise RuntimeError("База данных не открыта: сначала вызовите open_db()")
+    return _writes
+
+async def _log(kind: str, user_id: int, value: float):
+    await _queue().put(LogEvent(kind, user_id, value, datetime.utcnow().isoformat()))
+
+@timed
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.executescript(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                created_at TEXT
-            );
-
-            CREATE TABLE IF NOT EXISTS water_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                amount_ml INTEGER,
-                created_at TEXT
-            );
-
-            CREATE TABLE IF NOT EXISTS sleep_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                hours REAL,
-                created_at TEXT
-            );
-
-            CREATE TABLE IF NOT EXISTS steps_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                steps INTEGER,
-                created_at TEXT
-            );
-
-            CREATE TABLE IF NOT EXISTS mood_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                score INTEGER,
-                created_at TEXT
-            );
-
-            CREATE TABLE IF NOT EXISTS tasks (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                title TEXT,
-                done INTEGER DEFAULT 0,
-                created_at TEXT
-            );
-
-            CREATE TABLE IF NOT EXISTS achievements (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                title TEXT,
-                created_at TEXT
-            );
-            """
-        )
-        await db.commit()
+    # схема поднимается миграциями; если версия актуальна, это один SELECT
+    await migrate(_db())
 
-async def add_user_if_not_exists(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-        row = await cur.fetchone()
-        if not row:
-            await db.execute(
-                "INSERT INTO users (user_id, created_at) VALUES (?, ?)",
-                (user_id, datetime.utcnow().isoformat()),
-            )
-            await db.commit()
+@timed
+async def warm_user_cache(shard: int = 0, shards: int = 1):
+    # кэш ограничен по размеру, поэтому прогреваем не больше, чем он вмещает; воркеру нужны только свои пользователи
+    async with _db().read() as db:
+        cur = await db.execute(
+            "SELECT user_id FROM users WHERE user_id % ? = ? ORDER BY user_id DESC LIMIT ?",
+            (shards, shard, _known_users.max_size),
+        )
+        rows = await cur.fetchall()
         await cur.close()
+    for row in reversed(rows):
+        _known_users.add(row[0])
 
-async def add_water(user_id: int, amount: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+@timed
+async def add_user_if_not_exists(user_id: int):
+    if user_id in _known_users:
+        return
+    async with _db().write() as db:
         await db.execute(
-            "INSERT INTO water_logs (user_id, amount_ml, created_at) VALUES (?, ?, ?)",
-            (user_id, amount, datetime.utcnow().isoformat()),
+            "INSERT OR IGNORE INTO users (user_id, created_at) VALUES (?, ?)",
+            (user_id, datetime.utcnow().isoformat()),
         )
-        await db.commit()
+    _known_users.add(user_id)
+
+@timed
+async def add_water(user_id: int, amount: int):
+    await _log("water", user_id, amount)
 
+@timed
 async def add_sleep(user_id: int, hours: float):
-    async with aiosqlite.connect(DB_PATH) as db:
+    await _log("sleep", user_id, hours)
+
+@timed
+async def add_steps(user_id: int, steps: int):
+    await _log("steps", user_id, steps)
+
+@timed
+async def log_mood(user_id: int, score: int):
+    await _log("mood", user_id, score)
+
+@timed
+async def get_stats(user_id: int, metric: str):
+    async def query():
+        async with _db().read() as db:
+            cur = await db.execute(
+                "SELECT total, count FROM user_stats WHERE user_id = ? AND metric = ?",
+                (user_id, metric),
+            )
+            row = await cur.fetchone()
+            await cur.close()
+            return row
+
+    # записи из очереди прибавляются к прочитанному, а не сбрасываются перед чтением
+    row, pending = await _queue().read(user_id, query)
+    total, count = pending_stats(pending, metric)
+    if row:
+        total, count = total + row[0], count + row[1]
+    if count:
+        return float(total), int(count)
+    return None
+
+@timed
+async def get_mood_stats(user_id: int):
+    stats = await get_stats(user_id, "mood")
+    if stats:
+        total, count = stats
+        return total / count, count
+    return None
+
+@timed
+async def get_daily_rollups(user_id: int, first_day: str, last_day: str):
+    async def query():
+        async with _db().read() as db:
+            cur = await db.execute(
+                "SELECT * FROM daily_rollups WHERE user_id = ? AND day BETWEEN ? AND ? ORDER BY day",
+                (user_id, first_day, last_day),
+            )
+            rows = await cur.fetchall()
+            await cur.close()
+            return rows
+
+    rows, pending = await _queue().read(user_id, query)
+    return overlay_daily_rollups(user_id, rows, pending, first_day, last_day)
+
+@timed
+async def get_chart(user_id: int, metric: str, days: int):
+    async with _db().read() as db:
+        cur = await db.execute(
+            "SELECT end_day, path, caption, file_id FROM chart_cache WHERE user_id = ? AND metric = ? AND days = ?",
+            (user_id, metric, days),
+        )
+        row = await cur.fetchone()
+        await cur.close()
+        return row
+
+@timed
+async def reserve_chart(user_id: int, metric: str, days: int, end_day: str):
+    async with _db().write() as db:
         await db.execute(
-            "INSERT INTO sleep_logs (user_id, hours, created_at) VALUES (?, ?, ?)",
-            (user_id, hours, datetime.utcnow().isoformat()),
+            "INSERT OR REPLACE INTO chart_cache (user_id, metric, days, end_day) VALUES (?, ?, ?, ?)",
+            (user_id, metric, days, end_day),
         )
-        await db.commit()
 
-async def add_steps(user_id: int, steps: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+@timed
+async def save_chart_render(user_id: int, metric: str, days: int, end_day: str, path: str, caption: str):
+    # если запись уже удалил хук инвалидации, UPDATE ничего не изменит
+    async with _db().write() as db:
         await db.execute(
-            "INSERT INTO steps_logs (user_id, steps, created_at) VALUES (?, ?, ?)",
-            (user_id, steps, datetime.utcnow().isoformat()),
+            "UPDATE chart_cache SET path = ?, caption = ? WHERE user_id = ? AND metric = ? AND days = ? AND end_day = ?",
+            (path, caption, user_id, metric, days, end_day),
         )
-        await db.commit()
 
-async def log_mood(user_id: int, score: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+@timed
+async def save_chart_file_id(user_id: int, metric: str, days: int, end_day: str, file_id: str):
+    async with _db().write() as db:
         await db.execute(
-            "INSERT INTO mood_logs (user_id, score, created_at) VALUES (?, ?, ?)",
-            (user_id, score, datetime.utcnow().isoformat()),
+            "UPDATE chart_cache SET file_id = ? "
+            "WHERE user_id = ? AND metric = ? AND days = ? AND end_day = ? AND path IS NOT NULL",
+            (file_id, user_id, metric, days, end_day),
         )
-        await db.commit()
 
-async def get_mood_stats(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+@timed
+async def rebuild_user_stats():
+    await _queue().flush()
+    async with _db().write() as db:
+        await _rebuild_user_stats(db)
+
+@timed
+async def rebuild_daily_rollups():
+    await _queue().flush()
+    async with _db().write() as db:
+        cur = await db.execute("SELECT value FROM meta WHERE key = 'compacted_before'")
+        row = await cur.fetchone()
+        await cur.close()
+        await _rebuild_daily_rollups(db, row[0] if row else None)
+        await db.execute("DELETE FROM chart_cache")
+
+@timed
+async def advance_compaction(before_day: str) -> str:
+    # отметка компакции только растёт: удалённые логи уже не вернуть
+    async with _db().write() as db:
         cur = await db.execute(
-            "SELECT AVG(score), COUNT(*) FROM mood_logs WHERE user_id = ?",
-            (user_id,),
+            """
+            INSERT INTO meta (key, value) VALUES ('compacted_before', ?)
+            ON CONFLICT (key) DO UPDATE SET value = max(value, excluded.value)
+            RETURNING value
+            """,
+            (before_day,),
         )
         row = await cur.fetchone()
         await cur.close()
-        if row and row[1]:
-            return float(row[0]), int(row[1])
-        return None
+        return row[0]
 
+@timed
+async def delete_old_logs(kind: str, before: str, after_id: int, limit: int) -> tuple[int, int | None]:
+    # логи пишутся по возрастанию времени, поэтому старые строки лежат в начале таблицы по id:
+    # просматриваем окно из limit строк после after_id и удаляем в нём всё старше before
+    table = LOG_TABLES[kind][0]
+    async with _db().write() as db:
+        cur = await db.execute(
+            f"SELECT MAX(id) FROM (SELECT id FROM {table} WHERE id > ? ORDER BY id LIMIT ?)",
+            (after_id, limit),
+        )
+        last_id = (await cur.fetchone())[0]
+        await cur.close()
+        if last_id is None:
+            return 0, None
+        cur = await db.execute(
+            f"DELETE FROM {table} WHERE id > ? AND id <= ? AND created_at < ?",
+            (after_id, last_id, before),
+        )
+        return cur.rowcount, last_id
+
+@timed
+async def incremental_vacuum(pages: int) -> int:
+    async with _db().exclusive() as db:
+        cur = await db.execute("PRAGMA freelist_count")
+        free = (await cur.fetchone())[0]
+        await cur.close()
+        if not free:
+            return 0
+        # прагма отдаёт страницы по одной строке — выбираем всё, иначе она не доработает
+        cur = await db.execute(f"PRAGMA incremental_vacuum({int(pages)})")
+        await cur.fetchall()
+        await cur.close()
+        return min(free, pages)
+
+@timed
 async def add_task(user_id: int, title: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _db().write() as db:
         await db.execute(
             "INSERT INTO tasks (user_id, title, created_at) VALUES (?, ?, ?)",
             (user_id, title, datetime.utcnow().isoformat()),
         )
-        await db.commit()
 
-async def list_tasks(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+async def _keyset_page(select: str, where: str, params: tuple, cursor: str | None, newer: bool, limit: int) -> Page:
+    # страницы идут от новых к старым; newer=True — шаг назад, к записям новее курсора
+    if cursor is None:
+        newer = False
+        order = "DESC"
+    else:
+        created_at, row_id = decode_cursor(cursor)
+        where += " AND (created_at, id) > (?, ?)" if newer else " AND (created_at, id) < (?, ?)"
+        params += (created_at, row_id)
+        order = "ASC" if newer else "DESC"
+    async with _db().read() as db:
         cur = await db.execute(
-            "SELECT id, title, done FROM tasks WHERE user_id = ? ORDER BY created_at DESC",
-            (user_id,),
+            f"{select} WHERE {where} ORDER BY created_at {order}, id {order} LIMIT ?",
+            params + (limit + 1,),
         )
         rows = await cur.fetchall()
         await cur.close()
-        return rows
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if newer:
+        rows.reverse()
+        return Page(rows, has_newer=more, has_older=True)
+    return Page(rows, has_newer=cursor is not None, has_older=more)
+
+@timed
+async def list_tasks(
+    user_id: int, done: bool | None = None, cursor: str | None = None, newer: bool = False, limit: int = 10
+) -> Page:
+    where, params = "user_id = ?", (user_id,)
+    if done is not None:
+        where, params = "user_id = ? AND done = ?", (user_id, int(done))
+    return await _keyset_page(
+        "SELECT id, title, done, created_at FROM tasks", where, params, cursor, newer, limit
+    )
 
-async def complete_task(user_id: int, task_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
+@timed
+async def rebuild_search():
+    async with _db().write() as db:
+        await db.execute(TASKS_FTS_REBUILD)
+        # индекс собран целиком: фоновой дозаливке больше нечего делать
+        await db.execute("DELETE FROM meta WHERE key IN (?, ?)", (BACKFILL_FROM, BACKFILL_TO))
+
+@timed
+async def backfill_search_batch(limit: int = BACKFILL_BATCH) -> bool:
+    """Проиндексировать следующую порцию задач, созданных до tasks_fts; False — дозаливка закончена."""
+    async with _db().write() as db:
+        cur = await db.execute(
+            "SELECT key, CAST(value AS INTEGER) FROM meta WHERE key IN (?, ?)", (BACKFILL_FROM, BACKFILL_TO)
+        )
+        bounds = dict(await cur.fetchall())
+        await cur.close()
+        if len(bounds) < 2:
+            return False
+        after, until = bounds[BACKFILL_FROM], bounds[BACKFILL_TO]
         cur = await db.execute(
-            "UPDATE tasks SET done = 1 WHERE id = ? AND user_id = ?",
+            "SELECT MAX(id) FROM (SELECT id FROM tasks WHERE id > ? AND id <= ? ORDER BY id LIMIT ?)",
+            (after, until, limit),
+        )
+        last = (await cur.fetchone())[0]
+        await cur.close()
+        if last is None:
+            await db.execute("DELETE FROM meta WHERE key IN (?, ?)", (BACKFILL_FROM, BACKFILL_TO))
+            return False
+        await db.execute(
+            "INSERT INTO tasks_fts (rowid, title, user_id) "
+            "SELECT id, title, user_id FROM tasks WHERE id > ? AND id <= ?",
+            (after, last),
+        )
+        # отметка сдвигается в той же транзакции: после перезапуска дозаливка продолжится с неё
+        await db.execute("UPDATE meta SET value = ? WHERE key = ?", (last, BACKFILL_FROM))
+        return True
+
+@timed
+async def search_tasks(user_id: int, query: str, offset: int = 0, limit: int = 10) -> Page:
+    # при очень большом числе совпадений ранжируются MAX_MATCHES самых новых задач
+    wanted = query_words(query)
+    if not wanted:
+        return Page([], has_newer=False, has_older=False)
+    async with _db().read() as db:
+        cur = await db.execute(
+            """
+            SELECT t.id, t.title, t.done, t.created_at
+            FROM tasks_fts JOIN tasks t ON t.id = tasks_fts.rowid
+            WHERE tasks_fts MATCH ?
+            ORDER BY tasks_fts.rowid DESC
+            LIMIT ?
+            """,
+            (fts_query(user_id, wanted), MAX_MATCHES),
+        )
+        rows = await cur.fetchall()
+        await cur.close()
+    return rank_page(wanted, rows, offset, limit)
+
+@timed
+async def complete_task(user_id: int, task_id: int) -> list[Rule] | None:
+    # None — задачи нет; иначе новые ачивки (пустой список, если задача уже была выполнена)
+    async with _db().write() as db:
+        cur = await db.execute(
+            "UPDATE tasks SET done = 1 WHERE id = ? AND user_id = ? AND done = 0",
             (task_id, user_id),
         )
-        await db.commit()
-        return cur.rowcount > 0
+        if cur.rowcount:
+            return await apply_event(db, user_id, "task_done", 1)
+        cur = await db.execute("SELECT 1 FROM tasks WHERE id = ? AND user_id = ?", (task_id, user_id))
+        found = await cur.fetchone()
+        await cur.close()
+        return [] if found else None
+
+@timed
+async def record_progress(user_id: int, event: str, value: float) -> list[Rule]:
+    async with _db().write() as db:
+        return await apply_event(db, user_id, event, value)
+
+@timed
+async def list_achievements(
+    user_id: int, cursor: str | None = None, newer: bool = False, limit: int = 10
+) -> Page:
+    return await _keyset_page(
+        "SELECT id, title, created_at FROM achievements", "user_id = ?", (user_id,), cursor, newer, limit
+    )
+
+@timed
+async def export_rows(
+    table: str, columns: tuple[str, ...], key: tuple[str, ...], user_id: int, after: tuple | None, limit: int
+):
+    # одна порция выгрузки по ключу (keyset): каждая порция — короткое чтение, без долгого снимка базы
+    where, params = "user_id = ?", (user_id,)
+    if after is None:
+        # первая порция таблицы: дописываем отложенные логи пользователя
+        await _queue().barrier(user_id)
+    else:
+        where += f" AND ({', '.join(key)}) > ({', '.join('?' * len(key))})"
+        params += tuple(after)
+    async with _db().read() as db:
+        cur = await db.execute(
+            f"SELECT {', '.join(columns)} FROM {table} WHERE {where} ORDER BY {', '.join(key)} LIMIT ?",
+            params + (limit,),
+        )
+        rows = await cur.fetchall()
+        await cur.close()
+        return rows
+
+@timed
+async def add_timer(user_id: int, chat_id: int, kind: str, due_at: str) -> int:
+    async with _db().write() as db:
+        cur = await db.execute(
+            "INSERT INTO timers (user_id, chat_id, kind, due_at, created_at) VALUES (?, ?, ?, ?, ?)",
+            (user_id, chat_id, kind, due_at, datetime.utcnow().isoformat()),
+        )
+        return cur.lastrowid
+
+@timed
+async def cancel_timers(user_id: int, kind: str) -> list[int]:
+    async with _db().write() as db:
+        cur = await db.execute(
+            "SELECT id FROM timers WHERE user_id = ? AND kind = ? AND status = 'pending'",
+            (user_id, kind),
+        )
+        ids = [row[0] for row in await cur.fetchall()]
+        await cur.close()
+        if ids:
+            await db.executemany(
+                "UPDATE timers SET status = 'cancelled' WHERE id = ?",
+                [(timer_id,) for timer_id in ids],
+            )
+        return ids
+
+@timed
+async def pending_timers(shard: int = 0, shards: int = 1):
+    async with _db().read() as db:
+        cur = await db.execute(
+            "SELECT id, chat_id, kind, due_at FROM timers WHERE status = 'pending' AND user_id % ? = ? ORDER BY due_at",
+            (shards, shard),
+        )
+        rows = await cur.fetchall()
+        await cur.close()
+        return rows
+
+@timed
+async def claim_timer(timer_id: int) -> bool:
+    # отметка ставится до отправки: после падения посреди неё таймер не отправится второй раз
+    async with _db().write() as db:
+        cur = await db.execute("UPDATE timers SET status = 'sending' WHERE id = ? AND status = 'pending'", (timer_id,))
+        return cur.rowcount == 1
+
+@timed
+async def abandon_sending_timers(shard: int = 0, shards: int = 1) -> int:
+    # процесс упал между отметкой и ответом Telegram: дошло ли сообщение, неизвестно
+    async with _db().write() as db:
+        cur = await db.execute(
+            "UPDATE timers SET status = 'lost' WHERE status = 'sending' AND user_id % ? = ?", (shards, shard)
+        )
+        return cur.rowcount
 
-async def add_achievement(user_id: int, title: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+@timed
+async def finish_timer(timer_id: int, status: str):
+    async with _db().write() as db:
+        await db.execute("UPDATE timers SET status = ? WHERE id = ?", (status, timer_id))
+
+@timed
+async def get_media(path: str, sha256: str) -> str | None:
+    async with _db().read() as db:
+        cur = await db.execute(
+            "SELECT file_id FROM media_cache WHERE path = ? AND sha256 = ?",
+            (path, sha256),
+        )
+        row = await cur.fetchone()
+        await cur.close()
+        return row[0] if row else None
+
+@timed
+async def save_media(path: str, sha256: str, file_id: str):
+    async with _db().write() as db:
+        # старые версии файла больше не нужны: их file_id указывает на прежнее содержимое
+        await db.execute("DELETE FROM media_cache WHERE path = ? AND sha256 != ?", (path, sha256))
         await db.execute(
-            "INSERT INTO achievements (user_id, title, created_at) VALUES (?, ?, ?)",
-            (user_id, title, datetime.utcnow().isoformat()),
+            "INSERT OR REPLACE INTO media_cache (path, sha256, file_id, updated_at) VALUES (?, ?, ?, ?)",
+            (path, sha256, file_id, datetime.utcnow().isoformat()),
         )
-        await db.commit()
 
-async def list_achievements(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+@timed
+async def drop_media(path: str):
+    async with _db().write() as db:
+        await db.execute("DELETE FROM media_cache WHERE path = ?", (path,))
+
+@timed
+async def get_fsm_record(key: str):
+    async with _db().read() as db:
+        cur = await db.execute("SELECT state, data, expires_at FROM fsm_states WHERE key = ?", (key,))
+        row = await cur.fetchone()
+        await cur.close()
+        return row
+
+@timed
+async def save_fsm_record(key: str, state: str | None, data: str, expires_at: float):
+    async with _db().write() as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO fsm_states (key, state, data, expires_at) VALUES (?, ?, ?, ?)",
+            (key, state, data, expires_at),
+        )
+
+@timed
+async def delete_fsm_record(key: str):
+    async with _db().write() as db:
+        await db.execute("DELETE FROM fsm_states WHERE key = ?", (key,))
+
+@timed
+async def purge_fsm_records(now: float) -> int:
+    async with _db().write() as db:
+        cur = await db.execute("DELETE FROM fsm_states WHERE expires_at <= ?", (now,))
+        return cur.rowcount
+
+@timed
+async def set_reminders(user_id: int, enabled: bool):
+    async with _db().write() as db:
+        await db.execute("UPDATE users SET reminders = ? WHERE user_id = ?", (int(enabled), user_id))
+
+@timed
+async def set_quiet_hours(user_id: int, quiet_from: int, quiet_to: int):
+    async with _db().write() as db:
+        await db.execute(
+            "UPDATE users SET quiet_from = ?, quiet_to = ? WHERE user_id = ?",
+            (quiet_from, quiet_to, user_id),
+        )
+
+@timed
+async def get_reminder_settings(user_id: int):
+    async with _db().read() as db:
         cur = await db.execute(
-            "SELECT title, created_at FROM achievements WHERE user_id = ? ORDER BY created_at DESC",
+            "SELECT reminders, quiet_from, quiet_to FROM users WHERE user_id = ?",
             (user_id,),
         )
+        row = await cur.fetchone()
+        await cur.close()
+        return row
+
+@timed
+async def claim_broadcast(name: str, run_date: str, lease_until: float, ranges: int = 1):
+    """Взять в аренду свободный диапазон пользователей задания; None — брать нечего."""
+    async with _db().write() as db:
+        await db.execute(
+            "INSERT OR IGNORE INTO broadcast_jobs (name, run_date, created_at) VALUES (?, ?, ?)",
+            (name, run_date, datetime.utcnow().isoformat()),
+        )
+        cur = await db.execute(
+            "SELECT id, status, last_user_id FROM broadcast_jobs WHERE name = ? AND run_date = ?",
+            (name, run_date),
+        )
+        job = await cur.fetchone()
+        await cur.close()
+        if job["status"] == "done":
+            return None
+        cur = await db.execute("SELECT 1 FROM broadcast_ranges WHERE job_id = ? LIMIT 1", (job["id"],))
+        exists = await cur.fetchone()
+        await cur.close()
+        if exists is None:
+            await _split_broadcast(db, job["id"], job["last_user_id"], ranges)
+        cur = await db.execute(
+            "SELECT id, job_id, after_user_id, until_user_id, last_user_id, sent, failed FROM broadcast_ranges "
+            "WHERE job_id = ? AND status != 'done' AND COALESCE(lease_until, 0) <= ? "
+            "ORDER BY after_user_id LIMIT 1",
+            (job["id"], time.time()),
+        )
+        part = await cur.fetchone()
+        await cur.close()
+        if part is None:
+            return None
+        await db.execute("UPDATE broadcast_ranges SET lease_until = ? WHERE id = ?", (lease_until, part["id"]))
+        return part
+
+async def _split_broadcast(db, job_id: int, after_user_id: int, ranges: int):
+    # границы делят получателей поровну и фиксируются при создании задания: от числа воркеров они не зависят
+    cur = await db.execute(
+        """
+        SELECT MAX(user_id) FROM (
+            SELECT user_id, NTILE(?) OVER (ORDER BY user_id) AS part
+            FROM users WHERE user_id > ? AND reminders = 1
+        ) GROUP BY part ORDER BY part
+        """,
+        (max(1, ranges), after_user_id),
+    )
+    bounds = [row[0] for row in await cur.fetchall()]
+    await cur.close()
+    # последний диапазон открыт сверху: в него попадут и пользователи, пришедшие во время рассылки
+    edges = [after_user_id, *bounds[:-1]]
+    await db.executemany(
+        "INSERT INTO broadcast_ranges (job_id, after_user_id, until_user_id, last_user_id) VALUES (?, ?, ?, ?)",
+        [(job_id, low, high, low) for low, high in zip(edges, [*bounds[:-1], None])],
+    )
+
+@timed
+async def broadcast_recipients(
+    job_id: int, after_user_id: int, until_user_id: int | None, hour: int, limit: int
+) -> list[int]:
+    async with _db().read() as db:
+        cur = await db.execute(
+            """
+            SELECT u.user_id FROM users u
+            WHERE u.user_id > ? AND (? IS NULL OR u.user_id <= ?) AND u.reminders = 1
+              AND NOT (CASE WHEN u.quiet_from <= u.quiet_to
+                            THEN ? >= u.quiet_from AND ? < u.quiet_to
+                            ELSE ? >= u.quiet_from OR ? < u.quiet_to END)
+              AND NOT EXISTS (
+                  SELECT 1 FROM broadcast_deliveries d WHERE d.job_id = ? AND d.user_id = u.user_id
+              )
+            ORDER BY u.user_id
+            LIMIT ?
+            """,
+            (after_user_id, until_user_id, until_user_id, hour, hour, hour, hour, job_id, limit),
+        )
         rows = await cur.fetchall()
         await cur.close()
-        return rows
+        return [row[0] for row in rows]
+
+@timed
+async def mark_delivered(job_id: int, user_id: int):
+    async with _db().write() as db:
+        await db.execute(
+            "INSERT OR IGNORE INTO broadcast_deliveries (job_id, user_id) VALUES (?, ?)",
+            (job_id, user_id),
+        )
+
+@timed
+async def advance_broadcast(range_id: int, last_user_id: int, sent: int, failed: int, lease_until: float):
+    async with _db().write() as db:
+        await db.execute(
+            "UPDATE broadcast_ranges SET last_user_id = ?, sent = ?, failed = ?, lease_until = ? WHERE id = ?",
+            (last_user_id, sent, failed, lease_until, range_id),
+        )
+        # отметки до контрольной точки больше не нужны: keyset туда уже не вернётся;
+        # чужие диапазоны того же задания не трогаем — их ведут другие воркеры
+        await db.execute(
+            """
+            DELETE FROM broadcast_deliveries
+            WHERE job_id = (SELECT job_id FROM broadcast_ranges WHERE id = ?)
+              AND user_id > (SELECT after_user_id FROM broadcast_ranges WHERE id = ?) AND user_id <= ?
+            """,
+            (range_id, range_id, last_user_id),
+        )
+
+@timed
+async def renew_broadcast_lease(range_id: int, lease_until: float):
+    async with _db().write() as db:
+        await db.execute(
+            "UPDATE broadcast_ranges SET lease_until = ? WHERE id = ? AND status != 'done'",
+            (lease_until, range_id),
+        )
+
+@timed
+async def finish_broadcast(range_id: int) -> bool:
+    """Закрыть диапазон; True, если он был последним и задание завершено целиком."""
+    async with _db().write() as db:
+        await db.execute(
+            "UPDATE broadcast_ranges SET status = 'done', lease_until = NULL WHERE id = ?",
+            (range_id,),
+        )
+        cur = await db.execute(
+            "SELECT job_id, after_user_id, until_user_id FROM broadcast_ranges WHERE id = ?", (range_id,)
+        )
+        part = await cur.fetchone()
+        await cur.close()
+        await db.execute(
+            "DELETE FROM broadcast_deliveries WHERE job_id = ? AND user_id > ? AND (? IS NULL OR user_id <= ?)",
+            (part["job_id"], part["after_user_id"], part["until_user_id"], part["until_user_id"]),
+        )
+        cur = await db.execute(
+            "SELECT COUNT(*) FILTER (WHERE status != 'done'), SUM(sent), SUM(failed) FROM broadcast_ranges "
+            "WHERE job_id = ?",
+            (part["job_id"],),
+        )
+        left, sent, failed = await cur.fetchone()
+        await cur.close()
+        if left:
+            return False
+        await db.execute(
+            "UPDATE broadcast_jobs SET status = 'done', sent = ?, failed = ?, lease_until = NULL, finished_at = ? "
+            "WHERE id = ?",
+            (sent, failed, datetime.utcnow().isoformat(), part["job_id"]),
+        )
+        return True
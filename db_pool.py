@@ -0,0 +1,95 @@
+"""Долгоживущие соединения с SQLite: один писатель и небольшой пул читателей (WAL)."""
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+from metrics import note_rows
+
+logger = logging.getLogger(__name__)
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=67108864",
+)
+
+
+class ConnectionPool:
+    def __init__(self, path: str, readers: int = 4):
+        self.path = path
+        self.readers = max(1, readers)
+        self._writer: aiosqlite.Connection | None = None
+        self._write_lock = asyncio.Lock()
+        self._idle: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self._reader_conns: list[aiosqlite.Connection] = []
+
+    async def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # писатель открывается первым: он переводит файл в WAL до появления читателей
+        self._writer = await self._connect()
+        for _ in range(self.readers):
+            conn = await self._connect()
+            await conn.execute("PRAGMA query_only=1")
+            self._reader_conns.append(conn)
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        for conn in self._reader_conns:
+            await conn.close()
+        self._reader_conns.clear()
+        self._idle = asyncio.Queue()
+        if self._writer is not None:
+            async with self._write_lock:
+                try:
+                    await self._writer.execute("PRAGMA optimize")
+                except aiosqlite.OperationalError as e:
+                    # другой процесс с той же базой держит блокировку; без optimize можно обойтись,
+                    # а незакрытое соединение оставит живой поток aiosqlite и процесс не завершится
+                    logger.warning("PRAGMA optimize при закрытии не выполнена: %s", e)
+                finally:
+                    await self._writer.close()
+            self._writer = None
+
+    async def _connect(self) -> aiosqlite.Connection:
+        # isolation_level=None: транзакциями управляем сами через BEGIN/COMMIT
+        conn = await aiosqlite.connect(self.path, isolation_level=None)
+        conn.row_factory = aiosqlite.Row
+        for pragma in PRAGMAS:
+            await conn.execute(pragma)
+        return conn
+
+    @asynccontextmanager
+    async def exclusive(self):
+        # монопольный доступ к писателю без открытой транзакции (executescript, VACUUM)
+        async with self._write_lock:
+            yield self._writer
+
+    @asynccontextmanager
+    async def write(self):
+        async with self._write_lock:
+            changes = self._writer.total_changes
+            await self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            else:
+                await self._writer.commit()
+                note_rows(self._writer.total_changes - changes)
+
+    @asynccontextmanager
+    async def read(self):
+        conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
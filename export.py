@@ -0,0 +1,180 @@
+"""Выгрузка всех данных пользователя документом: JSON (можно gzip) или CSV в zip.
+
+Таблицы читаются из Storage порциями по ключу и сразу пишутся в
+SpooledTemporaryFile: небольшая выгрузка остаётся в памяти, большая уходит на
+диск, так что расход памяти не зависит от длины истории. Файл отправляется в
+Telegram тоже порциями. Одновременных выгрузок не больше max_concurrent, и у
+одного пользователя — не больше одной.
+"""
+import asyncio
+import csv
+import gzip
+import io
+import json
+import logging
+import tempfile
+import zipfile
+from datetime import datetime
+from typing import AsyncGenerator, NamedTuple
+
+from aiogram import Bot
+from aiogram.types import InputFile, Message
+
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# Telegram не принимает от ботов документы больше 50 МБ
+MAX_DOCUMENT_BYTES = 50 * 1024 * 1024
+
+
+class ExportTable(NamedTuple):
+    name: str
+    columns: tuple[str, ...]
+    # уникальный ключ порядка для keyset-чтения порциями
+    key: tuple[str, ...]
+
+
+EXPORT_TABLES = (
+    ExportTable("water_logs", ("id", "amount_ml", "created_at"), ("created_at", "id")),
+    ExportTable("sleep_logs", ("id", "hours", "created_at"), ("created_at", "id")),
+    ExportTable("steps_logs", ("id", "steps", "created_at"), ("created_at", "id")),
+    ExportTable("mood_logs", ("id", "score", "created_at"), ("created_at", "id")),
+    ExportTable("tasks", ("id", "title", "done", "created_at"), ("created_at", "id")),
+    ExportTable("achievements", ("id", "rule", "title", "created_at"), ("created_at", "id")),
+    # старые сырые логи удаляет компакция, дневные итоги за всё время остаются здесь
+    ExportTable(
+        "daily_rollups",
+        ("day", "water_sum", "water_count", "sleep_sum", "sleep_count",
+         "steps_sum", "steps_count", "mood_sum", "mood_count"),
+        ("day",),
+    ),
+)
+
+
+class SpooledInputFile(InputFile):
+    """Отдаёт файл для загрузки порциями, не читая его в память целиком."""
+
+    def __init__(self, file, filename: str, chunk_size: int = 65536):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.file = file
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        # при повторе запроса (429, сеть) файл читается заново с начала
+        self.file.seek(0)
+        while chunk := await asyncio.to_thread(self.file.read, self.chunk_size):
+            yield chunk
+
+
+class _JsonWriter:
+    def __init__(self, spool, user_id: int, compress: bool):
+        self._raw = gzip.GzipFile(fileobj=spool, mode="wb") if compress else None
+        self._out = self._raw or spool
+        self._first_row = True
+        header = {"user_id": user_id, "exported_at": datetime.utcnow().isoformat(timespec="seconds")}
+        self._write(json.dumps(header, ensure_ascii=False)[:-1] + ', "tables": {')
+        self._first_table = True
+
+    def _write(self, text: str):
+        self._out.write(text.encode())
+
+    def begin(self, table: ExportTable):
+        self._write(("" if self._first_table else ", ") + json.dumps(table.name) + ": [")
+        self._first_table = False
+        self._first_row = True
+
+    def rows(self, table: ExportTable, rows: list):
+        parts = (json.dumps(dict(zip(table.columns, row)), ensure_ascii=False) for row in rows)
+        self._write(("" if self._first_row else ", ") + ", ".join(parts))
+        self._first_row = False
+
+    def end(self, table: ExportTable):
+        self._write("]")
+
+    def close(self):
+        self._write("}}")
+        if self._raw is not None:
+            self._raw.close()
+
+
+class _CsvZipWriter:
+    def __init__(self, spool):
+        self._zip = zipfile.ZipFile(spool, "w", zipfile.ZIP_DEFLATED)
+        self._text: io.TextIOWrapper | None = None
+        self._csv = None
+
+    def begin(self, table: ExportTable):
+        # utf-8-sig, чтобы Excel сразу понял кириллицу
+        self._text = io.TextIOWrapper(self._zip.open(f"{table.name}.csv", "w"), encoding="utf-8-sig", newline="")
+        self._csv = csv.writer(self._text)
+        self._csv.writerow(table.columns)
+
+    def rows(self, table: ExportTable, rows: list):
+        self._csv.writerows(tuple(row) for row in rows)
+
+    def end(self, table: ExportTable):
+        self._text.close()
+
+    def close(self):
+        self._zip.close()
+
+
+class Exporter:
+    def __init__(
+        self, storage: Storage, max_concurrent: int = 2, chunk_rows: int = 500, spool_bytes: int = 1024 * 1024
+    ):
+        self.storage = storage
+        self.chunk_rows = chunk_rows
+        self.spool_bytes = spool_bytes
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._busy_users: set[int] = set()
+
+    def is_running(self, user_id: int) -> bool:
+        return user_id in self._busy_users
+
+    def is_full(self) -> bool:
+        return self._slots.locked()
+
+    async def answer_export(self, message: Message, user_id: int, fmt: str = "json", compress: bool = False) -> Message | None:
+        if user_id in self._busy_users:
+            return None
+        self._busy_users.add(user_id)
+        try:
+            async with self._slots:
+                with tempfile.SpooledTemporaryFile(max_size=self.spool_bytes) as spool:
+                    rows = await self._build(spool, user_id, fmt, compress)
+                    size = spool.tell()
+                    if size > MAX_DOCUMENT_BYTES:
+                        return await message.answer("Выгрузка получилась больше 50 МБ — Telegram не примет такой файл 😔")
+                    suffix = "zip" if fmt == "csv" else ("json.gz" if compress else "json")
+                    filename = f"wellbeing_{user_id}_{datetime.utcnow():%Y%m%d}.{suffix}"
+                    logger.info("Выгрузка %s для %d: %d строк, %d байт", filename, user_id, rows, size)
+                    return await message.answer_document(
+                        SpooledInputFile(spool, filename),
+                        caption=f"Твои данные: {rows} записей 📦",
+                    )
+        finally:
+            self._busy_users.discard(user_id)
+
+    async def _build(self, spool, user_id: int, fmt: str, compress: bool) -> int:
+        writer = _CsvZipWriter(spool) if fmt == "csv" else _JsonWriter(spool, user_id, compress)
+        total = 0
+        for table in EXPORT_TABLES:
+            await asyncio.to_thread(writer.begin, table)
+            after = None
+            while True:
+                rows = await self.storage.export_rows(
+                    table.name, table.columns, table.key, user_id, after, self.chunk_rows
+                )
+                if not rows:
+                    break
+                # сжатие и запись в файл — в потоке, чтобы не занимать цикл событий
+                await asyncio.to_thread(writer.rows, table, rows)
+                total += len(rows)
+                if len(rows) < self.chunk_rows:
+                    break
+                last = dict(zip(table.columns, rows[-1]))
+                after = tuple(last[column] for column in table.key)
+            await asyncio.to_thread(writer.end, table)
+        await asyncio.to_thread(writer.close)
+        return total
@@ -1,36 +1,156 @@
 import asyncio
+import html
 import logging
 import os
-from datetime import datetime, timedelta
+import re
+from datetime import timedelta
 
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.filters import CommandStart, Command
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import CommandStart, Command, CommandObject
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import (
     Message,
     CallbackQuery,
     ReplyKeyboardMarkup,
     KeyboardButton,
     InlineKeyboardMarkup,
-    InlineKeyboardButton, FSInputFile,
+    InlineKeyboardButton,
 )
 from dotenv import load_dotenv
 
-from db import init_db, add_user_if_not_exists, add_water, add_sleep, add_steps, \
-    log_mood, get_mood_stats, add_task, list_tasks, complete_task, \
-    add_achievement, list_achievements
-
-photo = FSInputFile('photos/бот.jpg')
+from broadcast import BroadcastEngine
+from charts import CHART_METRICS, ChartService
+from compaction import Compactor
+from export import Exporter
+from media_cache import MediaCache
+from metrics import HandlerNameMiddleware, MetricsMiddleware, start_metrics_server
+from middlewares import CallbackAckMiddleware, FloodControlMiddleware, RegisterUserMiddleware
+from outbound import OutboundThrottle
+from paging import Page, encode_cursor
+from rollups import day_value
+from scheduler import TimerScheduler
+from search import query_words
+from state_store import LRUTTLStorage, SQLiteStorage
+from storage import Storage, create_storage
+from text_router import TextRouter
+from timeutil import local_now
+from webhook import run_webhook
+
+from db import open_db, close_db, init_db, backfill_search_batch, warm_user_cache
+
+START_PHOTO = "photos/бот.jpg"
 
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_FLUSH_MS = int(os.getenv("DB_FLUSH_MS", "200"))
+DB_FLUSH_ROWS = int(os.getenv("DB_FLUSH_ROWS", "500"))
+KNOWN_USERS_CACHE = int(os.getenv("KNOWN_USERS_CACHE", "100000"))
+POMODORO_MINUTES = int(os.getenv("POMODORO_MINUTES", "25"))
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")  # memory | sqlite
+STORAGE = os.getenv("STORAGE", "sqlite")  # sqlite | memory — где хранить данные пользователей
+FSM_MAX_USERS = int(os.getenv("FSM_MAX_USERS", "10000"))
+FSM_TTL_MINUTES = int(os.getenv("FSM_TTL_MINUTES", "60"))
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+# номер воркера и число воркеров; выставляет супервизор shards.py, в обычном режиме — 0 из 1
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "64"))
+
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", "3"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "3"))
+
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "2"))  # обновлений в секунду от пользователя; 0 — без ограничения
+FLOOD_BURST = float(os.getenv("FLOOD_BURST", "6"))
+FLOOD_DUPLICATE_MS = int(os.getenv("FLOOD_DUPLICATE_MS", "1000"))  # 0 — не схлопывать повторы
+FLOOD_MAX_USERS = int(os.getenv("FLOOD_MAX_USERS", "10000"))
+
+BROADCASTS_ENABLED = os.getenv("BROADCASTS_ENABLED", "1") == "1"
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", "500"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "90"))  # 0 — не удалять старые логи
+COMPACT_BATCH = int(os.getenv("COMPACT_BATCH", "1000"))
+
+LIST_PAGE_SIZE = 10
+# длинные названия обрезаются, чтобы страница гарантированно влезла в 4096 символов
+LIST_TITLE_LIMIT = 200
+FIND_QUERY_LIMIT = 50
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — не поднимать /metrics
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "0"))
+
+CHARTS_DIR = os.getenv("CHARTS_DIR", "data/charts")
+CHART_RANGES = (7, 14, 30)
+CHART_MAX_DAYS = 90
+
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", "2"))
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "500"))
+
+WATER_RE = re.compile(r"^\d{2,4}$")
+SLEEP_RE = re.compile(r"^\d{1,2}([.,]\d)?$")
+STEPS_RE = re.compile(r"^\d{3,6}$")
+TASK_ID_RE = re.compile(r"^\d+$")
 
 logging.basicConfig(level=logging.INFO)
 
-dp = Dispatcher()
+if FSM_STORAGE == "sqlite":
+    fsm_storage = SQLiteStorage(ttl=FSM_TTL_MINUTES * 60)
+else:
+    fsm_storage = LRUTTLStorage(max_size=FSM_MAX_USERS, ttl=FSM_TTL_MINUTES * 60)
+
+outbound = OutboundThrottle(
+    # общий лимит Telegram на бота делится между воркерами
+    global_rate=TG_GLOBAL_RATE / SHARD_COUNT,
+    chat_rate=TG_CHAT_RATE,
+    chat_burst=TG_CHAT_BURST,
+    max_retries=TG_MAX_RETRIES,
+)
+
+dp = Dispatcher(storage=fsm_storage)
+if FLOOD_RATE or FLOOD_DUPLICATE_MS:
+    # повторные нажатия отбрасываются раньше всего остального: до метрик, базы и хендлеров
+    dp.update.outer_middleware(FloodControlMiddleware(
+        rate=FLOOD_RATE,
+        burst=FLOOD_BURST,
+        duplicate_window=FLOOD_DUPLICATE_MS / 1000,
+        max_users=FLOOD_MAX_USERS,
+    ))
+# метрики — первыми после защиты от флуда, чтобы в задержку попадала и регистрация пользователя;
+# отброшенные обновления в неё не входят и считаются отдельно: bot_updates_suppressed_total
+dp.update.outer_middleware(MetricsMiddleware(slow_update_ms=SLOW_UPDATE_MS))
+dp.update.outer_middleware(RegisterUserMiddleware())
 router = Router()
+router.message.middleware(HandlerNameMiddleware())
+router.callback_query.middleware(HandlerNameMiddleware())
+# на каждое нажатие отвечаем сразу, не дожидаясь хендлера
+router.callback_query.middleware(CallbackAckMiddleware())
+menu = TextRouter()
+# кнопки и ответы на вопросы бота проверяются после команд и callback-хендлеров
 dp.include_router(router)
+dp.include_router(menu.router)
+
+# ========= Состояния =========
+
+class Prompt(StatesGroup):
+    water = State()
+    sleep = State()
+    steps = State()
+    task_title = State()
+    task_number = State()
 
 # ========= Клавиатуры =========
 
@@ -122,6 +242,48 @@ def tasks_menu_inline() -> InlineKeyboardMarkup:
         ]
     )
 
+# ключ фильтра в callback_data -> (done для list_tasks, подпись кнопки, заголовок списка)
+TASK_FILTERS = {
+    "a": (None, "Все", "Твои задачи:"),
+    "o": (False, "❗ Открытые", "Открытые задачи:"),
+    "d": (True, "✅ Выполненные", "Выполненные задачи:"),
+}
+
+def page_nav(prefix: str, page: Page) -> list[InlineKeyboardButton]:
+    # ◀️ ведёт к более новым записям, ▶️ — к более старым; курсор — крайняя строка страницы
+    buttons = []
+    if page.has_newer:
+        first = page.items[0]
+        buttons.append(InlineKeyboardButton(
+            text="◀️", callback_data=f"{prefix}:n:{encode_cursor(first['created_at'], first['id'])}"
+        ))
+    if page.has_older:
+        last = page.items[-1]
+        buttons.append(InlineKeyboardButton(
+            text="▶️", callback_data=f"{prefix}:o:{encode_cursor(last['created_at'], last['id'])}"
+        ))
+    return buttons
+
+def tasks_page_kb(filter_key: str, page: Page) -> InlineKeyboardMarkup:
+    filters = [
+        InlineKeyboardButton(text=label, callback_data=f"tasks:{key}")
+        for key, (_, label, _) in TASK_FILTERS.items() if key != filter_key
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=[row for row in (page_nav(f"tasks:{filter_key}", page), filters) if row])
+
+def achievements_page_kb(page: Page) -> InlineKeyboardMarkup | None:
+    nav = page_nav("ach", page)
+    return InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+
+def find_page_kb(page: Page, offset: int) -> InlineKeyboardMarkup | None:
+    # результаты поиска отсортированы по релевантности, поэтому листаем по смещению, а не по курсору
+    nav = []
+    if page.has_newer:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"find:{max(offset - LIST_PAGE_SIZE, 0)}"))
+    if page.has_older:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"find:{offset + LIST_PAGE_SIZE}"))
+    return InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+
 def pomodoro_inline() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -129,6 +291,16 @@ def pomodoro_inline() -> InlineKeyboardMarkup:
         ]
     )
 
+def pomodoro_running_inline() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(text="🔁 Заново", callback_data="pomodoro_start"),
+                InlineKeyboardButton(text="⏹ Остановить", callback_data="pomodoro_stop"),
+            ],
+        ]
+    )
+
 def interests_test_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -147,11 +319,39 @@ def interests_test_kb() -> InlineKeyboardMarkup:
         ]
     )
 
+def chart_kb(metric: str, days: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(text=spec.icon, callback_data=f"chart:{name}:{days}")
+                for name, spec in CHART_METRICS.items() if name != metric
+            ],
+            [
+                InlineKeyboardButton(text=f"{n} дн.", callback_data=f"chart:{metric}:{n}")
+                for n in CHART_RANGES if n != days
+            ],
+        ]
+    )
+
+# ========= Ответ под кнопкой =========
+
+async def edit_or_send(callback: CallbackQuery, text: str, **kwargs):
+    """Заменить текст сообщения с кнопкой; сообщение старше 48 часов недоступно — тогда прислать новое."""
+    try:
+        if isinstance(callback.message, Message):
+            await callback.message.edit_text(text, **kwargs)
+        else:
+            # бот работает в личных чатах: чат — это сам пользователь
+            await callback.bot.send_message(callback.from_user.id, text, **kwargs)
+    except TelegramBadRequest as e:
+        # повторное нажатие даёт тот же текст — сообщение уже в нужном виде
+        if "message is not modified" not in e.message:
+            raise
+
 # ========= /start =========
 
 @router.message(CommandStart())
-async def cmd_start(message: Message):
-    await add_user_if_not_exists(message.from_user.id)
+async def cmd_start(message: Message, media: MediaCache):
     text = (
         "Привет! ✨ Я бот «Я проектирую свое благополучие».\n\n"
         "Помогаю прокачивать баланс между телом, душой и развитием:\n"
@@ -160,79 +360,96 @@ async def cmd_start(message: Message):
         "🚀 Развитие — тайм-менеджмент, задачи, мини-тест интересов.\n\n"
         "Выбери направление, с которого хочешь начать 👇"
     )
-    await message.answer_photo(photo=photo, reply_markup=main_menu_kb(), caption=text)
+    await media.answer_photo(message, START_PHOTO, reply_markup=main_menu_kb(), caption=text)
     #await message.answer(text, reply_markup=main_menu_kb())
 
 # ========= ГЛАВНОЕ МЕНЮ =========
 
-@router.message(F.text == "🏃‍♂️ Тело")
+@menu.button("🏃‍♂️ Тело")
 async def body_menu(message: Message):
     await message.answer(
         "Блок «Тело» 💪\nВыбирай, что отслеживаем или улучшаем сегодня.",
         reply_markup=body_menu_kb(),
     )
 
-@router.message(F.text == "🧠 Душа")
+@menu.button("🧠 Душа")
 async def soul_menu(message: Message):
     await message.answer(
         "Блок «Душа» 💛\nПоддержка настроения и анти-стресс практики.",
         reply_markup=soul_menu_kb(),
     )
 
-@router.message(F.text == "🚀 Развитие")
+@menu.button("🚀 Развитие")
 async def social_menu(message: Message):
     await message.answer(
         "Блок «Развитие» 🚀\nУчеба, планирование и самопознание.",
         reply_markup=social_menu_kb(),
     )
 
-@router.message(F.text == "⬅️ В меню")
+@menu.button("⬅️ В меню")
 async def back_to_main(message: Message):
     await message.answer("Возвращаю в главное меню ⚖️", reply_markup=main_menu_kb())
 
 # ========= БЛОК ТЕЛО =========
 
-@router.message(F.text == "💧 Записать воду")
-async def ask_water(message: Message):
+def format_awards(awarded: list) -> str:
+    titles = ", ".join(rule.title for rule in awarded)
+    return f"Ты получаешь {'ачивку' if len(awarded) == 1 else 'ачивки'}: {titles} 🎉"
+
+@menu.button("💧 Записать воду")
+async def ask_water(message: Message, state: FSMContext):
+    await state.set_state(Prompt.water)
     await message.answer("Сколько воды ты выпил(а) сегодня? Напиши в миллилитрах, например: 250")
 
-@router.message(F.text.regexp(r"^\d{2,4}$"))
-async def save_water(message: Message):
+@menu.prompt(Prompt.water)
+async def save_water(message: Message, state: FSMContext, storage: Storage):
+    if not WATER_RE.match(message.text):
+        await message.answer("Напиши количество воды числом в миллилитрах, например: 250")
+        return
     amount = int(message.text)
-    await add_water(message.from_user.id, amount)
-    await message.answer(f"Записал 💧 {amount} мл. Так держать! 🚰")
-
-@router.message(F.text == "😴 Сон")
-async def ask_sleep(message: Message):
+    await state.clear()
+    await storage.add_water(message.from_user.id, amount)
+    today = local_now().date().isoformat()
+    rollup = await storage.get_daily_rollups(message.from_user.id, today, today)
+    total = rollup[0]["water_sum"] if rollup else amount
+    await message.answer(f"Записал 💧 {amount} мл. Сегодня всего: {total} мл. Так держать! 🚰")
+
+@menu.button("😴 Сон")
+async def ask_sleep(message: Message, state: FSMContext):
+    await state.set_state(Prompt.sleep)
     await message.answer("Сколько часов ты спал(а) прошлой ночью? Напиши, например: 7.5")
 
-@router.message(F.text.regexp(r"^\d{1,2}(\.\d)?$"))
-async def save_sleep(message: Message):
+@menu.prompt(Prompt.sleep)
+async def save_sleep(message: Message, state: FSMContext, storage: Storage):
+    if not SLEEP_RE.match(message.text):
+        await message.answer("Напиши количество часов сна числом, например: 7.5")
+        return
     hours = float(message.text.replace(",", "."))
-    await add_sleep(message.from_user.id, hours)
+    await state.clear()
+    await storage.add_sleep(message.from_user.id, hours)
     comment = "Отлично, почти идеальный диапазон 😴" if 7 <= hours <= 9 else "Постарайся приблизиться к 7–9 часам сна 🌙"
     await message.answer(f"Записал сон: {hours} ч.\n{comment}")
 
-@router.message(F.text == "🚶‍♂️ Шаги/спорт")
-async def ask_steps(message: Message):
+@menu.button("🚶‍♂️ Шаги/спорт")
+async def ask_steps(message: Message, state: FSMContext):
+    await state.set_state(Prompt.steps)
     await message.answer("Сколько шагов/минут активности у тебя сегодня? Напиши число, например: 8000")
 
-@router.message(F.text.regexp(r"^\d{3,6}$"))
-async def save_steps_handler(message: Message):
+@menu.prompt(Prompt.steps)
+async def save_steps_handler(message: Message, state: FSMContext, storage: Storage):
+    if not STEPS_RE.match(message.text):
+        await message.answer("Напиши число шагов, например: 8000")
+        return
     steps = int(message.text)
-    await add_steps(message.from_user.id, steps)
-    badge = None
-    if steps >= 10000:
-        badge = "🏅 «Легенда шагов»"
-    elif steps >= 5000:
-        badge = "🎖 «Активный день»"
-    if badge:
-        await add_achievement(message.from_user.id, badge)
-        await message.answer(f"Записал {steps} шагов/ед. активности.\nТы получаешь ачивку: {badge} 🎉")
+    await state.clear()
+    await storage.add_steps(message.from_user.id, steps)
+    awarded = await storage.record_progress(message.from_user.id, "steps", steps)
+    if awarded:
+        await message.answer(f"Записал {steps} шагов/ед. активности.\n{format_awards(awarded)}")
     else:
         await message.answer(f"Записал {steps} шагов/ед. активности. Движение — это сила 💪")
 
-@router.message(F.text == "💡 Советы по телу")
+@menu.button("💡 Советы по телу")
 async def body_tips(message: Message):
     tips = [
         "Выбирай «умный перекус»: орехи, йогурт, фрукты — топ для мозга и энергии 🧠",
@@ -244,7 +461,7 @@ async def body_tips(message: Message):
 
 # ========= БЛОК ДУША =========
 
-@router.message(F.text == "📓 Дневник настроения")
+@menu.button("📓 Дневник настроения")
 async def mood_diary(message: Message):
     await message.answer(
         "Отметь, как ты сейчас себя чувствуешь 👇",
@@ -252,9 +469,8 @@ async def mood_diary(message: Message):
     )
 
 @router.callback_query(F.data.startswith("mood_"))
-async def mood_chosen(callback: CallbackQuery):
+async def mood_chosen(callback: CallbackQuery, storage: Storage):
     score = int(callback.data.split("_")[1])
-    await log_mood(callback.from_user.id, score)
     reactions = {
         5: "Круто! Поделись этим настроением с кем-то ещё 🌞",
         4: "Отлично! Береги этот ресурс 💛",
@@ -262,25 +478,36 @@ async def mood_chosen(callback: CallbackQuery):
         2: "Немного тяжеловато. Поддержи себя чем-то маленьким и приятным 💌",
         1: "Грустно 🖤 Если хочется — напиши близкому человеку или специалисту.",
     }
-    await callback.message.edit_text(
-        f"Записал твой настрой. {reactions.get(score, '')}"
+
+    async def record_and_report():
+        # статистика читается после записи, иначе в ней не будет этой отметки
+        await storage.log_mood(callback.from_user.id, score)
+        stats = await storage.get_mood_stats(callback.from_user.id)
+        if stats:
+            avg, count = stats
+            await callback.bot.send_message(
+                callback.from_user.id, f"В твоём дневнике уже {count} отметок. Среднее настроение: {avg:.1f}/5 📊"
+            )
+
+    # правка кнопок не зависит от базы — идёт одновременно с записью; ждём обе, чтобы ошибка
+    # правки не бросила запись без присмотра, а ошибка любой из них дошла до диспетчера
+    results = await asyncio.gather(
+        record_and_report(),
+        edit_or_send(callback, f"Записал твой настрой. {reactions.get(score, '')}"),
+        return_exceptions=True,
     )
-    stats = await get_mood_stats(callback.from_user.id)
-    if stats:
-        avg, count = stats
-        await callback.message.answer(
-            f"В твоём дневнике уже {count} отметок. Среднее настроение: {avg:.1f}/5 📊"
-        )
-    await callback.answer()
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
 
-@router.message(F.text == "🆘 SOS (анти-стресс)")
+@menu.button("🆘 SOS (анти-стресс)")
 async def sos_menu(message: Message):
     await message.answer(
         "Выбери технику, чтобы немного снизить напряжение прямо сейчас 💛",
         reply_markup=sos_kb(),
     )
 
-@router.callback_query(F.data == "sos_breath")
+@router.callback_query(F.data == "sos_breath", flags={"ack": "Попробуй сделать 4 цикла дыхания 🫁"})
 async def sos_breath(callback: CallbackQuery):
     text = (
         "Дыхание 4–7–8 ✨\n\n"
@@ -290,9 +517,8 @@ async def sos_breath(callback: CallbackQuery):
         "Сделай 4 цикла. Можно закрыть глаза и представить место, где тебе спокойно."
     )
     await callback.message.edit_text(text)
-    await callback.answer("Попробуй сделать 4 цикла дыхания 🫁")
 
-@router.callback_query(F.data == "sos_ground")
+@router.callback_query(F.data == "sos_ground", flags={"ack": "Сконцентрируйся на чувствах здесь и сейчас 💛"})
 async def sos_ground(callback: CallbackQuery):
     text = (
         "Техника заземления 5-4-3-2-1 🌍\n\n"
@@ -305,9 +531,8 @@ async def sos_ground(callback: CallbackQuery):
         "Это помогает вернуть внимание в «здесь и сейчас»."
     )
     await callback.message.edit_text(text)
-    await callback.answer("Сконцентрируйся на чувствах здесь и сейчас 💛")
 
-@router.message(F.text == "🧭 Навигатор помощи")
+@menu.button("🧭 Навигатор помощи")
 async def help_navigator(message: Message):
     await message.answer(
         "Выбери ситуацию, в которой сейчас нуждаешься в подсказке 👇",
@@ -325,7 +550,6 @@ async def help_bullying(callback: CallbackQuery):
         "Важно: ты не виноват(а) в том, что тебя травят."
     )
     await callback.message.edit_text(text)
-    await callback.answer()
 
 @router.callback_query(F.data == "help_parents")
 async def help_parents(callback: CallbackQuery):
@@ -337,7 +561,6 @@ async def help_parents(callback: CallbackQuery):
         "• Помни: твои чувства и границы имеют значение."
     )
     await callback.message.edit_text(text)
-    await callback.answer()
 
 @router.callback_query(F.data == "help_exams")
 async def help_exams(callback: CallbackQuery):
@@ -349,36 +572,41 @@ async def help_exams(callback: CallbackQuery):
         "• Если тревога мешает вообще садиться за учёбу — стоит обсудить это со специалистом (психологом).\n"
     )
     await callback.message.edit_text(text)
-    await callback.answer()
 
 # ========= БЛОК РАЗВИТИЕ =========
 
-@router.message(F.text == "⏱ Pomodoro 25 мин")
+@menu.button("⏱ Pomodoro 25 мин")
 async def pomodoro_menu(message: Message):
     await message.answer(
         "Метод Pomodoro: 25 минут фокусной работы + 5 минут отдыха.\nНажми старт, чтобы запустить сессию 👇",
         reply_markup=pomodoro_inline(),
     )
 
-@router.callback_query(F.data == "pomodoro_start")
-async def pomodoro_start(callback: CallbackQuery):
-    await callback.message.edit_text(
-        "Таймер Pomodoro запущен на 25 минут ⏱\nСфокусируйся на одной задаче без отвлечений."
+@router.callback_query(F.data == "pomodoro_start", flags={"ack": "По окончании я напомню 🛎"})
+async def pomodoro_start(callback: CallbackQuery, scheduler: TimerScheduler):
+    delay = timedelta(minutes=POMODORO_MINUTES)
+    # бот работает в личных чатах, а сообщение с кнопкой может быть уже недоступно
+    scheduled = asyncio.create_task(scheduler.schedule(callback.from_user.id, callback.from_user.id, "pomodoro", delay))
+    # время окончания в тексте отличает перезапуск «🔁 Заново» от прошлого старта
+    text = (
+        f"Таймер Pomodoro запущен на {POMODORO_MINUTES} минут, до {(local_now() + delay):%H:%M} ⏱\n"
+        "Сфокусируйся на одной задаче без отвлечений."
     )
-    await callback.answer("По окончании я напомню 🛎")
-
-    async def notify():
-        await asyncio.sleep(25 * 60)  # для теста можно поставить 10
-        try:
-            await callback.message.answer(
-                "⏰ Время! Pomodoro завершён.\nСделай небольшой перерыв 5 минут ☕"
-            )
-        except Exception:
-            pass
-
-    asyncio.create_task(notify())
+    try:
+        # повторный старт в ту же минуту даёт тот же текст — таймер всё равно перезапущен
+        await edit_or_send(callback, text, reply_markup=pomodoro_running_inline())
+    finally:
+        await scheduled
+
+@router.callback_query(F.data == "pomodoro_stop")
+async def pomodoro_stop(callback: CallbackQuery, scheduler: TimerScheduler):
+    if await scheduler.cancel(callback.from_user.id, "pomodoro"):
+        await callback.message.edit_text("Pomodoro остановлен ⏹", reply_markup=pomodoro_inline())
+    else:
+        # на нажатие уже ответили, поэтому пояснение — в самом сообщении, а не всплывающим текстом
+        await callback.message.edit_text("Этот таймер уже не активен ⏹", reply_markup=pomodoro_inline())
 
-@router.message(F.text == "📝 Задачи на учебу")
+@menu.button("📝 Задачи на учебу")
 async def tasks_menu(message: Message):
     await message.answer(
         "Задачи на учёбу: фиксируй, что хочешь сделать сегодня или на неделю.\n"
@@ -387,88 +615,88 @@ async def tasks_menu(message: Message):
     )
 
 @router.callback_query(F.data == "task_add")
-async def task_add(callback: CallbackQuery):
+async def task_add(callback: CallbackQuery, state: FSMContext):
+    await state.set_state(Prompt.task_title)
     await callback.message.edit_text(
         "Напиши одну задачу для учебы или развития.\nНапример: «Выучить 10 слов по английскому»."
     )
-    # следующий текст-сообщение пользователя будет пойман ниже
-    await callback.answer()
 
-@router.message(F.text.startswith("Задача:"))
-async def task_add_from_text(message: Message):
-    # Этот хендлер можно не использовать, если обрабатывать любые тексты
-    pass
+@menu.prompt(Prompt.task_title)
+async def save_task_title(message: Message, state: FSMContext, storage: Storage):
+    title = message.text.strip()
+    if len(title) < 3:
+        await message.answer("Сделай формулировку чуть конкретнее, хотя бы 3 символа 🙂")
+        return
+    await storage.add_task(message.from_user.id, title)
+    await state.clear()
+    await message.answer(f"Задача сохранена: «{title}» ✅", reply_markup=social_menu_kb())
 
-# простой вариант: любое текстовое сообщение после нажатия task_add будет задачей
-last_task_request = {}  # user_id -> bool
 
-@router.callback_query(F.data == "task_add")
-async def task_add_request(callback: CallbackQuery):
-    last_task_request[callback.from_user.id] = True
-    await callback.message.edit_text(
-        "Напиши задачу, я её запомню 📌"
-    )
-    await callback.answer()
+def clip(text: str, limit: int = LIST_TITLE_LIMIT) -> str:
+    return text if len(text) <= limit else text[:limit - 1] + "…"
 
-@router.message()
-async def catch_task_or_route(message: Message):
-    # если пользователь только что нажал «добавить задачу»
-    if last_task_request.get(message.from_user.id):
-        title = message.text.strip()
-        if len(title) < 3:
-            await message.answer("Сделай формулировку чуть конкретнее, хотя бы 3 символа 🙂")
-            return
-        await add_task(message.from_user.id, title)
-        last_task_request[message.from_user.id] = False
-        await message.answer(f"Задача сохранена: «{title}» ✅", reply_markup=social_menu_kb())
-        return
+def task_line(task) -> str:
+    # сообщения уходят с parse_mode=HTML, а название задачи — текст пользователя
+    return f"{'✅' if task['done'] else '❗'} {task['id']}. {html.escape(clip(task['title']))}"
 
-    # остальные сообщения игнорировать или вернуть в меню, если не подошли другие хендлеры выше
-    # Если текст совпадает с уже обработанными ранее (меню/команды), сюда он не попадёт.
+def parse_page_args(parts: list[str]) -> tuple[str | None, bool]:
+    # [] — первая страница, [направление, курсор] — шаг от курсора
+    if len(parts) == 2 and parts[0] in ("n", "o"):
+        return parts[1], parts[0] == "n"
+    return None, False
 
+async def show_tasks_page(
+    callback: CallbackQuery, storage: Storage, filter_key: str, cursor: str | None = None, newer: bool = False
+):
+    done, _, header = TASK_FILTERS[filter_key]
+    try:
+        page = await storage.list_tasks(callback.from_user.id, done, cursor, newer, LIST_PAGE_SIZE)
+    except ValueError:
+        page = None
+    if page is None or (not page.items and cursor is not None):
+        # курсор испорчен или записи вокруг него удалены — показываем первую страницу
+        page = await storage.list_tasks(callback.from_user.id, done, limit=LIST_PAGE_SIZE)
+    if page.items:
+        text = header + "\n\n" + "\n".join(task_line(t) for t in page.items)
+    elif filter_key == "a":
+        text = "Пока задач нет. Добавь хотя бы одну 📌"
+    else:
+        text = f"{header}\n\nЗдесь пока пусто."
+    await edit_or_send(callback, text, reply_markup=tasks_page_kb(filter_key, page))
 
 @router.callback_query(F.data == "task_list")
-async def task_list_cb(callback: CallbackQuery):
-    tasks = await list_tasks(callback.from_user.id)
-    if not tasks:
-        await callback.message.edit_text("Пока задач нет. Добавь хотя бы одну 📌")
-    else:
-        lines = []
-        for t in tasks:
-            status = "✅" if t["done"] else "❗"
-            lines.append(f"{status} {t['id']}. {t['title']}")
-        await callback.message.edit_text("Твои задачи:\n\n" + "\n".join(lines))
-    await callback.answer()
+async def task_list_cb(callback: CallbackQuery, storage: Storage):
+    await show_tasks_page(callback, storage, "a")
+
+@router.callback_query(F.data.startswith("tasks:"))
+async def tasks_page_cb(callback: CallbackQuery, storage: Storage):
+    filter_key, *rest = callback.data.split(":")[1:]
+    if filter_key not in TASK_FILTERS:
+        return
+    await show_tasks_page(callback, storage, filter_key, *parse_page_args(rest))
 
 @router.callback_query(F.data == "task_done")
-async def task_done_cb(callback: CallbackQuery):
+async def task_done_cb(callback: CallbackQuery, state: FSMContext):
+    await state.set_state(Prompt.task_number)
     await callback.message.edit_text(
         "Напиши номер задачи, которую выполнил(а).\nНомер можно посмотреть в списке задач."
     )
-    last_task_request[callback.from_user.id] = False  # сбрасываем флаг добавления
-    # следующий текст будем трактовать как номер задачи
-    # Сделаем отдельный флаг
-    global waiting_done
-    try:
-        waiting_done[callback.from_user.id] = True
-    except NameError:
-        waiting_done = {callback.from_user.id: True}
-    await callback.answer()
-
-@router.message(F.text.regexp(r"^\d+$"))
-async def mark_task_done(message: Message):
-    global waiting_done
-    if "waiting_done" in globals() and waiting_done.get(message.from_user.id):
-        task_id = int(message.text)
-        ok = await complete_task(message.from_user.id, task_id)
-        waiting_done[message.from_user.id] = False
-        if ok:
-            await message.answer(f"Задача №{task_id} отмечена выполненной ✅")
-            await add_achievement(message.from_user.id, "🎓 «Фокус и дисциплина»")
-        else:
-            await message.answer("Не нашёл такую задачу. Проверь номер ещё раз 🙂")
 
-@router.message(F.text == "🧪 Мини-тест интересов")
+@menu.prompt(Prompt.task_number)
+async def mark_task_done(message: Message, state: FSMContext, storage: Storage):
+    if not TASK_ID_RE.match(message.text):
+        await message.answer("Напиши номер задачи цифрами, например: 3")
+        return
+    task_id = int(message.text)
+    await state.clear()
+    awarded = await storage.complete_task(message.from_user.id, task_id)
+    if awarded is not None:
+        text = f"Задача №{task_id} отмечена выполненной ✅"
+        await message.answer(f"{text}\n{format_awards(awarded)}" if awarded else text)
+    else:
+        await message.answer("Не нашёл такую задачу. Проверь номер ещё раз 🙂")
+
+@menu.button("🧪 Мини-тест интересов")
 async def test_interests(message: Message):
     await message.answer(
         "Выбери, что сейчас тебе ближе по духу 👇",
@@ -499,9 +727,8 @@ async def test_result(callback: CallbackQuery):
             "Профессии: психолог, педагог, социальный работник, врач, ментор."
         )
     await callback.message.edit_text(text)
-    await callback.answer()
 
-@router.message(F.text == "🗣 Софт-скиллы советы")
+@menu.button("🗣 Софт-скиллы советы")
 async def soft_skills(message: Message):
     tips = [
         "Перед выступлением проговори первые 2–3 фразы вслух — это снижает волнение 🎤",
@@ -510,24 +737,295 @@ async def soft_skills(message: Message):
     ]
     await message.answer("Несколько идей по софт-скиллам:\n\n" + "\n\n".join(f"• {t}" for t in tips))
 
+# ========= Поиск задач =========
+
+def format_found(query: str, page: Page) -> str:
+    return (
+        f"Задачи по запросу «{html.escape(clip(query, FIND_QUERY_LIMIT))}»:\n\n"
+        + "\n".join(task_line(t) for t in page.items)
+    )
+
+@router.message(Command("find"))
+async def find_cmd(message: Message, command: CommandObject, state: FSMContext, storage: Storage):
+    query = (command.args or "").strip()
+    if not query_words(query):
+        await message.answer("Напиши, что найти среди задач, например: /find английский")
+        return
+    page = await storage.search_tasks(message.from_user.id, query, limit=LIST_PAGE_SIZE)
+    if not page.items:
+        await message.answer(f"По запросу «{html.escape(clip(query, FIND_QUERY_LIMIT))}» задач не нашлось 🔍")
+        return
+    # запрос может не влезть в callback_data (64 байта), поэтому листание берёт его из данных FSM
+    await state.update_data(find_query=query)
+    await message.answer(format_found(query, page), reply_markup=find_page_kb(page, 0))
+
+@router.callback_query(F.data.startswith("find:"))
+async def find_page_cb(callback: CallbackQuery, state: FSMContext, storage: Storage):
+    offset = callback.data.removeprefix("find:")
+    query = (await state.get_data()).get("find_query")
+    if not offset.isdecimal() or query is None:
+        # данные FSM стираются при выходе из любого диалога
+        await edit_or_send(callback, "Поиск устарел, повтори его: /find слова из задачи 🔍")
+        return
+    page = await storage.search_tasks(callback.from_user.id, query, int(offset), LIST_PAGE_SIZE)
+    if page.items:
+        await edit_or_send(callback, format_found(query, page), reply_markup=find_page_kb(page, int(offset)))
+
 # ========= Ачивки (опциональная команда) =========
 
+def format_achievements(page: Page) -> str:
+    return "Твои ачивки:\n\n" + "\n".join(f"• {clip(a['title'])} ({a['created_at']})" for a in page.items)
+
 @router.message(Command("achievements"))
-async def show_achievements(message: Message):
-    ach = await list_achievements(message.from_user.id)
-    if not ach:
+async def show_achievements(message: Message, storage: Storage):
+    page = await storage.list_achievements(message.from_user.id, limit=LIST_PAGE_SIZE)
+    if not page.items:
         await message.answer("У тебя пока нет ачивок. Всё впереди! ⭐")
     else:
-        text = "Твои ачивки:\n\n" + "\n".join(f"• {a['title']} ({a['created_at']})" for a in ach)
-        await message.answer(text)
+        await message.answer(format_achievements(page), reply_markup=achievements_page_kb(page))
+
+@router.callback_query(F.data.startswith("ach:"))
+async def achievements_page_cb(callback: CallbackQuery, storage: Storage):
+    cursor, newer = parse_page_args(callback.data.split(":")[1:])
+    try:
+        page = await storage.list_achievements(callback.from_user.id, cursor, newer, LIST_PAGE_SIZE)
+    except ValueError:
+        page = None
+    if page is None or (not page.items and cursor is not None):
+        page = await storage.list_achievements(callback.from_user.id, limit=LIST_PAGE_SIZE)
+    if page.items:
+        await callback.message.edit_text(format_achievements(page), reply_markup=achievements_page_kb(page))
+
+# ========= Недельный отчёт =========
+
+WEEKDAYS = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+
+# метрика -> (значок, единица, формат числа)
+WEEK_METRICS = {
+    "water": ("💧", " мл", ".0f"),
+    "sleep": ("😴", " ч", ".1f"),
+    "steps": ("🚶", "", ".0f"),
+    "mood": ("📓", "/5", ".1f"),
+}
+
+def format_week(rows: dict, first_day) -> str:
+    lines = []
+    for offset in range(7):
+        day = first_day + timedelta(days=offset)
+        row = rows.get(day.isoformat())
+        prev = rows.get((day - timedelta(days=1)).isoformat())
+        parts = []
+        for metric, (icon, unit, fmt) in WEEK_METRICS.items():
+            value = day_value(row, metric)
+            if value is None:
+                continue
+            part = f"{icon} {value:{fmt}}{unit}"
+            prev_value = day_value(prev, metric)
+            if prev_value is not None and round(value - prev_value, 1):
+                part += f" ({value - prev_value:+{fmt}})"
+            parts.append(part)
+        lines.append(f"{WEEKDAYS[day.weekday()]} {day:%d.%m} — " + (" · ".join(parts) if parts else "нет записей"))
+    return "\n".join(lines)
+
+@router.message(Command("week"))
+async def week_report(message: Message, storage: Storage):
+    today = local_now().date()
+    first_day = today - timedelta(days=6)
+    # берём на день больше, чтобы у первого дня недели тоже была разница с предыдущим
+    rows = await storage.get_daily_rollups(
+        message.from_user.id, (first_day - timedelta(days=1)).isoformat(), today.isoformat()
+    )
+    if not rows:
+        await message.answer("За последнюю неделю записей пока нет. Начни с воды или сна 💧😴")
+        return
+    text = "Твоя неделя 📅\n\n" + format_week({row["day"]: row for row in rows}, first_day)
+    await message.answer(text + "\n\nГрафики за месяц: /chart mood 30, /chart sleep 30")
+
+# ========= Графики =========
+
+@router.message(Command("chart"))
+async def chart_cmd(message: Message, command: CommandObject, charts: ChartService):
+    metric, days = "mood", 14
+    for arg in (command.args or "").lower().split():
+        if arg in CHART_METRICS:
+            metric = arg
+        elif arg.isdecimal() and 2 <= int(arg) <= CHART_MAX_DAYS:
+            days = int(arg)
+        else:
+            await message.answer(
+                "Пример: /chart sleep 30\n"
+                f"Метрики: {', '.join(CHART_METRICS)}; период — от 2 до {CHART_MAX_DAYS} дней."
+            )
+            return
+    await charts.send_chart(
+        message.bot, message.chat.id, message.from_user.id, metric, days, reply_markup=chart_kb(metric, days)
+    )
 
+@router.callback_query(F.data.startswith("chart:"))
+async def chart_cb(callback: CallbackQuery, charts: ChartService):
+    metric, _, days = callback.data.removeprefix("chart:").partition(":")
+    if metric not in CHART_METRICS or not days.isdecimal() or not 2 <= int(days) <= CHART_MAX_DAYS:
+        return
+    # под сообщением старше 48 часов callback.message недоступен — график уходит прямо в личный чат
+    await charts.send_chart(
+        callback.bot, callback.from_user.id, callback.from_user.id, metric, int(days),
+        reply_markup=chart_kb(metric, int(days)),
+    )
 
-async def main():
+# ========= Выгрузка данных =========
+
+@router.message(Command("export"))
+async def export_cmd(message: Message, command: CommandObject, exporter: Exporter):
+    args = (command.args or "json").lower().split()
+    fmt = args[0]
+    compress = args[1:] == ["gz"]
+    if fmt not in ("json", "csv") or (args[1:] and not compress) or (compress and fmt == "csv"):
+        await message.answer(
+            "Форматы выгрузки:\n"
+            "/export — JSON\n"
+            "/export json gz — JSON, сжатый gzip\n"
+            "/export csv — CSV-таблицы в zip-архиве"
+        )
+        return
+    if exporter.is_running(message.from_user.id):
+        await message.answer("Выгрузка уже готовится, подожди немного ⏳")
+        return
+    if exporter.is_full():
+        await message.answer("Готовлю выгрузки для других, твоя начнётся чуть позже ⏳")
+    await exporter.answer_export(message, message.from_user.id, fmt, compress)
+
+# ========= Напоминания =========
+
+@router.message(Command("reminders"))
+async def reminders_cmd(message: Message, command: CommandObject, storage: Storage):
+    arg = (command.args or "").strip().lower()
+    if arg in ("on", "off"):
+        await storage.set_reminders(message.from_user.id, arg == "on")
+        if arg == "on":
+            await message.answer("Ежедневные напоминания включены 🔔")
+        else:
+            await message.answer("Напоминания выключены 🔕 Включить снова: /reminders on")
+        return
+    settings = await storage.get_reminder_settings(message.from_user.id)
+    if not settings:
+        await message.answer("Сначала нажми /start 🙂")
+        return
+    status = "включены 🔔" if settings["reminders"] else "выключены 🔕"
+    await message.answer(
+        f"Напоминания {status}\n"
+        f"Тихие часы: с {settings['quiet_from']}:00 до {settings['quiet_to']}:00\n\n"
+        "/reminders on или /reminders off — включить или выключить\n"
+        "/quiet 22 8 — не беспокоить с 22:00 до 8:00"
+    )
+
+@router.message(Command("quiet"))
+async def quiet_cmd(message: Message, command: CommandObject, storage: Storage):
+    parts = (command.args or "").split()
+    if len(parts) != 2 or not all(p.isdecimal() and int(p) < 24 for p in parts):
+        await message.answer("Напиши часы начала и конца тишины, например: /quiet 22 8")
+        return
+    quiet_from, quiet_to = map(int, parts)
+    await storage.set_quiet_hours(message.from_user.id, quiet_from, quiet_to)
+    await message.answer(f"Не буду беспокоить с {quiet_from}:00 до {quiet_to}:00 🌙")
+
+
+@dp.startup()
+async def on_startup(bot: Bot, dispatcher: Dispatcher):
+    await open_db(
+        readers=DB_READERS,
+        flush_interval_ms=DB_FLUSH_MS,
+        flush_max_rows=DB_FLUSH_ROWS,
+        known_users=KNOWN_USERS_CACHE,
+    )
+    await init_db()
+    await warm_user_cache(SHARD_INDEX, SHARD_COUNT)
+    storage = create_storage(STORAGE)
+    dispatcher["storage"] = storage
+    if isinstance(fsm_storage, SQLiteStorage):
+        await fsm_storage.purge_expired()
+    scheduler = TimerScheduler(bot, shard=SHARD_INDEX, shards=SHARD_COUNT)
+    await scheduler.start()
+    dispatcher["scheduler"] = scheduler
+    dispatcher["media"] = MediaCache()
+    dispatcher["charts"] = ChartService(CHARTS_DIR, storage, cache=STORAGE == "sqlite")
+    dispatcher["exporter"] = Exporter(storage, max_concurrent=EXPORT_CONCURRENCY, chunk_rows=EXPORT_CHUNK)
+    # рассылки и компакция работают с таблицами SQLite: при хранилище в памяти им нечего делать
+    if BROADCASTS_ENABLED and STORAGE == "sqlite":
+        broadcasts = BroadcastEngine(
+            bot,
+            chunk_size=BROADCAST_CHUNK,
+            concurrency=BROADCAST_CONCURRENCY,
+        )
+        broadcasts.start()
+        dispatcher["broadcasts"] = broadcasts
+    # компакция общая для всей базы — её ведёт только первый воркер
+    if RETENTION_DAYS > 0 and SHARD_INDEX == 0 and STORAGE == "sqlite":
+        compactor = Compactor(retention_days=RETENTION_DAYS, batch_rows=COMPACT_BATCH)
+        compactor.start()
+        dispatcher["compactor"] = compactor
+    # задачи, созданные до поискового индекса, дозаливаются в фоне; это тоже работа на всю базу
+    if SHARD_INDEX == 0 and STORAGE == "sqlite":
+        dispatcher["search_backfill"] = asyncio.create_task(backfill_search_index())
+    if METRICS_PORT:
+        dispatcher["metrics_runner"] = await start_metrics_server(METRICS_HOST, METRICS_PORT + SHARD_INDEX)
+
+async def backfill_search_index():
+    # по порции на транзакцию: между ними к писателю проходят записи хендлеров
+    try:
+        while await backfill_search_batch():
+            await asyncio.sleep(0)
+    except Exception:
+        logging.exception("Дозаливка поискового индекса прервалась, продолжится после перезапуска")
+
+@dp.shutdown()
+async def on_shutdown(dispatcher: Dispatcher):
+    scheduler = dispatcher.get("scheduler")
+    if scheduler is not None:
+        await scheduler.stop()
+    broadcasts = dispatcher.get("broadcasts")
+    if broadcasts is not None:
+        await broadcasts.stop()
+    compactor = dispatcher.get("compactor")
+    if compactor is not None:
+        await compactor.stop()
+    search_backfill = dispatcher.get("search_backfill")
+    if search_backfill is not None:
+        search_backfill.cancel()
+        await asyncio.gather(search_backfill, return_exceptions=True)
+    metrics_runner = dispatcher.get("metrics_runner")
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await close_db()
+
+
+def create_bot() -> Bot:
     if not BOT_TOKEN:
         raise RuntimeError("Не найден BOT_TOKEN в .env")
-    await init_db()
     bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    await dp.start_polling(bot)
+    # все исходящие вызовы бота проходят через общий троттлинг
+    bot.session.middleware(outbound)
+    return bot
+
+
+async def main():
+    bot = create_bot()
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_BASE_URL or not WEBHOOK_SECRET:
+            raise RuntimeError("Для режима webhook нужны WEBHOOK_BASE_URL и WEBHOOK_SECRET в .env")
+        await run_webhook(
+            dp,
+            bot,
+            base_url=WEBHOOK_BASE_URL,
+            path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            host=WEBAPP_HOST,
+            port=WEBAPP_PORT,
+            max_concurrency=WEBHOOK_MAX_CONCURRENCY,
+        )
+    else:
+        # если раньше бот работал через вебхук, getUpdates без этого вернёт ошибку
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 if __name__ == "__main__":
     asyncio.run(main())
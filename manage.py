@@ -0,0 +1,61 @@
+"""Служебные команды обслуживания базы: python manage.py <команда>."""
+import argparse
+import asyncio
+import logging
+import os
+
+from compaction import Compactor
+from db import DB_PATH, open_db, close_db, init_db, rebuild_daily_rollups, rebuild_search, rebuild_user_stats
+
+
+async def cmd_rebuild_stats(args):
+    await rebuild_user_stats()
+    logging.info("Таблица user_stats пересобрана из дневных агрегатов")
+
+
+async def cmd_rebuild_daily(args):
+    await rebuild_daily_rollups()
+    logging.info("Таблица daily_rollups пересобрана из логов")
+
+
+async def cmd_rebuild_search(args):
+    await rebuild_search()
+    logging.info("Поисковый индекс tasks_fts пересобран из задач")
+
+
+async def cmd_compact(args):
+    await Compactor(retention_days=args.days, batch_rows=args.batch).run_once()
+
+
+COMMANDS = {
+    "rebuild-stats": cmd_rebuild_stats,
+    "rebuild-daily": cmd_rebuild_daily,
+    "rebuild-search": cmd_rebuild_search,
+    "compact": cmd_compact,
+}
+
+
+async def run(args):
+    await open_db(args.db)
+    try:
+        await init_db()
+        await COMMANDS[args.command](args)
+    finally:
+        await close_db()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обслуживание базы бота")
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    parser.add_argument("--db", default=DB_PATH, help="путь к файлу SQLite")
+    parser.add_argument(
+        "--days", type=int, default=int(os.getenv("RETENTION_DAYS", "90")),
+        help="compact: сколько дней хранить сырые логи",
+    )
+    parser.add_argument("--batch", type=int, default=1000, help="compact: строк в одной транзакции удаления")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
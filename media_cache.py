@@ -0,0 +1,111 @@
+"""Кэш Telegram file_id для статичных файлов бота.
+
+Первая отправка загружает файл и запоминает выданный file_id (в SQLite по пути
+и sha256 содержимого); дальше отправляется только file_id. Если файл на диске
+изменился, старая запись удаляется и файл загружается заново.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+from typing import Awaitable, Callable, NamedTuple
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+
+from db import drop_media, get_media, save_media
+
+logger = logging.getLogger(__name__)
+
+# ответы Telegram, после которых file_id больше не годится и файл нужно загрузить заново
+FILE_ID_ERRORS = (
+    "wrong file identifier",
+    "wrong remote file identifier",
+    "file reference expired",
+    "file_reference_expired",
+)
+
+
+class _FileState(NamedTuple):
+    mtime_ns: int
+    size: int
+    sha256: str
+
+
+def is_file_id_error(error: TelegramBadRequest) -> bool:
+    # остальные 400 (подпись, разметка, чат) повторная загрузка не исправит
+    message = error.message.lower()
+    return any(text in message for text in FILE_ID_ERRORS)
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaCache:
+    def __init__(self):
+        # хэш пересчитываем, только когда у файла поменялись mtime или размер
+        self._states: dict[str, _FileState] = {}
+        self._file_ids: dict[tuple[str, str], str] = {}
+
+    async def answer_photo(self, message: Message, path: str, **kwargs) -> Message:
+        return await self._send(
+            path,
+            lambda media: message.answer_photo(photo=media, **kwargs),
+            lambda sent: sent.photo[-1].file_id,
+        )
+
+    async def answer_document(self, message: Message, path: str, **kwargs) -> Message:
+        return await self._send(
+            path,
+            lambda media: message.answer_document(document=media, **kwargs),
+            lambda sent: sent.document.file_id,
+        )
+
+    async def _send(
+        self,
+        path: str,
+        send: Callable[[FSInputFile | str], Awaitable[Message]],
+        extract_file_id: Callable[[Message], str],
+    ) -> Message:
+        sha256 = await self._content_hash(path)
+        file_id = await self._lookup(path, sha256)
+        if file_id:
+            try:
+                return await send(file_id)
+            except TelegramBadRequest as e:
+                if not is_file_id_error(e):
+                    raise
+                # file_id протух на стороне Telegram — загрузим файл заново
+                logger.warning("file_id для %s больше не принимается, загружаю заново", path)
+                self._file_ids.pop((path, sha256), None)
+                await drop_media(path)
+        sent = await send(FSInputFile(path))
+        file_id = extract_file_id(sent)
+        self._file_ids[(path, sha256)] = file_id
+        await save_media(path, sha256, file_id)
+        return sent
+
+    async def _content_hash(self, path: str) -> str:
+        stat = os.stat(path)
+        state = self._states.get(path)
+        if state and state.mtime_ns == stat.st_mtime_ns and state.size == stat.st_size:
+            return state.sha256
+        sha256 = await asyncio.to_thread(_sha256, path)
+        if state and state.sha256 != sha256:
+            self._file_ids.pop((path, state.sha256), None)
+        self._states[path] = _FileState(stat.st_mtime_ns, stat.st_size, sha256)
+        return sha256
+
+    async def _lookup(self, path: str, sha256: str) -> str | None:
+        key = (path, sha256)
+        if key not in self._file_ids:
+            file_id = await get_media(path, sha256)
+            if file_id is None:
+                return None
+            self._file_ids[key] = file_id
+        return self._file_ids[key]
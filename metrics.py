@@ -0,0 +1,281 @@
+"""Метрики бота в формате Prometheus: задержки хендлеров, ошибки, запросы к базе.
+
+MetricsMiddleware (outer на dp.update) меряет обработку каждого обновления и
+число обновлений в работе; HandlerNameMiddleware (inner на роутерах) и
+TextRouter сообщают, какой хендлер сработал. Декоратор timed вешается на функции
+db.py и считает время запроса и затронутые строки. Всё отдаётся текстом на
+отдельном локальном порту: GET /metrics.
+"""
+import bisect
+import functools
+import logging
+import sqlite3
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+from aiohttp import web
+
+from paging import Page
+
+logger = logging.getLogger(__name__)
+
+HANDLER_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        # последняя ячейка — значения больше самой крупной границы (+Inf)
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str = "") -> list[str]:
+        lines = []
+        cumulative = 0
+        bucket_labels = f"{labels}," if labels else ""
+        for bound, count in zip((*self.buckets, "+Inf"), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{bucket_labels}le="{bound}"}} {cumulative}')
+        total_labels = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{total_labels} {self.sum}")
+        lines.append(f"{name}_count{total_labels} {self.count}")
+        return lines
+
+
+class UpdateRecord:
+    """Что известно об обрабатываемом обновлении: хендлер и работа с базой."""
+
+    __slots__ = ("handler", "db_ops", "db_seconds", "started")
+
+    def __init__(self):
+        self.handler: str | None = None
+        self.db_ops = 0
+        self.db_seconds = 0.0
+        self.started = time.perf_counter()
+
+
+class _DbCall:
+    __slots__ = ("rows",)
+
+    def __init__(self):
+        self.rows = 0
+
+
+_update: ContextVar[UpdateRecord | None] = ContextVar("metrics_update", default=None)
+_db_call: ContextVar[_DbCall | None] = ContextVar("metrics_db_call", default=None)
+
+
+class Metrics:
+    def __init__(self):
+        self.handler_latency: dict[str, Histogram] = {}
+        self.handler_errors: Counter[str] = Counter()
+        self.updates: Counter[str] = Counter()
+        self.in_flight = 0
+        self.db_latency: dict[str, Histogram] = {}
+        self.db_rows: Counter[str] = Counter()
+        self.db_errors: Counter[str] = Counter()
+        # логи, которые очередь записи так и не смогла сохранить и отложила в файл
+        self.dead_letters = 0
+        # обновления, отброшенные защитой от флуда, по причине
+        self.suppressed: Counter[str] = Counter()
+        # исходящие вызовы с chat_id: sent, retried, throttled, dropped (повторы исчерпаны), failed
+        self.outbound: Counter[str] = Counter()
+        # от получения колбэка до answerCallbackQuery
+        self.callback_ack = Histogram(HANDLER_BUCKETS)
+        # подписчики на каждое обработанное обновление: (тип, запись, секунды); нужны бенчмарку
+        self.listeners: list[Callable[[str, UpdateRecord, float], None]] = []
+
+    def observe_handler(self, handler: str, seconds: float):
+        histogram = self.handler_latency.get(handler)
+        if histogram is None:
+            histogram = self.handler_latency[handler] = Histogram(HANDLER_BUCKETS)
+        histogram.observe(seconds)
+
+    def observe_db(self, query: str, seconds: float, rows: int):
+        histogram = self.db_latency.get(query)
+        if histogram is None:
+            histogram = self.db_latency[query] = Histogram(DB_BUCKETS)
+        histogram.observe(seconds)
+        self.db_rows[query] += rows
+
+    def render(self) -> str:
+        lines = [
+            "# HELP bot_updates_in_flight Обновления, которые сейчас обрабатываются",
+            "# TYPE bot_updates_in_flight gauge",
+            f"bot_updates_in_flight {self.in_flight}",
+            "# HELP bot_updates_total Обработанные обновления по типу",
+            "# TYPE bot_updates_total counter",
+            *(f'bot_updates_total{{type="{kind}"}} {count}' for kind, count in sorted(self.updates.items())),
+            "# HELP bot_updates_suppressed_total Обновления, отброшенные защитой от флуда",
+            "# TYPE bot_updates_suppressed_total counter",
+            *(f'bot_updates_suppressed_total{{reason="{reason}"}} {count}' for reason, count in sorted(self.suppressed.items())),
+            "# HELP bot_handler_duration_seconds Время обработки обновления по хендлеру",
+            "# TYPE bot_handler_duration_seconds histogram",
+        ]
+        for handler, histogram in sorted(self.handler_latency.items()):
+            lines += histogram.render("bot_handler_duration_seconds", f'handler="{handler}"')
+        lines += [
+            "# HELP bot_callback_ack_seconds Время от получения колбэка до ответа на него",
+            "# TYPE bot_callback_ack_seconds histogram",
+            *self.callback_ack.render("bot_callback_ack_seconds"),
+            "# HELP bot_handler_errors_total Исключения в хендлерах",
+            "# TYPE bot_handler_errors_total counter",
+            *(f'bot_handler_errors_total{{handler="{name}"}} {count}' for name, count in sorted(self.handler_errors.items())),
+            "# HELP bot_outbound_events_total Исходящие вызовы Bot API через троттлинг по исходу",
+            "# TYPE bot_outbound_events_total counter",
+            *(f'bot_outbound_events_total{{event="{event}"}} {count}' for event, count in sorted(self.outbound.items())),
+            "# HELP bot_db_query_duration_seconds Время вызова функции db.py",
+            "# TYPE bot_db_query_duration_seconds histogram",
+        ]
+        for query, histogram in sorted(self.db_latency.items()):
+            lines += histogram.render("bot_db_query_duration_seconds", f'query="{query}"')
+        lines += [
+            "# HELP bot_db_rows_total Строки, прочитанные или изменённые запросом",
+            "# TYPE bot_db_rows_total counter",
+            *(f'bot_db_rows_total{{query="{name}"}} {count}' for name, count in sorted(self.db_rows.items())),
+            "# HELP bot_db_errors_total Ошибки запросов к базе",
+            "# TYPE bot_db_errors_total counter",
+            *(f'bot_db_errors_total{{query="{name}"}} {count}' for name, count in sorted(self.db_errors.items())),
+            "# HELP bot_write_behind_dead_letters_total Логи, не сохранённые в базу после всех повторов",
+            "# TYPE bot_write_behind_dead_letters_total counter",
+            f"bot_write_behind_dead_letters_total {self.dead_letters}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+def set_handler_name(name: str):
+    record = _update.get()
+    if record is not None:
+        record.handler = name
+
+
+def note_ack():
+    # вызывается после answerCallbackQuery: сколько прошло с начала обработки обновления
+    record = _update.get()
+    if record is not None:
+        METRICS.callback_ack.observe(time.perf_counter() - record.started)
+
+
+def note_rows(count: int):
+    # вызывается пулом соединений после записи: сколько строк изменила транзакция
+    call = _db_call.get()
+    if call is not None:
+        call.rows += count
+
+
+def _result_rows(result: Any) -> int:
+    if isinstance(result, Page):
+        return len(result.items)
+    if isinstance(result, list):
+        return len(result)
+    return 1 if isinstance(result, sqlite3.Row) else 0
+
+
+def timed(func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        outer = _db_call.get() is None
+        call = _DbCall()
+        token = _db_call.set(call)
+        started = time.perf_counter()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception:
+            METRICS.db_errors[name] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            _db_call.reset(token)
+            # вложенный вызов (get_mood_stats -> get_stats) учитываем в апдейте один раз
+            record = _update.get()
+            if outer and record is not None:
+                record.db_ops += 1
+                record.db_seconds += elapsed
+        METRICS.observe_db(name, elapsed, call.rows + _result_rows(result))
+        return result
+
+    return wrapper
+
+
+class MetricsMiddleware(BaseMiddleware):
+    def __init__(self, slow_update_ms: float = 0):
+        # 0 — не логировать медленные обновления
+        self.slow_update_ms = slow_update_ms
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        record = UpdateRecord()
+        token = _update.set(record)
+        update_type = event.event_type if isinstance(event, Update) else type(event).__name__
+        METRICS.in_flight += 1
+        started = record.started
+        try:
+            return await handler(event, data)
+        except Exception:
+            METRICS.handler_errors[record.handler or "unhandled"] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            METRICS.in_flight -= 1
+            METRICS.updates[update_type] += 1
+            METRICS.observe_handler(record.handler or "unhandled", elapsed)
+            for listener in METRICS.listeners:
+                listener(update_type, record, elapsed)
+            _update.reset(token)
+            if self.slow_update_ms and elapsed * 1000 >= self.slow_update_ms:
+                logger.warning(
+                    "Медленное обновление %s: хендлер %s, %.0f мс, база %d запросов за %.0f мс",
+                    update_type, record.handler or "unhandled", elapsed * 1000,
+                    record.db_ops, record.db_seconds * 1000,
+                )
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """Inner middleware: запоминает имя функции-хендлера для MetricsMiddleware."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        if handler_object is not None:
+            set_handler_name(handler_object.callback.__name__)
+        return await handler(event, data)
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(
+            body=METRICS.render().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Метрики доступны на http://%s:%d/metrics", host, port)
+    return runner
@@ -0,0 +1,155 @@
+"""Middleware диспетчера."""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import CallbackQuery, TelegramObject, Update, User
+
+from metrics import METRICS, note_ack
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class RegisterUserMiddleware(BaseMiddleware):
+    """Заводит строку в users для любого пользователя, даже если он не нажимал /start.
+
+    Хранилище берётся из данных диспетчера; у SQLite повторные обращения
+    обслуживаются кэшем известных user_id в db и не ходят в базу.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user: User | None = data.get("event_from_user")
+        storage: Storage | None = data.get("storage")
+        if user is not None and not user.is_bot and storage is not None:
+            await storage.add_user_if_not_exists(user.id)
+        return await handler(event, data)
+
+
+class _FloodState:
+    __slots__ = ("tokens", "updated", "last_key", "last_at")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+        self.last_key: Hashable | None = None
+        self.last_at = 0.0
+
+
+def _update_key(update: Update) -> Hashable | None:
+    # одинаковым считается нажатие той же кнопки под тем же сообщением или тот же текст
+    callback = update.callback_query
+    if callback is not None:
+        return "c", callback.data, callback.message.message_id if callback.message else callback.inline_message_id
+    if update.message is not None and update.message.text:
+        return "m", update.message.text
+    return None
+
+
+class FloodControlMiddleware(BaseMiddleware):
+    """Гасит повторные нажатия и слишком частые обновления одного пользователя.
+
+    Тот же колбэк или текст в пределах duplicate_window секунд схлопывается в
+    первый, общий темп ограничен корзиной токенов: rate обновлений в секунду с
+    запасом burst. Состояние хранится только для max_users последних активных
+    пользователей. На подавленный колбэк сразу отвечаем, чтобы у кнопки пропали
+    часики; сообщения отбрасываются молча.
+    """
+
+    def __init__(self, rate: float = 2, burst: float = 6, duplicate_window: float = 1, max_users: int = 10_000):
+        # rate=0 — без ограничения темпа, duplicate_window=0 — без схлопывания повторов
+        self.rate = rate
+        self.burst = burst
+        self.duplicate_window = duplicate_window
+        self.max_users = max_users
+        self._users: OrderedDict[int, _FloodState] = OrderedDict()
+
+    def check(self, user_id: int, key: Hashable | None, now: float) -> str | None:
+        """None — пропустить обновление, иначе причина подавления: duplicate или rate."""
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = _FloodState(self.burst, now)
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        if (
+            self.duplicate_window and key is not None
+            and key == state.last_key and now - state.last_at < self.duplicate_window
+        ):
+            return "duplicate"
+        if self.rate:
+            state.tokens = min(self.burst, state.tokens + (now - state.updated) * self.rate)
+            state.updated = now
+            if state.tokens < 1:
+                return "rate"
+            state.tokens -= 1
+        # окно повтора отсчитывается от принятого обновления, а не от последнего нажатия
+        state.last_key, state.last_at = key, now
+        return None
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user: User | None = data.get("event_from_user")
+        if user is None or not isinstance(event, Update):
+            return await handler(event, data)
+        reason = self.check(user.id, _update_key(event), time.monotonic())
+        if reason is None:
+            return await handler(event, data)
+        METRICS.suppressed[reason] += 1
+        if event.callback_query is not None:
+            try:
+                await event.callback_query.answer("Не так быстро 🙂" if reason == "rate" else None)
+            except TelegramAPIError as e:
+                logger.debug("Не удалось ответить на подавленный колбэк: %s", e)
+        return None
+
+
+class CallbackAckMiddleware(BaseMiddleware):
+    """Inner middleware колбэков: отвечает на нажатие, не дожидаясь хендлера.
+
+    answerCallbackQuery уходит параллельно с работой хендлера, и часики на кнопке
+    пропадают через один вызов API, а не после всех записей в базу и правок
+    сообщений. Хендлеры сами callback.answer не вызывают; всплывающий текст
+    задаётся флагом: @router.callback_query(..., flags={"ack": "текст"}).
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        if not isinstance(event, CallbackQuery):
+            return await handler(event, data)
+        ack = asyncio.create_task(self._ack(event, get_flag(data, "ack")))
+        # даём ответу уйти в сессию раньше первого вызова API из хендлера
+        await asyncio.sleep(0)
+        try:
+            return await handler(event, data)
+        finally:
+            await ack
+
+    @staticmethod
+    async def _ack(callback: CallbackQuery, text: str | None):
+        try:
+            await callback.answer(text)
+        except TelegramAPIError as e:
+            # колбэк мог устареть (ответить можно в течение нескольких секунд), хендлер всё равно доработает
+            logger.warning("Не удалось ответить на колбэк %s: %s", callback.data, e)
+        else:
+            note_ack()
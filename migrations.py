@@ -0,0 +1,317 @@
+"""Версионированные миграции схемы SQLite.
+
+Каждая миграция применяется один раз и записывается в таблицу schema_version.
+Шаг миграции — это SQL-строка или корутина, получающая соединение писателя.
+"""
+import logging
+import sqlite3
+from datetime import datetime
+from typing import Awaitable, Callable, NamedTuple
+
+import aiosqlite
+
+from db_pool import ConnectionPool
+from achievements import dedupe_achievements, rebuild_counters
+from rollups import rebuild_daily_rollups, user_stats_from_logs
+from search import TASKS_FTS_BACKFILL, TASKS_FTS_SCHEMA
+
+logger = logging.getLogger(__name__)
+
+Step = str | Callable[[aiosqlite.Connection], Awaitable[None]]
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    steps: tuple[Step, ...]
+    # VACUUM и часть PRAGMA нельзя выполнять внутри транзакции
+    transactional: bool = True
+
+
+def _user_created_index(table: str) -> str:
+    return f"CREATE INDEX IF NOT EXISTS idx_{table}_user_created ON {table} (user_id, created_at)"
+
+
+MIGRATIONS: list[Migration] = [
+    Migration(1, "базовые таблицы", (
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            created_at TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS water_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount_ml INTEGER,
+            created_at TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS sleep_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            hours REAL,
+            created_at TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS steps_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            steps INTEGER,
+            created_at TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS mood_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            score INTEGER,
+            created_at TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            title TEXT,
+            done INTEGER DEFAULT 0,
+            created_at TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS achievements (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            title TEXT,
+            created_at TEXT
+        )
+        """,
+    )),
+    Migration(2, "индексы (user_id, created_at)", tuple(
+        _user_created_index(table)
+        for table in ("water_logs", "sleep_logs", "steps_logs", "mood_logs", "tasks", "achievements")
+    )),
+    Migration(3, "сводная статистика user_stats", (
+        """
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER NOT NULL,
+            metric TEXT NOT NULL,
+            total REAL NOT NULL DEFAULT 0,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, metric)
+        ) WITHOUT ROWID
+        """,
+        user_stats_from_logs,
+    )),
+    Migration(4, "таймеры Pomodoro", (
+        """
+        CREATE TABLE IF NOT EXISTS timers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            due_at TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_timers_pending ON timers (due_at) WHERE status = 'pending'",
+        "CREATE INDEX IF NOT EXISTS idx_timers_user_kind ON timers (user_id, kind) WHERE status = 'pending'",
+    )),
+    Migration(5, "кэш file_id для медиа", (
+        """
+        CREATE TABLE IF NOT EXISTS media_cache (
+            path TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            updated_at TEXT,
+            PRIMARY KEY (path, sha256)
+        ) WITHOUT ROWID
+        """,
+    )),
+    Migration(6, "FSM-состояния пользователей", (
+        """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_fsm_states_expires ON fsm_states (expires_at)",
+    )),
+    Migration(7, "ежедневные напоминания", (
+        "ALTER TABLE users ADD COLUMN reminders INTEGER NOT NULL DEFAULT 1",
+        "ALTER TABLE users ADD COLUMN quiet_from INTEGER NOT NULL DEFAULT 22",
+        "ALTER TABLE users ADD COLUMN quiet_to INTEGER NOT NULL DEFAULT 8",
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            run_date TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            lease_until REAL,
+            created_at TEXT,
+            finished_at TEXT,
+            UNIQUE (name, run_date)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (job_id, user_id)
+        ) WITHOUT ROWID
+        """,
+    )),
+    Migration(8, "дневные агрегаты daily_rollups", (
+        """
+        CREATE TABLE IF NOT EXISTS daily_rollups (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            water_sum INTEGER NOT NULL DEFAULT 0,
+            water_count INTEGER NOT NULL DEFAULT 0,
+            sleep_sum REAL NOT NULL DEFAULT 0,
+            sleep_count INTEGER NOT NULL DEFAULT 0,
+            steps_sum INTEGER NOT NULL DEFAULT 0,
+            steps_count INTEGER NOT NULL DEFAULT 0,
+            mood_sum INTEGER NOT NULL DEFAULT 0,
+            mood_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+        """,
+        rebuild_daily_rollups,
+    )),
+    Migration(9, "кэш графиков chart_cache", (
+        """
+        CREATE TABLE IF NOT EXISTS chart_cache (
+            user_id INTEGER NOT NULL,
+            metric TEXT NOT NULL,
+            days INTEGER NOT NULL,
+            end_day TEXT NOT NULL,
+            path TEXT,
+            caption TEXT,
+            file_id TEXT,
+            PRIMARY KEY (user_id, metric, days)
+        ) WITHOUT ROWID
+        """,
+    )),
+    Migration(10, "индекс задач по статусу", (
+        "CREATE INDEX IF NOT EXISTS idx_tasks_user_done_created ON tasks (user_id, done, created_at)",
+    )),
+    Migration(11, "правила ачивок и счётчики user_counters", (
+        "ALTER TABLE achievements ADD COLUMN rule TEXT",
+        dedupe_achievements,
+        # ачивки без правила (старые названия) уникальностью не ограничены: NULL не конфликтуют
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_achievements_user_rule ON achievements (user_id, rule)",
+        """
+        CREATE TABLE IF NOT EXISTS user_counters (
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            value REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, name)
+        ) WITHOUT ROWID
+        """,
+        rebuild_counters,
+    )),
+    Migration(12, "служебная таблица meta", (
+        """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        ) WITHOUT ROWID
+        """,
+    )),
+    # auto_vacuum у существующего файла меняется только вместе с VACUUM
+    Migration(13, "auto_vacuum=INCREMENTAL", (
+        "PRAGMA auto_vacuum=INCREMENTAL",
+        "VACUUM",
+    ), transactional=False),
+    # существующие задачи индексируются уже после старта порциями (db.backfill_search_batch),
+    # чтобы миграция не держала писателя на время чтения всей таблицы tasks
+    Migration(14, "полнотекстовый поиск задач tasks_fts", (
+        *TASKS_FTS_SCHEMA,
+        *TASKS_FTS_BACKFILL,
+    )),
+    # задание рассылки делится на диапазоны user_id с собственной арендой и курсором,
+    # чтобы имя задания и прогресс не зависели от числа воркеров
+    Migration(15, "диапазоны пользователей в рассылках broadcast_ranges", (
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_ranges (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id INTEGER NOT NULL,
+            after_user_id INTEGER NOT NULL,
+            until_user_id INTEGER,
+            last_user_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            lease_until REAL,
+            UNIQUE (job_id, after_user_id)
+        )
+        """,
+    )),
+]
+
+CURRENT_VERSION = MIGRATIONS[-1].version
+
+
+async def _current_version(db: aiosqlite.Connection) -> int:
+    try:
+        cur = await db.execute("SELECT MAX(version) FROM schema_version")
+    except sqlite3.OperationalError:
+        # таблицы ещё нет — чистая база или база до появления миграций
+        return 0
+    row = await cur.fetchone()
+    await cur.close()
+    return row[0] or 0
+
+
+async def migrate(pool: ConnectionPool) -> int:
+    async with pool.read() as db:
+        version = await _current_version(db)
+    if version >= CURRENT_VERSION:
+        return version
+
+    async with pool.exclusive() as db:
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT,
+                applied_at TEXT
+            )
+            """
+        )
+        for migration in MIGRATIONS:
+            if migration.transactional:
+                await db.execute("BEGIN IMMEDIATE")
+            try:
+                # перечитываем версию под блокировкой: параллельный процесс мог уже мигрировать
+                if migration.version <= await _current_version(db):
+                    if migration.transactional:
+                        await db.rollback()
+                    continue
+                logger.info("Применяю миграцию %d: %s", migration.version, migration.name)
+                for step in migration.steps:
+                    if isinstance(step, str):
+                        await db.execute(step)
+                    else:
+                        await step(db)
+                await db.execute(
+                    "INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                    (migration.version, migration.name, datetime.utcnow().isoformat()),
+                )
+            except BaseException:
+                if migration.transactional:
+                    await db.rollback()
+                raise
+            if migration.transactional:
+                await db.commit()
+        return await _current_version(db)
@@ -0,0 +1,187 @@
+"""Исходящие вызовы Bot API с учётом лимитов Telegram.
+
+OutboundThrottle подключается к сессии бота как request middleware, поэтому
+через него проходит каждый message.answer/edit_text/send_message. Вызовы с
+chat_id ждут токен в ведре своего чата и в общем ведре; при 429 вызов
+повторяется после retry_after, а оба ведра замирают на это время: flood-wait
+Telegram касается всего бота, и остальные чаты не должны его продлевать. Фоновые отправки (таймеры, рассылки) помечаются
+через `with background():` и пропускают вперёд ответы на действия пользователей.
+
+После сетевой ошибки или 5xx неизвестно, выполнил ли Telegram запрос. Правки и
+другие идемпотентные вызовы повторяются всегда, а новые сообщения (send*, copy*,
+forward*) — только если соединение даже не установилось: иначе повтор мог бы
+прислать пользователю дубль. Такие отправки доставляются не больше одного раза.
+Счётчики исходов публикуются на /metrics как bot_outbound_events_total.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiohttp import ClientConnectorError
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.methods import TelegramMethod
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+_priority: ContextVar[int] = ContextVar("outbound_priority", default=INTERACTIVE)
+
+# методы, которые создают новое сообщение: их повтор после частичного успеха даст дубль
+_NEW_MESSAGE_PREFIXES = ("Send", "Copy", "Forward")
+
+
+@contextmanager
+def background():
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def _safe_to_retry(method: TelegramMethod, error: Exception) -> bool:
+    if not type(method).__name__.startswith(_NEW_MESSAGE_PREFIXES):
+        return True
+    # aiogram поднимает TelegramNetworkError внутри except ClientError: исходная ошибка в __context__
+    return isinstance(error, TelegramNetworkError) and isinstance(error.__context__, ClientConnectorError)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def reserve(self) -> float:
+        # берём токен в долг и возвращаем, сколько нужно подождать до его появления
+        wait = self.delay()
+        self.tokens -= 1
+        return wait
+
+    def pause(self, seconds: float):
+        # следующий токен — не раньше чем через seconds; несколько 429 одного окна не складываются
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class OutboundThrottle(BaseRequestMiddleware):
+    def __init__(
+        self,
+        global_rate: float = 30,
+        chat_rate: float = 1,
+        chat_burst: float = 3,
+        max_retries: int = 3,
+        max_chats: int = 10000,
+    ):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: OrderedDict[int | str, TokenBucket] = OrderedDict()
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._pump_task: asyncio.Task | None = None
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: TelegramMethod,
+    ):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # getUpdates, answerCallbackQuery и т.п. не попадают под лимиты сообщений
+            return await make_request(bot, method)
+
+        attempt = 0
+        while True:
+            await self._acquire(chat_id, _priority.get())
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                # 429: Telegram запрос отклонил, повтор безопасен для любого метода
+                self._chat_bucket(chat_id).pause(e.retry_after)
+                self._global.pause(e.retry_after)
+                if attempt >= self.max_retries:
+                    METRICS.outbound["dropped"] += 1
+                    raise
+                delay = e.retry_after
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if not _safe_to_retry(method, e):
+                    METRICS.outbound["failed"] += 1
+                    raise
+                if attempt >= self.max_retries:
+                    METRICS.outbound["dropped"] += 1
+                    raise
+                delay = 2 ** attempt
+            except Exception:
+                METRICS.outbound["failed"] += 1
+                raise
+            else:
+                METRICS.outbound["sent"] += 1
+                return result
+            attempt += 1
+            METRICS.outbound["retried"] += 1
+            logger.warning("%s в чат %s: повтор через %s с", type(method).__name__, chat_id, delay)
+            await asyncio.sleep(delay)
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _acquire(self, chat_id: int | str, priority: int):
+        wait = self._chat_bucket(chat_id).reserve()
+        if wait > 0:
+            METRICS.outbound["throttled"] += 1
+            await asyncio.sleep(wait)
+        if not self._waiters and self._global.delay() == 0:
+            self._global.reserve()
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        await future
+
+    async def _pump(self):
+        # выдаёт общие токены ожидающим в порядке приоритета
+        while self._waiters:
+            future = self._waiters[0][2]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            wait = self._global.delay()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            heapq.heappop(self._waiters)
+            self._global.reserve()
+            future.set_result(None)
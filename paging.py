@@ -0,0 +1,45 @@
+"""Keyset-пагинация списков по курсору (created_at, id).
+
+Курсор кладётся в callback_data inline-кнопок, поэтому он упакован компактно:
+created_at в микросекундах от эпохи и id, оба в base36 через точку.
+Страница читает не больше limit + 1 строк независимо от длины истории.
+"""
+import string
+from datetime import datetime, timedelta
+from typing import Any, NamedTuple
+
+_DIGITS = string.digits + string.ascii_lowercase
+# created_at в базе — наивное UTC-время, поэтому и эпоха наивная
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+class Page(NamedTuple):
+    items: list[Any]
+    # есть ли записи новее первой и старше последней строки страницы
+    has_newer: bool
+    has_older: bool
+
+
+def _base36(number: int) -> str:
+    digits = []
+    while True:
+        number, rest = divmod(number, 36)
+        digits.append(_DIGITS[rest])
+        if not number:
+            return "".join(reversed(digits))
+
+
+def encode_cursor(created_at: str, row_id: int) -> str:
+    micros = (datetime.fromisoformat(created_at) - _EPOCH) // _MICROSECOND
+    return f"{_base36(micros)}.{_base36(row_id)}"
+
+
+def decode_cursor(cursor: str) -> tuple[str, int]:
+    # испорченный курсор даёт ValueError — его ловит вызывающий код
+    micros, _, row_id = cursor.partition(".")
+    try:
+        created_at = _EPOCH + timedelta(microseconds=int(micros, 36))
+    except OverflowError as e:
+        raise ValueError(f"Некорректный курсор {cursor!r}") from e
+    return created_at.isoformat(), int(row_id, 36)
@@ -0,0 +1,147 @@
+"""Агрегаты по логам трекинга, которые обновляются инкрементально при сбросе очереди записи."""
+import aiosqlite
+
+from timeutil import LOCAL_TZ, day_start_utc, local_day
+from write_behind import LogEvent
+
+# вид лога -> (таблица, колонка со значением)
+LOG_TABLES = {
+    "water": ("water_logs", "amount_ml"),
+    "sleep": ("sleep_logs", "hours"),
+    "steps": ("steps_logs", "steps"),
+    "mood": ("mood_logs", "score"),
+}
+
+# метрики, у которых значение дня — среднее по записям, а не сумма
+DAILY_AVERAGES = {"sleep", "mood"}
+
+USER_STATS_UPSERT = """
+    INSERT INTO user_stats (user_id, metric, total, count) VALUES (?, ?, ?, ?)
+    ON CONFLICT (user_id, metric) DO UPDATE SET
+        total = total + excluded.total,
+        count = count + excluded.count
+"""
+
+
+async def apply_user_stats(db: aiosqlite.Connection, events: list[LogEvent]):
+    totals: dict[tuple[int, str], list] = {}
+    for event in events:
+        acc = totals.setdefault((event.user_id, event.kind), [0, 0])
+        acc[0] += event.value
+        acc[1] += 1
+    await db.executemany(
+        USER_STATS_UPSERT,
+        [(user_id, kind, total, count) for (user_id, kind), (total, count) in totals.items()],
+    )
+
+
+async def user_stats_from_logs(db: aiosqlite.Connection):
+    # только для миграции 3: тогда daily_rollups ещё нет, а логи хранятся целиком
+    await db.execute("DELETE FROM user_stats")
+    for kind, (table, column) in LOG_TABLES.items():
+        await db.execute(
+            f"""
+            INSERT INTO user_stats (user_id, metric, total, count)
+            SELECT user_id, ?, SUM({column}), COUNT(*) FROM {table} GROUP BY user_id
+            """,
+            (kind,),
+        )
+
+
+async def rebuild_user_stats(db: aiosqlite.Connection):
+    # из дневных агрегатов, а не из логов: старые логи удаляет компакция
+    await db.execute("DELETE FROM user_stats")
+    for kind in LOG_TABLES:
+        await db.execute(
+            f"""
+            INSERT INTO user_stats (user_id, metric, total, count)
+            SELECT user_id, ?, SUM({kind}_sum), SUM({kind}_count) FROM daily_rollups
+            GROUP BY user_id HAVING SUM({kind}_count) > 0
+            """,
+            (kind,),
+        )
+
+
+def _daily_upsert(kind: str) -> str:
+    return f"""
+        INSERT INTO daily_rollups (user_id, day, {kind}_sum, {kind}_count) VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            {kind}_sum = {kind}_sum + excluded.{kind}_sum,
+            {kind}_count = {kind}_count + excluded.{kind}_count
+    """
+
+
+def pending_stats(events: list[LogEvent], kind: str) -> tuple[float, int]:
+    """Сумма и число событий вида kind, ещё не записанных в user_stats."""
+    values = [event.value for event in events if event.kind == kind]
+    return sum(values), len(values)
+
+
+def overlay_daily_rollups(user_id: int, rows: list, events: list[LogEvent], first_day: str, last_day: str) -> list:
+    """Строки daily_rollups за период вместе с событиями из очереди записи."""
+    events = [event for event in events if first_day <= local_day(event.created_at) <= last_day]
+    if not events:
+        return rows
+    by_day = {row["day"]: dict(row) for row in rows}
+    for event in events:
+        day = local_day(event.created_at)
+        row = by_day.get(day)
+        if row is None:
+            row = by_day[day] = {"user_id": user_id, "day": day}
+            for kind in LOG_TABLES:
+                row[f"{kind}_sum"] = 0
+                row[f"{kind}_count"] = 0
+        row[f"{event.kind}_sum"] += event.value
+        row[f"{event.kind}_count"] += 1
+    return [by_day[day] for day in sorted(by_day)]
+
+
+async def apply_daily_rollups(db: aiosqlite.Connection, events: list[LogEvent]):
+    totals: dict[str, dict[tuple[int, str], list]] = {}
+    for event in events:
+        acc = totals.setdefault(event.kind, {}).setdefault(
+            (event.user_id, local_day(event.created_at)), [0, 0]
+        )
+        acc[0] += event.value
+        acc[1] += 1
+    for kind, by_day in totals.items():
+        await db.executemany(
+            _daily_upsert(kind),
+            [(user_id, day, total, count) for (user_id, day), (total, count) in by_day.items()],
+        )
+
+
+async def rebuild_daily_rollups(db: aiosqlite.Connection, since_day: str | None = None):
+    # дни до since_day свёрнуты компакцией: логов за них нет, поэтому их агрегаты не трогаем
+    since_day = since_day or ""
+    since = day_start_utc(since_day) if since_day else ""
+    # день считается в часовом поясе бота, как и в apply_daily_rollups
+    shift = f"{int(LOCAL_TZ.utcoffset(None).total_seconds()):+d} seconds"
+    await db.execute("DELETE FROM daily_rollups WHERE day >= ?", (since_day,))
+    for kind, (table, column) in LOG_TABLES.items():
+        await db.execute(
+            f"""
+            INSERT INTO daily_rollups (user_id, day, {kind}_sum, {kind}_count)
+            SELECT user_id, date(created_at, ?) AS day, SUM({column}), COUNT(*)
+            FROM {table} WHERE created_at >= ? GROUP BY user_id, day
+            ON CONFLICT (user_id, day) DO UPDATE SET
+                {kind}_sum = excluded.{kind}_sum,
+                {kind}_count = excluded.{kind}_count
+            """,
+            (shift, since),
+        )
+
+
+def day_value(row, metric: str) -> float | None:
+    if row is None or not row[f"{metric}_count"]:
+        return None
+    total = row[f"{metric}_sum"]
+    return total / row[f"{metric}_count"] if metric in DAILY_AVERAGES else total
+
+
+async def invalidate_charts(db: aiosqlite.Connection, events: list[LogEvent]):
+    # график строится по daily_rollups, поэтому устаревает только от новых логов той же метрики
+    await db.executemany(
+        "DELETE FROM chart_cache WHERE user_id = ? AND metric = ?",
+        {(event.user_id, event.kind) for event in events},
+    )
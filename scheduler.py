@@ -0,0 +1,117 @@
+"""Планировщик таймеров (Pomodoro), переживающий перезапуски бота.
+
+Таймеры хранятся в таблице timers, а в памяти — только мин-куча (срок, id).
+Один цикл спит до ближайшего срока; при старте незавершённые таймеры
+загружаются из базы, просроченные отправляются сразу и один раз. В
+шардированном режиме каждый воркер загружает только таймеры своих пользователей.
+
+Доставка — не больше одного раза: перед отправкой таймер помечается в базе
+как 'sending'. Если процесс упал, не дождавшись ответа Telegram, при старте
+такой таймер становится 'lost' и не повторяется — лучше потерять
+напоминание, чем прислать его дважды.
+"""
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+
+from db import abandon_sending_timers, add_timer, cancel_timers, claim_timer, finish_timer, pending_timers
+from outbound import background
+
+logger = logging.getLogger(__name__)
+
+TIMER_TEXTS = {
+    "pomodoro": "⏰ Время! Pomodoro завершён.\nСделай небольшой перерыв 5 минут ☕",
+}
+
+
+class TimerScheduler:
+    def __init__(self, bot: Bot, shard: int = 0, shards: int = 1):
+        self.bot = bot
+        self.shard = shard
+        self.shards = shards
+        self._heap: list[tuple[datetime, int]] = []
+        # id -> (chat_id, kind); отменённые таймеры удаляются отсюда, а из кучи — лениво
+        self._live: dict[int, tuple[int, str]] = {}
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._sending: set[asyncio.Task] = set()
+
+    async def start(self):
+        lost = await abandon_sending_timers(self.shard, self.shards)
+        if lost:
+            logger.warning("Таймеров, прерванных посреди отправки: %d — повторно не отправляются", lost)
+        for row in await pending_timers(self.shard, self.shards):
+            self._push(row["id"], row["chat_id"], row["kind"], datetime.fromisoformat(row["due_at"]))
+        if self._live:
+            logger.info("Восстановлено таймеров: %d", len(self._live))
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+
+    async def schedule(self, user_id: int, chat_id: int, kind: str, delay: timedelta) -> int:
+        # у пользователя может быть только один активный таймер каждого вида: повторный старт перезапускает его
+        await self.cancel(user_id, kind)
+        due_at = datetime.utcnow() + delay
+        timer_id = await add_timer(user_id, chat_id, kind, due_at.isoformat())
+        self._push(timer_id, chat_id, kind, due_at)
+        return timer_id
+
+    async def cancel(self, user_id: int, kind: str) -> bool:
+        cancelled = await cancel_timers(user_id, kind)
+        for timer_id in cancelled:
+            self._live.pop(timer_id, None)
+        return bool(cancelled)
+
+    def _push(self, timer_id: int, chat_id: int, kind: str, due_at: datetime):
+        self._live[timer_id] = (chat_id, kind)
+        heapq.heappush(self._heap, (due_at, timer_id))
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            while self._heap and self._heap[0][1] not in self._live:
+                heapq.heappop(self._heap)
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            due_at, timer_id = self._heap[0]
+            delay = (due_at - datetime.utcnow()).total_seconds()
+            if delay > 0:
+                # будильник через call_later: проснёмся к сроку или раньше, если куча изменилась
+                alarm = asyncio.get_running_loop().call_later(delay, self._wakeup.set)
+                try:
+                    await self._wakeup.wait()
+                finally:
+                    alarm.cancel()
+                continue
+            heapq.heappop(self._heap)
+            chat_id, kind = self._live.pop(timer_id)
+            task = asyncio.create_task(self._fire(timer_id, chat_id, kind))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _fire(self, timer_id: int, chat_id: int, kind: str):
+        if not await claim_timer(timer_id):
+            # таймер отменили, пока он ждал своей очереди на отправку
+            return
+        status = "fired"
+        try:
+            with background():
+                await self.bot.send_message(chat_id, TIMER_TEXTS[kind])
+        except Exception:
+            logger.exception("Не удалось отправить таймер %d в чат %d", timer_id, chat_id)
+            status = "failed"
+        await finish_timer(timer_id, status)
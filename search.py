@@ -0,0 +1,120 @@
+"""Полнотекстовый поиск по задачам: команда /find.
+
+Названия задач индексируются виртуальной таблицей FTS5 tasks_fts с внешним
+содержимым (content='tasks'): сам текст хранится только в tasks, а индекс
+поддерживают триггеры на вставку, изменение и удаление. В индекс попадает и
+user_id — запрос ищет слова вместе с токеном пользователя, поэтому FTS5
+пересекает списки документов и не перебирает чужие задачи. Каждое слово
+запроса ищется по префиксу: «англ» находит «Английскому».
+
+Найденное ранжируется здесь же, а не bm25(): для idf FTS5 пришлось бы
+посчитать документы с каждым словом по всей таблице, а для запроса это
+десятки миллисекунд. Оценка та же и в MemoryStore.
+"""
+import re
+
+from paging import Page
+
+# сколько слов запроса учитывать: длинный запрос дороже и почти никогда не нужен
+MAX_QUERY_WORDS = 8
+# слова запроса ищутся по префиксу не длиннее этого: такие префиксы покрыты индексом prefix=
+PREFIX_CHARS = 6
+# сколько самых новых совпадений ранжировать: ограничивает работу на пользователя с тысячами задач
+MAX_MATCHES = 500
+
+# токены как у unicode61: буквы и цифры, всё остальное (включая _) — разделители
+_WORD_RE = re.compile(r"[^\W_]+")
+
+# задачи, созданные до tasks_fts, индексируются в фоне порциями по id (db.backfill_search_batch);
+# ещё не проиндексированный диапазон (from, to] хранится в meta, пока дозаливка не закончится
+BACKFILL_FROM = "tasks_fts_backfill_from"
+BACKFILL_TO = "tasks_fts_backfill_to"
+BACKFILL_BATCH = 1000
+
+
+def _indexed(row: str) -> str:
+    # строку из недозалитого диапазона в индексе ещё нет: 'delete' для неё испортил бы FTS5
+    return f"""NOT EXISTS (
+        SELECT 1 FROM meta f JOIN meta t ON t.key = '{BACKFILL_TO}'
+        WHERE f.key = '{BACKFILL_FROM}'
+          AND {row}.id > CAST(f.value AS INTEGER) AND {row}.id <= CAST(t.value AS INTEGER)
+    )"""
+
+
+TASKS_FTS_SCHEMA = (
+    # без индекса префиксов FTS5 склеивает списки всех слов с этим началом по всей таблице,
+    # а с ним префикс читается как одно слово и пересекается с токеном пользователя за доли миллисекунды
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS tasks_fts USING fts5(
+        title, user_id, content='tasks', content_rowid='id', prefix='2 3 4 5 6'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS tasks_fts_insert AFTER INSERT ON tasks BEGIN
+        INSERT INTO tasks_fts (rowid, title, user_id) VALUES (new.id, new.title, new.user_id);
+    END
+    """,
+    # у внешнего содержимого удаление из индекса требует старых значений колонок
+    f"""
+    CREATE TRIGGER IF NOT EXISTS tasks_fts_delete AFTER DELETE ON tasks
+    WHEN {_indexed("old")} BEGIN
+        INSERT INTO tasks_fts (tasks_fts, rowid, title, user_id) VALUES ('delete', old.id, old.title, old.user_id);
+    END
+    """,
+    # отметка о выполнении меняет только done — индекс при этом не трогаем;
+    # новое название недозалитой задачи попадёт в индекс вместе с её порцией
+    f"""
+    CREATE TRIGGER IF NOT EXISTS tasks_fts_update AFTER UPDATE OF title, user_id ON tasks
+    WHEN {_indexed("old")} BEGIN
+        INSERT INTO tasks_fts (tasks_fts, rowid, title, user_id) VALUES ('delete', old.id, old.title, old.user_id);
+        INSERT INTO tasks_fts (rowid, title, user_id) VALUES (new.id, new.title, new.user_id);
+    END
+    """,
+)
+
+# миграция только отмечает, какие задачи ещё не в индексе: сама дозаливка идёт после старта
+TASKS_FTS_BACKFILL = (
+    f"INSERT OR REPLACE INTO meta (key, value) VALUES ('{BACKFILL_FROM}', 0)",
+    f"INSERT OR REPLACE INTO meta (key, value) SELECT '{BACKFILL_TO}', COALESCE(MAX(id), 0) FROM tasks",
+)
+
+# полная пересборка (manage.py rebuild-search): FTS5 сам перечитывает все названия из tasks
+TASKS_FTS_REBUILD = "INSERT INTO tasks_fts (tasks_fts) VALUES ('rebuild')"
+
+
+def words(text: str) -> list[str]:
+    return _WORD_RE.findall(text.casefold())
+
+
+def query_words(text: str) -> list[str]:
+    """Слова запроса в нижнем регистре, обрезанные до PREFIX_CHARS символов."""
+    # обрезка заодно склеивает окончания: «английскому» находит «Английский»
+    return [word[:PREFIX_CHARS] for word in words(text)[:MAX_QUERY_WORDS]]
+
+
+def fts_query(user_id: int, wanted: list[str]) -> str:
+    # однобуквенные префиксы не индексируются, поэтому такие слова ищутся целиком;
+    # слова состоят только из букв и цифр, так что кавычки внутри не встретятся
+    terms = (f'title:"{word}"*' if len(word) > 1 else f'title:"{word}"' for word in wanted)
+    return " AND ".join([f'user_id:"{user_id}"', *terms])
+
+
+def _matches(prefix: str, word: str) -> bool:
+    return word.startswith(prefix) if len(prefix) > 1 else word == prefix
+
+
+def score(wanted: list[str], title: str) -> float:
+    """Релевантность названия: совпадения на слово названия; 0 — подошли не все слова запроса."""
+    title_words = words(title)
+    hits = [sum(_matches(prefix, word) for word in title_words) for prefix in wanted]
+    if not title_words or not all(hits):
+        return 0.0
+    return sum(hits) / len(title_words)
+
+
+def rank_page(wanted: list[str], tasks: list, offset: int, limit: int) -> Page:
+    # результаты по релевантности, при равенстве — новые; has_newer — есть предыдущая страница, has_older — следующая
+    scored = [(relevance, task) for task in tasks if (relevance := score(wanted, task["title"]))]
+    scored.sort(key=lambda item: (-item[0], -item[1]["id"]))
+    found = [task for _, task in scored]
+    return Page(found[offset:offset + limit], has_newer=offset > 0, has_older=len(found) > offset + limit)
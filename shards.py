@@ -0,0 +1,378 @@
+"""Бот в нескольких процессах: python shards.py [--workers N].
+
+Один процесс с start_polling упирается в одно ядро: хендлеры и разбор
+обновлений pydantic'ом делят его между собой. Здесь супервизор сам забирает
+обновления через getUpdates сырым aiohttp, без разбора, и раздаёт их воркерам
+по user_id % N: обновления одного пользователя всегда попадают в один процесс
+и обрабатываются там по очереди. Воркер — обычный диспетчер из main.py со своим
+пулом соединений и своим писателем; записи разных процессов сериализует
+блокировка файла SQLite (busy_timeout). Таймеры и кэш пользователей каждый
+воркер ведёт только для своих пользователей, компакцию — первый воркер, а
+диапазоны пользователей в рассылках воркеры берут в аренду по одному.
+
+Супервизор помнит обновления, которые воркер ещё не подтвердил. Упавший воркер
+перезапускается и получает их заново (обработка «хотя бы один раз»). offset для
+getUpdates сдвигается только до самого раннего неподтверждённого обновления, так
+что после падения самого супервизора Telegram пришлёт их снова. SIGHUP —
+мягкий перезапуск по очереди: воркер дорабатывает начатое и выходит, новый
+продолжает с того же места в очереди.
+"""
+import argparse
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from typing import Any, Callable
+
+import aiohttp
+from aiogram import Bot
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API = "https://api.telegram.org"
+
+# воркер ещё ничего не получил, но супервизор жив — ждём дальше
+_IDLE = object()
+
+
+def shard_of(user_id: int, shards: int) -> int:
+    return user_id % shards
+
+
+def update_user_id(raw: dict[str, Any]) -> int:
+    # у сообщений и колбэков автор в "from", у реакций и ответов в опросах — в "user"
+    for key, payload in raw.items():
+        if key == "update_id" or not isinstance(payload, dict):
+            continue
+        user = payload.get("from") or payload.get("user")
+        if user:
+            return user["id"]
+        chat = payload.get("chat")
+        if chat:
+            return chat["id"]
+    return 0
+
+
+# ========= Воркер =========
+
+def run_worker(
+    shard: int,
+    shards: int,
+    inbox: multiprocessing.Queue,
+    outbox: multiprocessing.Queue,
+    make_bot: Callable[[], Bot] | None,
+    max_concurrency: int,
+):
+    # Ctrl+C и SIGTERM приходят всей группе процессов; останавливает воркеры только супервизор
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # main читает настройки при импорте, поэтому номер шарда — до импорта
+    os.environ.update(SHARD_INDEX=str(shard), SHARD_COUNT=str(shards))
+    asyncio.run(_serve(shard, inbox, outbox, make_bot, max_concurrency))
+
+
+def _next_update(inbox: multiprocessing.Queue):
+    try:
+        return inbox.get(timeout=1)
+    except queue.Empty:
+        # супервизор убит без остановки воркеров — выходим, а не ждём вечно
+        return _IDLE if multiprocessing.parent_process().is_alive() else None
+
+
+async def _serve(
+    shard: int,
+    inbox: multiprocessing.Queue,
+    outbox: multiprocessing.Queue,
+    make_bot: Callable[[], Bot] | None,
+    max_concurrency: int,
+):
+    import main
+
+    bot = make_bot() if make_bot is not None else main.create_bot()
+    dp = main.dp
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot])
+    outbox.put((shard, None))
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(max_concurrency)
+    # последнее обновление каждого пользователя: следующее ждёт его завершения
+    tails: dict[int, asyncio.Task] = {}
+
+    async def process(raw: dict[str, Any], previous: asyncio.Task | None):
+        try:
+            if previous is not None:
+                await asyncio.wait((previous,))
+            await dp.feed_raw_update(bot, raw)
+        except Exception:
+            logger.exception("Воркер %d: ошибка в обновлении %d", shard, raw["update_id"])
+        finally:
+            slots.release()
+            outbox.put((shard, raw["update_id"]))
+
+    def forget(user_id: int, task: asyncio.Task):
+        if tails.get(user_id) is task:
+            del tails[user_id]
+
+    try:
+        while (raw := await loop.run_in_executor(None, _next_update, inbox)) is not None:
+            if raw is _IDLE:
+                continue
+            await slots.acquire()
+            user_id = update_user_id(raw)
+            task = asyncio.create_task(process(raw, tails.get(user_id)))
+            tails[user_id] = task
+            task.add_done_callback(functools.partial(forget, user_id))
+        # хвосты ждут предыдущие обновления своих пользователей, так что дожидаемся всего начатого
+        if tails:
+            await asyncio.wait(tuple(tails.values()))
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot])
+        await bot.session.close()
+
+
+# ========= Супервизор =========
+
+class Supervisor:
+    def __init__(
+        self,
+        workers: int,
+        make_bot: Callable[[], Bot] | None = None,
+        max_concurrency: int = 64,
+        restart_delay: float = 1.0,
+    ):
+        self.workers = workers
+        # фабрика бота вызывается в воркере; должна быть функцией уровня модуля (spawn её пиклит)
+        self.make_bot = make_bot
+        self.max_concurrency = max_concurrency
+        self.restart_delay = restart_delay
+        self._ctx = multiprocessing.get_context("spawn")
+        self._inboxes = [self._ctx.Queue() for _ in range(workers)]
+        self._outbox = self._ctx.Queue()
+        self._procs: list[multiprocessing.Process | None] = [None] * workers
+        self._ready = [asyncio.Event() for _ in range(workers)]
+        # шард -> update_id -> (сырое обновление, когда отдано воркеру)
+        self._pending: list[dict[int, tuple[dict, float]]] = [{} for _ in range(workers)]
+        self._idle = asyncio.Event()
+        self._idle.set()
+        # старший update_id, отданный воркерам: getUpdates повторяет неподтверждённые, их не раздаём дважды
+        self._last_dispatched = 0
+        self._acked = asyncio.Event()
+        self._restarting: set[int] = set()
+        self._stopping = False
+        self._tasks: list[asyncio.Task] = []
+        # подписчики на подтверждения воркеров: (шард, update_id, секунды); нужны бенчмарку
+        self.listeners: list[Callable[[int, int, float], None]] = []
+
+    async def start(self):
+        for shard in range(self.workers):
+            self._spawn(shard)
+        self._tasks = [asyncio.create_task(self._collect()), asyncio.create_task(self._watch())]
+        await asyncio.gather(*(ready.wait() for ready in self._ready))
+        logger.info("Запущено воркеров: %d", self.workers)
+
+    async def stop(self):
+        self._stopping = True
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for proc in self._procs:
+            await self._join(proc)
+        self._outbox.put(None)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def dispatch(self, raw: dict[str, Any]) -> int:
+        shard = shard_of(update_user_id(raw), self.workers)
+        self._pending[shard][raw["update_id"]] = (raw, time.monotonic())
+        self._last_dispatched = max(self._last_dispatched, raw["update_id"])
+        self._idle.clear()
+        self._inboxes[shard].put(raw)
+        return shard
+
+    async def drain(self):
+        await self._idle.wait()
+
+    def confirmed_offset(self) -> int | None:
+        """offset для getUpdates: Telegram забывает только то, что подтвердили все воркеры."""
+        # воркер обрабатывает пользователей параллельно, поэтому подтверждения приходят не по порядку
+        unacked = [min(pending) for pending in self._pending if pending]
+        if unacked:
+            return min(unacked)
+        return self._last_dispatched + 1 if self._last_dispatched else None
+
+    async def restart(self, shard: int):
+        """Мягкий перезапуск: воркер дорабатывает полученное до метки и выходит."""
+        self._restarting.add(shard)
+        try:
+            proc = self._procs[shard]
+            self._inboxes[shard].put(None)
+            await self._join(proc)
+            self._respawn(shard, crashed=proc.exitcode != 0)
+            await self._ready[shard].wait()
+        finally:
+            self._restarting.discard(shard)
+
+    async def rolling_restart(self):
+        for shard in range(self.workers):
+            await self.restart(shard)
+        logger.info("Все воркеры перезапущены")
+
+    def _spawn(self, shard: int):
+        self._ready[shard].clear()
+        proc = self._ctx.Process(
+            target=run_worker,
+            args=(shard, self.workers, self._inboxes[shard], self._outbox, self.make_bot, self.max_concurrency),
+            name=f"shard-{shard}",
+        )
+        proc.start()
+        self._procs[shard] = proc
+
+    def _respawn(self, shard: int, crashed: bool):
+        if crashed:
+            # процесс мог упасть посреди чтения очереди: берём новую и отдаём всё неподтверждённое заново
+            self._inboxes[shard] = self._ctx.Queue()
+            for raw, _ in self._pending[shard].values():
+                self._inboxes[shard].put(raw)
+        self._spawn(shard)
+
+    @staticmethod
+    async def _join(proc: multiprocessing.Process | None):
+        while proc is not None and proc.is_alive():
+            await asyncio.sleep(0.05)
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while (item := await loop.run_in_executor(None, self._outbox.get)) is not None:
+            shard, update_id = item
+            if update_id is None:
+                self._ready[shard].set()
+                continue
+            self._ack(shard, update_id)
+
+    def _ack(self, shard: int, update_id: int):
+        entry = self._pending[shard].pop(update_id, None)
+        if entry is not None:
+            seconds = time.monotonic() - entry[1]
+            for listener in self.listeners:
+                listener(shard, update_id, seconds)
+        self._acked.set()
+        if not any(self._pending):
+            self._idle.set()
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(1)
+            for shard, proc in enumerate(self._procs):
+                if self._stopping or shard in self._restarting or proc.is_alive():
+                    continue
+                logger.warning(
+                    "Воркер %d завершился с кодом %s, перезапуск; неподтверждённых обновлений: %d",
+                    shard, proc.exitcode, len(self._pending[shard]),
+                )
+                self._restarting.add(shard)
+                try:
+                    await asyncio.sleep(self.restart_delay)
+                    self._respawn(shard, crashed=True)
+                finally:
+                    self._restarting.discard(shard)
+
+    async def poll(self, token: str, allowed_updates: list[str], timeout: int = 30):
+        base = f"{TELEGRAM_API}/bot{token}/"
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout + 10)) as session:
+            # если раньше бот работал через вебхук, getUpdates без этого вернёт ошибку
+            async with session.post(base + "deleteWebhook") as resp:
+                await resp.read()
+            while True:
+                payload = {"timeout": timeout, "allowed_updates": allowed_updates}
+                offset = self.confirmed_offset()
+                if offset is not None:
+                    payload["offset"] = offset
+                self._acked.clear()
+                try:
+                    async with session.post(base + "getUpdates", json=payload) as resp:
+                        body = await resp.json()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logger.warning("getUpdates: %r, повтор через 5 с", e)
+                    await asyncio.sleep(5)
+                    continue
+                if not body.get("ok"):
+                    retry_after = body.get("parameters", {}).get("retry_after", 5)
+                    logger.error("getUpdates: %s, повтор через %s с", body.get("description"), retry_after)
+                    await asyncio.sleep(retry_after)
+                    continue
+                fresh = [raw for raw in body["result"] if raw["update_id"] > self._last_dispatched]
+                for raw in fresh:
+                    self.dispatch(raw)
+                if body["result"] and not fresh:
+                    # всё полученное ещё у воркеров, и getUpdates сразу вернёт то же самое — ждём подтверждения
+                    try:
+                        await asyncio.wait_for(self._acked.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+
+    async def confirm(self, token: str):
+        """Сообщить Telegram о подтверждённых обновлениях, чтобы после перезапуска они не пришли снова."""
+        offset = self.confirmed_offset()
+        if offset is None:
+            return
+        payload = {"offset": offset, "limit": 1, "timeout": 0}
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+                async with session.post(f"{TELEGRAM_API}/bot{token}/getUpdates", json=payload) as resp:
+                    await resp.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning("Не удалось подтвердить обновления до %d: %r", offset, e)
+
+
+async def run(args):
+    # воркеры импортируют main сами, уже со своим SHARD_INDEX
+    import main
+    from db import close_db, init_db, open_db
+
+    if not main.BOT_TOKEN:
+        raise RuntimeError("Не найден BOT_TOKEN в .env")
+    # миграции — один раз до старта воркеров, чтобы они не соревновались за схему
+    await open_db()
+    try:
+        await init_db()
+    finally:
+        await close_db()
+
+    cores = os.cpu_count() or 1
+    if cores < 2 or args.workers > cores:
+        # на одном ядре воркеры только добавляют межпроцессный обмен (см. замеры в README)
+        logger.warning("Воркеров %d при %d ядрах: это медленнее, чем один процесс main.py", args.workers, cores)
+    supervisor = Supervisor(args.workers, max_concurrency=args.concurrency)
+    await supervisor.start()
+    loop = asyncio.get_running_loop()
+    polling = asyncio.create_task(supervisor.poll(main.BOT_TOKEN, main.dp.resolve_used_update_types()))
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, polling.cancel)
+    loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.create_task(supervisor.rolling_restart()))
+    try:
+        await polling
+    except asyncio.CancelledError:
+        pass
+    finally:
+        logger.info("Остановка: ждём, пока воркеры доработают начатое")
+        await supervisor.stop()
+        await supervisor.confirm(main.BOT_TOKEN)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бот в нескольких процессах-воркерах")
+    parser.add_argument(
+        "--workers", type=int, default=int(os.getenv("SHARD_WORKERS", "0")) or os.cpu_count(),
+        help="число воркеров (по умолчанию — число ядер)",
+    )
+    parser.add_argument("--concurrency", type=int, default=64, help="обновлений одновременно в одном воркере")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Хранилища FSM-состояний: ограниченное LRU+TTL в памяти и SQLite для нескольких процессов."""
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Mapping, NamedTuple
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+from db import delete_fsm_record, get_fsm_record, purge_fsm_records, save_fsm_record
+
+
+def _state_name(state: StateType) -> str | None:
+    return state.state if isinstance(state, State) else state
+
+
+def _check_data(data: Mapping[str, Any]):
+    if not isinstance(data, dict):
+        raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+
+
+class _Record(NamedTuple):
+    state: str | None
+    data: dict[str, Any]
+    expires_at: float
+
+
+class LRUTTLStorage(BaseStorage):
+    """Состояния в памяти процесса: не больше max_size пользователей, каждое живёт ttl секунд."""
+
+    def __init__(self, max_size: int = 10000, ttl: float = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._records: OrderedDict[StorageKey, _Record] = OrderedDict()
+
+    async def close(self):
+        self._records.clear()
+
+    def _get(self, key: StorageKey) -> _Record | None:
+        record = self._records.get(key)
+        if record is None:
+            return None
+        if record.expires_at <= time.monotonic():
+            del self._records[key]
+            return None
+        self._records.move_to_end(key)
+        return record
+
+    def _put(self, key: StorageKey, state: str | None, data: dict[str, Any]):
+        # пустая запись ничего не хранит — удаляем, чтобы завершённые диалоги не занимали память
+        if state is None and not data:
+            self._records.pop(key, None)
+            return
+        self._records[key] = _Record(state, data, time.monotonic() + self.ttl)
+        self._records.move_to_end(key)
+        while len(self._records) > self.max_size:
+            self._records.popitem(last=False)
+
+    async def set_state(self, key: StorageKey, state: StateType = None):
+        record = self._get(key)
+        self._put(key, _state_name(state), record.data if record else {})
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        record = self._get(key)
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]):
+        _check_data(data)
+        record = self._get(key)
+        self._put(key, record.state if record else None, data.copy())
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        record = self._get(key)
+        return record.data.copy() if record else {}
+
+
+class SQLiteStorage(BaseStorage):
+    """Состояния в таблице fsm_states общей базы — видны всем процессам бота."""
+
+    def __init__(self, ttl: float = 3600):
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+
+    async def close(self):
+        pass
+
+    async def purge_expired(self) -> int:
+        return await purge_fsm_records(time.time())
+
+    async def _get(self, key: str) -> tuple[str | None, dict[str, Any]]:
+        row = await get_fsm_record(key)
+        if row is None or row["expires_at"] <= time.time():
+            return None, {}
+        return row["state"], json.loads(row["data"])
+
+    async def _put(self, key: str, state: str | None, data: dict[str, Any]):
+        if state is None and not data:
+            await delete_fsm_record(key)
+        else:
+            await save_fsm_record(key, state, json.dumps(data, ensure_ascii=False), time.time() + self.ttl)
+
+    async def set_state(self, key: StorageKey, state: StateType = None):
+        storage_key = self.key_builder.build(key)
+        _, data = await self._get(storage_key)
+        await self._put(storage_key, _state_name(state), data)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        state, _ = await self._get(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]):
+        _check_data(data)
+        storage_key = self.key_builder.build(key)
+        state, _ = await self._get(storage_key)
+        await self._put(storage_key, state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        _, data = await self._get(self.key_builder.build(key))
+        return data
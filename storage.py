@@ -0,0 +1,346 @@
+"""Данные пользователей за одним интерфейсом Storage: пользователи, логи, задачи, ачивки, статистика.
+
+Хендлеры получают хранилище из данных диспетчера (dispatcher["storage"]) и не
+знают, где лежат данные. SQLiteStore — обычная работа через db.py: пул
+соединений, очередь записи логов, агрегаты и метрики запросов. MemoryStore
+держит всё в словарях по user_id и нужен для бенчмарков и быстрых проверок:
+данные живут до остановки процесса. Таймеры, FSM, кэш медиа и графиков
+и рассылки работают с SQLite при любом хранилище.
+"""
+import bisect
+import itertools
+from datetime import datetime
+from typing import Any, Callable, Protocol
+
+import db
+from achievements import COUNTER_UPDATES, RULES, Rule
+from paging import Page, decode_cursor
+from rollups import LOG_TABLES
+from search import MAX_MATCHES, query_words, rank_page, score
+from timeutil import local_day
+
+
+class Storage(Protocol):
+    async def add_user_if_not_exists(self, user_id: int): ...
+
+    async def get_reminder_settings(self, user_id: int): ...
+
+    async def set_reminders(self, user_id: int, enabled: bool): ...
+
+    async def set_quiet_hours(self, user_id: int, quiet_from: int, quiet_to: int): ...
+
+    async def add_water(self, user_id: int, amount: int): ...
+
+    async def add_sleep(self, user_id: int, hours: float): ...
+
+    async def add_steps(self, user_id: int, steps: int): ...
+
+    async def log_mood(self, user_id: int, score: int): ...
+
+    async def get_stats(self, user_id: int, metric: str) -> tuple[float, int] | None: ...
+
+    async def get_mood_stats(self, user_id: int) -> tuple[float, int] | None: ...
+
+    async def get_daily_rollups(self, user_id: int, first_day: str, last_day: str) -> list: ...
+
+    async def add_task(self, user_id: int, title: str): ...
+
+    async def list_tasks(
+        self, user_id: int, done: bool | None = None, cursor: str | None = None, newer: bool = False, limit: int = 10
+    ) -> Page: ...
+
+    async def search_tasks(self, user_id: int, query: str, offset: int = 0, limit: int = 10) -> Page: ...
+
+    async def complete_task(self, user_id: int, task_id: int) -> list[Rule] | None: ...
+
+    async def record_progress(self, user_id: int, event: str, value: float) -> list[Rule]: ...
+
+    async def list_achievements(
+        self, user_id: int, cursor: str | None = None, newer: bool = False, limit: int = 10
+    ) -> Page: ...
+
+    async def export_rows(
+        self, table: str, columns: tuple[str, ...], key: tuple[str, ...], user_id: int, after: tuple | None, limit: int
+    ) -> list: ...
+
+
+class SQLiteStore:
+    """Хранилище в SQLite: соединения открывает open_db при старте бота."""
+
+    add_user_if_not_exists = staticmethod(db.add_user_if_not_exists)
+    get_reminder_settings = staticmethod(db.get_reminder_settings)
+    set_reminders = staticmethod(db.set_reminders)
+    set_quiet_hours = staticmethod(db.set_quiet_hours)
+    add_water = staticmethod(db.add_water)
+    add_sleep = staticmethod(db.add_sleep)
+    add_steps = staticmethod(db.add_steps)
+    log_mood = staticmethod(db.log_mood)
+    get_stats = staticmethod(db.get_stats)
+    get_mood_stats = staticmethod(db.get_mood_stats)
+    get_daily_rollups = staticmethod(db.get_daily_rollups)
+    add_task = staticmethod(db.add_task)
+    list_tasks = staticmethod(db.list_tasks)
+    search_tasks = staticmethod(db.search_tasks)
+    complete_task = staticmethod(db.complete_task)
+    record_progress = staticmethod(db.record_progress)
+    list_achievements = staticmethod(db.list_achievements)
+    export_rows = staticmethod(db.export_rows)
+
+
+_COUNTER_OPS = {
+    "sum": lambda old, value: old + value,
+    "max": max,
+}
+
+
+class _UserData:
+    __slots__ = (
+        "settings", "logs", "log_keys", "stats", "days", "day_keys", "tasks", "task_keys", "task_keys_by_done",
+        "task_ids", "achievements", "achievement_keys", "counters",
+    )
+
+    def __init__(self):
+        # None — пользователь ещё не заведён (логи без строки в users SQLite тоже принимает)
+        self.settings: dict[str, int] | None = None
+        # значение лога по ключу (created_at, id); ключи по возрастанию — для порций выгрузки через bisect
+        self.logs: dict[str, dict[tuple[str, int], float]] = {kind: {} for kind in LOG_TABLES}
+        self.log_keys: dict[str, list[tuple[str, int]]] = {kind: [] for kind in LOG_TABLES}
+        self.stats: dict[str, list] = {}
+        # день -> строка в формате daily_rollups; дни по возрастанию
+        self.days: dict[str, dict[str, Any]] = {}
+        self.day_keys: list[str] = []
+        # строки по ключу (created_at, id); ключи по возрастанию — для keyset-страниц через bisect
+        self.tasks: dict[tuple[str, int], dict[str, Any]] = {}
+        self.task_keys: list[tuple[str, int]] = []
+        # те же ключи отдельно для невыполненных (0) и выполненных (1): фильтр не перебирает чужой статус
+        self.task_keys_by_done: dict[int, list[tuple[str, int]]] = {0: [], 1: []}
+        self.task_ids: dict[int, tuple[str, int]] = {}
+        self.achievements: dict[tuple[str, int], dict[str, Any]] = {}
+        self.achievement_keys: list[tuple[str, int]] = []
+        self.counters: dict[str, float] = {}
+
+
+def _insert_sorted(keys: list, key):
+    # записи почти всегда новее всех прежних — тогда это обычный append
+    if not keys or keys[-1] < key:
+        keys.append(key)
+    else:
+        bisect.insort(keys, key)
+
+
+# таблица логов -> (вид лога, колонка значения)
+_LOG_BY_TABLE = {table: (kind, column) for kind, (table, column) in LOG_TABLES.items()}
+
+
+def _export_source(data: _UserData, table: str) -> tuple[list, Callable[[Any], dict[str, Any]]]:
+    # уже упорядоченные ключи таблицы (created_at, id) или day и строка по ключу
+    if table == "tasks":
+        return data.task_keys, data.tasks.__getitem__
+    if table == "achievements":
+        return data.achievement_keys, data.achievements.__getitem__
+    if table == "daily_rollups":
+        return data.day_keys, data.days.__getitem__
+    kind, column = _LOG_BY_TABLE[table]
+    values = data.logs[kind]
+    return data.log_keys[kind], lambda key: {"id": key[1], column: values[key], "created_at": key[0]}
+
+
+def _keyset_page(keys: list, rows: dict, cursor: str | None, newer: bool, limit: int) -> Page:
+    # та же семантика, что у db._keyset_page: от новых к старым, newer=True — шаг к записям новее курсора
+    if cursor is None:
+        newer = False
+        candidates = reversed(keys)
+    else:
+        key = decode_cursor(cursor)
+        if newer:
+            candidates = itertools.islice(keys, bisect.bisect_right(keys, key), None)
+        else:
+            candidates = reversed(keys[:bisect.bisect_left(keys, key)])
+    found = [rows[key] for key in itertools.islice(candidates, limit + 1)]
+    more = len(found) > limit
+    found = found[:limit]
+    if newer:
+        found.reverse()
+        return Page(found, has_newer=more, has_older=True)
+    return Page(found, has_newer=cursor is not None, has_older=more)
+
+
+class MemoryStore:
+    """Хранилище в памяти процесса: всё разложено по user_id, запросы не сканируют чужие данные."""
+
+    def __init__(self):
+        self._users: dict[int, _UserData] = {}
+        self._ids = {table: itertools.count(1) for table in ("tasks", "achievements", *LOG_TABLES)}
+
+    def _user(self, user_id: int) -> _UserData:
+        data = self._users.get(user_id)
+        if data is None:
+            data = self._users[user_id] = _UserData()
+        return data
+
+    async def add_user_if_not_exists(self, user_id: int):
+        data = self._user(user_id)
+        if data.settings is None:
+            data.settings = {"reminders": 1, "quiet_from": 22, "quiet_to": 8}
+
+    async def get_reminder_settings(self, user_id: int):
+        data = self._users.get(user_id)
+        return dict(data.settings) if data is not None and data.settings is not None else None
+
+    async def set_reminders(self, user_id: int, enabled: bool):
+        data = self._users.get(user_id)
+        if data is not None and data.settings is not None:
+            data.settings["reminders"] = int(enabled)
+
+    async def set_quiet_hours(self, user_id: int, quiet_from: int, quiet_to: int):
+        data = self._users.get(user_id)
+        if data is not None and data.settings is not None:
+            data.settings.update(quiet_from=quiet_from, quiet_to=quiet_to)
+
+    def add_log(self, kind: str, user_id: int, value: float, created_at: str | None = None):
+        """Пишет лог и сразу обновляет агрегаты; created_at задают только при заполнении тестовыми данными."""
+        created_at = created_at or datetime.utcnow().isoformat()
+        data = self._user(user_id)
+        key = (created_at, next(self._ids[kind]))
+        data.logs[kind][key] = value
+        _insert_sorted(data.log_keys[kind], key)
+        stats = data.stats.setdefault(kind, [0, 0])
+        stats[0] += value
+        stats[1] += 1
+        day = local_day(created_at)
+        row = data.days.get(day)
+        if row is None:
+            row = data.days[day] = {"user_id": user_id, "day": day}
+            _insert_sorted(data.day_keys, day)
+            for name in LOG_TABLES:
+                row[f"{name}_sum"] = 0
+                row[f"{name}_count"] = 0
+        row[f"{kind}_sum"] += value
+        row[f"{kind}_count"] += 1
+
+    async def add_water(self, user_id: int, amount: int):
+        self.add_log("water", user_id, amount)
+
+    async def add_sleep(self, user_id: int, hours: float):
+        self.add_log("sleep", user_id, hours)
+
+    async def add_steps(self, user_id: int, steps: int):
+        self.add_log("steps", user_id, steps)
+
+    async def log_mood(self, user_id: int, score: int):
+        self.add_log("mood", user_id, score)
+
+    async def get_stats(self, user_id: int, metric: str) -> tuple[float, int] | None:
+        data = self._users.get(user_id)
+        stats = data.stats.get(metric) if data is not None else None
+        if stats and stats[1]:
+            return float(stats[0]), int(stats[1])
+        return None
+
+    async def get_mood_stats(self, user_id: int) -> tuple[float, int] | None:
+        stats = await self.get_stats(user_id, "mood")
+        if stats:
+            total, count = stats
+            return total / count, count
+        return None
+
+    async def get_daily_rollups(self, user_id: int, first_day: str, last_day: str) -> list:
+        data = self._users.get(user_id)
+        if data is None:
+            return []
+        keys = data.day_keys
+        first, last = bisect.bisect_left(keys, first_day), bisect.bisect_right(keys, last_day)
+        return [data.days[day] for day in keys[first:last]]
+
+    async def add_task(self, user_id: int, title: str, created_at: str | None = None):
+        data = self._user(user_id)
+        task_id = next(self._ids["tasks"])
+        created_at = created_at or datetime.utcnow().isoformat()
+        key = (created_at, task_id)
+        data.tasks[key] = {"id": task_id, "title": title, "done": 0, "created_at": created_at}
+        data.task_ids[task_id] = key
+        _insert_sorted(data.task_keys, key)
+        _insert_sorted(data.task_keys_by_done[0], key)
+
+    async def list_tasks(
+        self, user_id: int, done: bool | None = None, cursor: str | None = None, newer: bool = False, limit: int = 10
+    ) -> Page:
+        data = self._users.get(user_id) or _UserData()
+        keys = data.task_keys if done is None else data.task_keys_by_done[int(done)]
+        return _keyset_page(keys, data.tasks, cursor, newer, limit)
+
+    async def search_tasks(self, user_id: int, query: str, offset: int = 0, limit: int = 10) -> Page:
+        wanted = query_words(query)
+        data = self._users.get(user_id)
+        if not wanted or data is None:
+            return Page([], has_newer=False, has_older=False)
+        # как в SQLite: ранжируются MAX_MATCHES самых новых совпадений (task_ids заполняется по возрастанию id)
+        tasks = (data.tasks[data.task_ids[task_id]] for task_id in reversed(data.task_ids))
+        found = itertools.islice((task for task in tasks if score(wanted, task["title"])), MAX_MATCHES)
+        return rank_page(wanted, list(found), offset, limit)
+
+    async def complete_task(self, user_id: int, task_id: int) -> list[Rule] | None:
+        data = self._users.get(user_id)
+        key = data.task_ids.get(task_id) if data is not None else None
+        if key is None:
+            return None
+        task = data.tasks[key]
+        if task["done"]:
+            return []
+        task["done"] = 1
+        undone = data.task_keys_by_done[0]
+        del undone[bisect.bisect_left(undone, key)]
+        _insert_sorted(data.task_keys_by_done[1], key)
+        return self._apply_event(data, "task_done", 1)
+
+    async def record_progress(self, user_id: int, event: str, value: float) -> list[Rule]:
+        return self._apply_event(self._user(user_id), event, value)
+
+    def _apply_event(self, data: _UserData, event: str, value: float) -> list[Rule]:
+        # как achievements.apply_event: счётчики события, затем правила, которые впервые выполнились
+        awarded = []
+        owned = {row["rule"] for row in data.achievements.values()}
+        for counter, op in COUNTER_UPDATES.get(event, ()):
+            old = data.counters.get(counter)
+            total = data.counters[counter] = value if old is None else _COUNTER_OPS[op](old, value)
+            for rule in RULES:
+                if rule.counter != counter or total < rule.threshold or rule.id in owned:
+                    continue
+                achievement_id = next(self._ids["achievements"])
+                created_at = datetime.utcnow().isoformat()
+                key = (created_at, achievement_id)
+                data.achievements[key] = {
+                    "id": achievement_id, "rule": rule.id, "title": rule.title, "created_at": created_at,
+                }
+                _insert_sorted(data.achievement_keys, key)
+                owned.add(rule.id)
+                awarded.append(rule)
+        return awarded
+
+    async def list_achievements(
+        self, user_id: int, cursor: str | None = None, newer: bool = False, limit: int = 10
+    ) -> Page:
+        data = self._users.get(user_id) or _UserData()
+        return _keyset_page(data.achievement_keys, data.achievements, cursor, newer, limit)
+
+    async def export_rows(
+        self, table: str, columns: tuple[str, ...], key: tuple[str, ...], user_id: int, after: tuple | None, limit: int
+    ) -> list:
+        # та же порция, что у db.export_rows: строки таблицы по ключу key строго после after
+        data = self._users.get(user_id)
+        if data is None:
+            return []
+        keys, row_of = _export_source(data, table)
+        start = 0
+        if after is not None:
+            # ключи дней хранятся строкой, остальные — кортежем (created_at, id)
+            start = bisect.bisect_right(keys, after[0] if table == "daily_rollups" else tuple(after))
+        return [tuple(row[column] for column in columns) for row in map(row_of, keys[start:start + limit])]
+
+
+def create_storage(kind: str) -> Storage:
+    if kind == "memory":
+        return MemoryStore()
+    if kind == "sqlite":
+        return SQLiteStore()
+    raise ValueError(f"Неизвестное хранилище {kind!r}: ожидается sqlite или memory")
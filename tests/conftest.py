@@ -0,0 +1,160 @@
+"""Общие фикстуры: бот с заглушкой сессии поверх настоящего диспетчера из main."""
+import asyncio
+import datetime as dt
+import inspect
+import itertools
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.types import CallbackQuery, Chat, InaccessibleMessage, Message, PhotoSize, Update, User
+
+from metrics import METRICS
+
+
+class StubSession(BaseSession):
+    """Сессия без сети: запоминает вызовы API и отвечает правдоподобными объектами."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+        # имя метода API → исключение, которое он бросит вместо ответа
+        self.errors: dict[str, Exception] = {}
+        self._ids = itertools.count(1000)
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls.append(method)
+        if type(method).__name__ in self.errors:
+            raise self.errors[type(method).__name__]
+        if method.__returning__ is bool:
+            return True
+        extra = {}
+        if type(method).__name__ == "SendPhoto":
+            extra["photo"] = [PhotoSize(file_id=f"photo{next(self._ids)}", file_unique_id="u", width=1, height=1)]
+        return Message(
+            message_id=next(self._ids),
+            date=dt.datetime.now(),
+            chat=Chat(id=getattr(method, "chat_id", None) or 1, type="private"),
+            text=getattr(method, "text", None),
+            **extra,
+        )
+
+    def texts(self, since: int = 0) -> list[str]:
+        return [text for call in self.calls[since:] if (text := getattr(call, "text", None))]
+
+
+class BotEnv:
+    """Подаёт синтетические обновления в main.dp и запоминает, какой хендлер их обработал."""
+
+    def __init__(self, main, loop: asyncio.AbstractEventLoop):
+        self.main = main
+        self.loop = loop
+        self.session = StubSession()
+        self.bot = Bot("123:abc", session=self.session)
+        self.handled: list[str] = []
+        self._ids = itertools.count(1)
+        METRICS.listeners.append(lambda update_type, record, elapsed: self.handled.append(record.handler))
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def _feed(self, update: Update) -> str | None:
+        before = len(self.handled)
+        self.run(self.main.dp.feed_update(self.bot, update))
+        return self.handled[before] if len(self.handled) > before else None
+
+    def message(self, user_id: int, text: str) -> str | None:
+        """Отправить текст от пользователя; возвращает имя сработавшего хендлера или None."""
+        user = User(id=user_id, is_bot=False, first_name="u")
+        chat = Chat(id=user_id, type="private")
+        message = Message(message_id=next(self._ids), date=dt.datetime.now(), chat=chat, from_user=user, text=text)
+        return self._feed(Update(update_id=next(self._ids), message=message))
+
+    def callback(self, user_id: int, data: str, accessible: bool = True) -> str | None:
+        """Нажать инлайн-кнопку под сообщением бота; accessible=False — сообщение старше 48 часов."""
+        chat = Chat(id=user_id, type="private")
+        if accessible:
+            bot_user = User(id=1, is_bot=True, first_name="bot")
+            message = Message(message_id=next(self._ids), date=dt.datetime.now(), chat=chat, from_user=bot_user, text="…")
+        else:
+            message = InaccessibleMessage(chat=chat, message_id=next(self._ids))
+        query = CallbackQuery(
+            id=str(next(self._ids)),
+            from_user=User(id=user_id, is_bot=False, first_name="u"),
+            chat_instance="test",
+            message=message,
+            data=data,
+        )
+        return self._feed(Update(update_id=next(self._ids), callback_query=query))
+
+    @property
+    def storage(self):
+        return self.main.dp["storage"]
+
+    def state(self, user_id: int) -> str | None:
+        context = self.main.dp.fsm.get_context(self.bot, chat_id=user_id, user_id=user_id)
+        return self.run(context.get_state())
+
+    def set_state(self, user_id: int, state: str | None):
+        """Поставить пользователю вопрос бота напрямую, минуя кнопку, которая его задаёт."""
+        context = self.main.dp.fsm.get_context(self.bot, chat_id=user_id, user_id=user_id)
+        self.run(context.set_state(state))
+
+
+@pytest.fixture(scope="session")
+def bot_env(tmp_path_factory):
+    # main читает настройки при импорте и хранит базу и картинки по относительным путям
+    workdir = tmp_path_factory.mktemp("bot")
+    (workdir / "photos").mkdir()
+    (workdir / "photos" / "бот.jpg").write_bytes(b"\xff\xd8jpeg")
+    os.chdir(workdir)
+    os.environ.update({
+        "BOT_TOKEN": "123:abc",
+        "BROADCASTS_ENABLED": "0",
+        "RETENTION_DAYS": "0",
+        "FLOOD_RATE": "0",
+        "FLOOD_DUPLICATE_MS": "0",
+        "METRICS_PORT": "0",
+    })
+    import main
+
+    loop = asyncio.new_event_loop()
+    env = BotEnv(main, loop)
+    env.run(main.dp.emit_startup(bot=env.bot, dispatcher=main.dp, bots=[env.bot]))
+    yield env
+    # иначе потоки aiosqlite не дадут процессу завершиться
+    env.run(main.dp.emit_shutdown(bot=env.bot, dispatcher=main.dp))
+    loop.close()
+    os.chdir(ROOT)
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    # async-тесты выполняются в цикле событий бота, где открыта база
+    if not inspect.iscoroutinefunction(pyfuncitem.obj):
+        return None
+    env = pyfuncitem.funcargs["bot_env"]
+    env.run(pyfuncitem.obj(**{name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}))
+    return True
+
+
+@pytest.fixture
+def user_id():
+    # у каждого теста свой пользователь: FSM-состояния и данные не пересекаются
+    return next(_user_ids)
+
+
+_user_ids = itertools.count(10_000)
@@ -0,0 +1,63 @@
+"""Рассылки: аренда диапазона не истекает посреди порции, а прогресс не зависит от числа воркеров."""
+import asyncio
+
+from aiogram import Bot
+
+import db
+from broadcast import BroadcastEngine, Reminder
+from conftest import StubSession
+
+
+class SlowSession(StubSession):
+    async def make_request(self, bot, method, timeout=None):
+        await asyncio.sleep(0.5)
+        return await super().make_request(bot, method, timeout)
+
+
+async def _only_recipients(user_ids: list[int]):
+    # в общей тестовой базе есть пользователи других тестов: напоминания получают только эти
+    for user_id in user_ids:
+        await db.add_user_if_not_exists(user_id)
+        await db.set_quiet_hours(user_id, 0, 0)
+    async with db._db().write() as conn:
+        await conn.execute(
+            f"UPDATE users SET reminders = user_id IN ({', '.join('?' * len(user_ids))})", user_ids
+        )
+
+
+def _chat_ids(*sessions: StubSession) -> list[int]:
+    return sorted(call.chat_id for session in sessions for call in session.calls)
+
+
+async def test_lease_is_renewed_during_long_chunk(bot_env):
+    await _only_recipients([7_000_001])
+    session = SlowSession()
+    engine = BroadcastEngine(Bot("123:abc", session=session), lease_seconds=0.3, ranges=1)
+    reminder = Reminder("lease", 0, "Проверка аренды")
+    job = asyncio.create_task(engine.run_job(reminder, "2026-01-01"))
+    await asyncio.sleep(0.4)
+    # отправка ещё идёт, а аренда уже продлена: второй процесс диапазон не заберёт
+    assert await db.claim_broadcast("lease", "2026-01-01", 0) is None
+    await job
+    assert _chat_ids(session) == [7_000_001]
+    assert engine.progress["lease:2026-01-01:0"]["done"]
+
+
+async def test_worker_count_change_does_not_resend(bot_env):
+    users = [7_000_101 + i for i in range(6)]
+    await _only_recipients(users)
+    reminder = Reminder("workers", 0, "Проверка диапазонов")
+    # воркер взял первый диапазон, отправил одному пользователю и упал: аренда истекла
+    part = await db.claim_broadcast("workers", "2026-01-02", 0, ranges=3)
+    await db.mark_delivered(part["job_id"], users[0])
+    await db.advance_broadcast(part["id"], users[0], 1, 0, 0)
+    # задание продолжают два воркера с другими настройками: границы диапазонов уже сохранены
+    sessions = [StubSession(), StubSession()]
+    engines = [BroadcastEngine(Bot("123:abc", session=session), chunk_size=1, ranges=5) for session in sessions]
+    await asyncio.gather(*(engine.run_job(reminder, "2026-01-02") for engine in engines))
+    assert _chat_ids(*sessions) == users[1:]
+    # перезапуск с одним воркером в тот же день ничего не отправляет повторно
+    session = StubSession()
+    await BroadcastEngine(Bot("123:abc", session=session)).run_job(reminder, "2026-01-02")
+    assert session.calls == []
+    assert await db.claim_broadcast("workers", "2026-01-02", 0) is None
@@ -0,0 +1,23 @@
+"""Закрытие пула, когда базу держит другой процесс."""
+import aiosqlite
+
+import db_pool
+
+
+async def test_close_survives_locked_database(bot_env, tmp_path, monkeypatch):
+    pool = db_pool.ConnectionPool(str(tmp_path / "pool.db"), readers=1)
+    await pool.open()
+    writer = pool._writer
+    execute = writer.execute
+
+    def locked(sql, *args):
+        # так отвечает SQLite, когда соседний воркер пишет дольше busy_timeout
+        if sql == "PRAGMA optimize":
+            raise aiosqlite.OperationalError("database is locked")
+        return execute(sql, *args)
+
+    monkeypatch.setattr(writer, "execute", locked)
+    await pool.close()
+    assert pool._writer is None
+    # соединение закрыто и его поток остановлен: иначе процесс воркера не смог бы выйти
+    assert writer._connection is None
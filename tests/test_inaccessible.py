@@ -0,0 +1,32 @@
+"""Кнопки под сообщениями старше 48 часов: Telegram не отдаёт само сообщение, ответ приходит новым."""
+
+
+def _sent(bot_env, since: int, method: str) -> list:
+    return [call for call in bot_env.session.calls[since:] if type(call).__name__ == method]
+
+
+def test_chart_button_sends_photo_to_user(bot_env, user_id):
+    bot_env.run(bot_env.storage.log_mood(user_id, 3))
+    since = len(bot_env.session.calls)
+    assert bot_env.callback(user_id, "chart:mood:7", accessible=False) == "chart_cb"
+    assert [call.chat_id for call in _sent(bot_env, since, "SendPhoto")] == [user_id]
+
+
+def test_task_list_page_is_sent_anew(bot_env, user_id):
+    bot_env.run(bot_env.storage.add_task(user_id, "Дочитать главу"))
+    since = len(bot_env.session.calls)
+    assert bot_env.callback(user_id, "tasks:a", accessible=False) == "tasks_page_cb"
+    sent = _sent(bot_env, since, "SendMessage")
+    assert [call.chat_id for call in sent] == [user_id]
+    assert "Дочитать главу" in sent[0].text
+
+
+def test_find_page_is_sent_anew(bot_env, user_id):
+    for i in range(12):
+        bot_env.run(bot_env.storage.add_task(user_id, f"Английский урок {i}"))
+    assert bot_env.message(user_id, "/find английский") == "find_cmd"
+    since = len(bot_env.session.calls)
+    assert bot_env.callback(user_id, "find:10", accessible=False) == "find_page_cb"
+    sent = _sent(bot_env, since, "SendMessage")
+    assert [call.chat_id for call in sent] == [user_id]
+    assert "Английский урок" in sent[0].text
@@ -0,0 +1,65 @@
+"""Повторная загрузка файла только тогда, когда Telegram отверг сохранённый file_id."""
+import datetime as dt
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import SendPhoto
+from aiogram.types import Chat, Message
+
+from media_cache import MediaCache
+
+
+def _bad_request(text: str) -> TelegramBadRequest:
+    return TelegramBadRequest(method=SendPhoto(chat_id=1, photo="x"), message=f"Bad Request: {text}")
+
+
+def _message(bot_env, user_id: int) -> Message:
+    chat = Chat(id=user_id, type="private")
+    return Message(message_id=1, date=dt.datetime.now(), chat=chat, text="…").as_(bot_env.bot)
+
+
+def _sent_photos(bot_env, since: int) -> list:
+    return [call.photo for call in bot_env.session.calls[since:] if isinstance(call, SendPhoto)]
+
+
+@pytest.fixture
+def photo(tmp_path):
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(b"\xff\xd8jpeg")
+    return str(path)
+
+
+async def test_stale_file_id_is_uploaded_again(bot_env, user_id, photo):
+    cache = MediaCache()
+    message = _message(bot_env, user_id)
+    await cache.answer_photo(message, photo)
+    bot_env.session.errors["SendPhoto"] = _bad_request("wrong file identifier/HTTP URL specified")
+    since = len(bot_env.session.calls)
+    try:
+        with pytest.raises(TelegramBadRequest):
+            # загрузка тоже падает — важно, что до неё дошло
+            await cache.answer_photo(message, photo)
+    finally:
+        del bot_env.session.errors["SendPhoto"]
+    file_id, upload = _sent_photos(bot_env, since)
+    assert isinstance(file_id, str)
+    assert not isinstance(upload, str)
+
+
+async def test_other_bad_request_is_raised(bot_env, user_id, photo):
+    cache = MediaCache()
+    message = _message(bot_env, user_id)
+    await cache.answer_photo(message, photo)
+    bot_env.session.errors["SendPhoto"] = _bad_request("can't parse entities")
+    since = len(bot_env.session.calls)
+    try:
+        with pytest.raises(TelegramBadRequest, match="parse entities"):
+            await cache.answer_photo(message, photo, caption="<b>", parse_mode="HTML")
+    finally:
+        del bot_env.session.errors["SendPhoto"]
+    [file_id] = _sent_photos(bot_env, since)
+    assert isinstance(file_id, str)
+    # file_id не сброшен: следующая отправка снова обходится без загрузки
+    since = len(bot_env.session.calls)
+    await cache.answer_photo(message, photo)
+    assert _sent_photos(bot_env, since) == [file_id]
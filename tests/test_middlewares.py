@@ -0,0 +1,32 @@
+"""Защита от флуда: отброшенные обновления не доходят до хендлера и попадают в метрики."""
+import datetime as dt
+
+from aiogram.types import Chat, Message, Update, User
+
+from metrics import METRICS
+from middlewares import FloodControlMiddleware
+
+
+def update(user: User, text: str, update_id: int) -> Update:
+    message = Message(
+        message_id=update_id, date=dt.datetime.now(), chat=Chat(id=user.id, type="private"), from_user=user, text=text
+    )
+    return Update(update_id=update_id, message=message)
+
+
+async def test_dropped_updates_are_counted(bot_env):
+    middleware = FloodControlMiddleware(rate=1, burst=2, duplicate_window=1)
+    user = User(id=42, is_bot=False, first_name="u")
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event.message.text)
+
+    before = dict(METRICS.suppressed)
+    for n, text in enumerate(["💧 Записать воду", "💧 Записать воду", "250", "300"]):
+        await middleware(handler, update(user, text, n), {"event_from_user": user})
+    # повтор кнопки схлопнут, а на четвёртое обновление в ту же секунду не хватило токенов
+    assert handled == ["💧 Записать воду", "250"]
+    assert METRICS.suppressed["duplicate"] - before.get("duplicate", 0) == 1
+    assert METRICS.suppressed["rate"] - before.get("rate", 0) == 1
+    assert "bot_updates_suppressed_total{reason=\"rate\"}" in METRICS.render()
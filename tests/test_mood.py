@@ -0,0 +1,37 @@
+"""Отметка настроения: запись и правка сообщения ждут друг друга, ошибка правки не теряет отметку."""
+import pytest
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import EditMessageText
+
+
+def _fail_edit(bot_env, reason: str):
+    bot_env.session.errors["EditMessageText"] = TelegramBadRequest(EditMessageText(text="…"), f"Bad Request: {reason}")
+
+
+def test_unchanged_message_still_records_and_reports(bot_env, user_id):
+    _fail_edit(bot_env, "message is not modified")
+    try:
+        since = len(bot_env.session.calls)
+        assert bot_env.callback(user_id, "mood_4") == "mood_chosen"
+    finally:
+        del bot_env.session.errors["EditMessageText"]
+    assert bot_env.run(bot_env.storage.get_mood_stats(user_id)) == (4.0, 1)
+    assert any(text.startswith("В твоём дневнике уже 1 отметок") for text in bot_env.session.texts(since))
+
+
+def test_edit_error_reaches_caller_after_mood_is_saved(bot_env, user_id):
+    _fail_edit(bot_env, "message can't be edited")
+    try:
+        with pytest.raises(TelegramBadRequest, match="can't be edited"):
+            bot_env.callback(user_id, "mood_2")
+    finally:
+        del bot_env.session.errors["EditMessageText"]
+    assert bot_env.run(bot_env.storage.get_mood_stats(user_id)) == (2.0, 1)
+
+
+def test_inaccessible_message_gets_new_reply(bot_env, user_id):
+    since = len(bot_env.session.calls)
+    assert bot_env.callback(user_id, "mood_5", accessible=False) == "mood_chosen"
+    sent = [call for call in bot_env.session.calls[since:] if type(call).__name__ == "SendMessage"]
+    assert {call.chat_id for call in sent} == {user_id}
+    assert any(call.text.startswith("Записал твой настрой") for call in sent)
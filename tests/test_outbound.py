@@ -0,0 +1,90 @@
+"""Повторы исходящих вызовов: новые сообщения не дублируются, счётчики попадают в /metrics."""
+from types import SimpleNamespace
+
+import pytest
+from aiohttp import ClientConnectorError, ServerDisconnectedError
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.methods import EditMessageText, SendMessage
+
+from metrics import METRICS
+from outbound import OutboundThrottle
+
+
+def flaky(error, failures: int = 1):
+    """make_request, который первые failures раз падает ошибкой error()."""
+    calls = []
+
+    async def make_request(bot, method):
+        calls.append(method)
+        if len(calls) <= failures:
+            raise error(method)
+        return True
+
+    return make_request, calls
+
+
+def network(cause: Exception):
+    def error(method):
+        # как у aiogram: исходная ошибка aiohttp остаётся в __context__
+        e = TelegramNetworkError(method=method, message=type(cause).__name__)
+        e.__context__ = cause
+        return e
+    return error
+
+
+def server(method):
+    return TelegramServerError(method=method, message="Bad Gateway")
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    async def sleep(delay):
+        pass
+    monkeypatch.setattr("outbound.asyncio.sleep", sleep)
+
+
+async def test_send_is_not_retried_after_request_may_have_arrived(bot_env):
+    make_request, calls = flaky(network(ServerDisconnectedError()))
+    with pytest.raises(TelegramNetworkError):
+        await OutboundThrottle()(make_request, bot_env.bot, SendMessage(chat_id=1, text="привет"))
+    assert len(calls) == 1
+
+
+async def test_send_is_retried_when_connection_failed(bot_env):
+    make_request, calls = flaky(network(ClientConnectorError.__new__(ClientConnectorError)))
+    assert await OutboundThrottle()(make_request, bot_env.bot, SendMessage(chat_id=2, text="привет"))
+    assert len(calls) == 2
+
+
+async def test_edit_is_retried_after_server_error(bot_env):
+    before = METRICS.outbound["retried"]
+    make_request, calls = flaky(server, failures=2)
+    assert await OutboundThrottle()(make_request, bot_env.bot, EditMessageText(chat_id=3, message_id=1, text="x"))
+    assert len(calls) == 3
+    assert METRICS.outbound["retried"] - before == 2
+    assert 'bot_outbound_events_total{event="retried"}' in METRICS.render()
+
+
+async def test_flood_wait_on_one_chat_delays_other_chats(bot_env, monkeypatch):
+    # часы идут только во время ожидания: так видно, сколько ждал вызов
+    now = [0.0]
+
+    async def sleep(delay):
+        now[0] += delay
+
+    monkeypatch.setattr("outbound.asyncio.sleep", sleep)
+    # подменяем модуль целиком: time.monotonic нужен и самому циклу событий
+    monkeypatch.setattr("outbound.time", SimpleNamespace(monotonic=lambda: now[0]))
+    throttle = OutboundThrottle(max_retries=0)
+
+    def flood(method):
+        return TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=5)
+
+    make_request, _ = flaky(flood)
+    with pytest.raises(TelegramRetryAfter):
+        await throttle(make_request, bot_env.bot, SendMessage(chat_id=4, text="первый"))
+    started = now[0]
+    make_request, calls = flaky(flood, failures=0)
+    assert await throttle(make_request, bot_env.bot, SendMessage(chat_id=5, text="другой чат"))
+    assert len(calls) == 1
+    assert now[0] - started >= 5
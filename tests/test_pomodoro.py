@@ -0,0 +1,32 @@
+"""Старт и перезапуск таймера Pomodoro из инлайн-кнопок."""
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import EditMessageText
+
+
+def timers(bot_env, user_id: int) -> list:
+    scheduler = bot_env.main.dp["scheduler"]
+    return [chat_id for chat_id, kind in scheduler._live.values() if chat_id == user_id and kind == "pomodoro"]
+
+
+def test_restart_with_same_text_still_acks_and_reschedules(bot_env, user_id):
+    assert bot_env.callback(user_id, "pomodoro_start") == "pomodoro_start"
+    bot_env.session.errors["EditMessageText"] = TelegramBadRequest(
+        EditMessageText(text="…"), "Bad Request: message is not modified"
+    )
+    try:
+        since = len(bot_env.session.calls)
+        assert bot_env.callback(user_id, "pomodoro_start") == "pomodoro_start"
+    finally:
+        del bot_env.session.errors["EditMessageText"]
+    assert "AnswerCallbackQuery" in [type(call).__name__ for call in bot_env.session.calls[since:]]
+    # перезапуск отменяет прежний таймер: активен ровно один
+    assert timers(bot_env, user_id) == [user_id]
+
+
+def test_start_under_inaccessible_message_sends_new_one(bot_env, user_id):
+    since = len(bot_env.session.calls)
+    assert bot_env.callback(user_id, "pomodoro_start", accessible=False) == "pomodoro_start"
+    sent = [call for call in bot_env.session.calls[since:] if type(call).__name__ == "SendMessage"]
+    assert [call.chat_id for call in sent] == [user_id]
+    assert sent[0].text.startswith("Таймер Pomodoro запущен")
+    assert timers(bot_env, user_id) == [user_id]
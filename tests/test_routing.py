@@ -0,0 +1,118 @@
+"""Какой хендлер получает текст: кнопки меню и ответы на последний вопрос бота."""
+import pytest
+
+
+def test_sleep_prompt_takes_number_that_looks_like_steps(bot_env, user_id):
+    assert bot_env.message(user_id, "😴 Сон") == "ask_sleep"
+    since = len(bot_env.session.calls)
+    # 8000 подходит под формат шагов, но бот спрашивал про сон
+    assert bot_env.message(user_id, "8000") == "save_sleep"
+    assert bot_env.session.texts(since) == ["Напиши количество часов сна числом, например: 7.5"]
+    assert bot_env.state(user_id) == "Prompt:sleep"
+    assert bot_env.message(user_id, "7,5") == "save_sleep"
+    assert bot_env.state(user_id) is None
+
+
+def test_task_number_after_task_done_prompt(bot_env, user_id):
+    assert bot_env.callback(user_id, "task_add") == "task_add"
+    assert bot_env.message(user_id, "Выучить слова") == "save_task_title"
+    [task] = bot_env.run(bot_env.storage.list_tasks(user_id)).items
+    assert bot_env.callback(user_id, "task_done") == "task_done_cb"
+    assert bot_env.state(user_id) == "Prompt:task_number"
+    since = len(bot_env.session.calls)
+    assert bot_env.message(user_id, str(task["id"])) == "mark_task_done"
+    assert bot_env.state(user_id) is None
+    assert bot_env.session.texts(since)[0].startswith(f"Задача №{task['id']} отмечена выполненной ✅")
+
+
+@pytest.mark.parametrize(
+    ("button", "asked", "answer", "saved", "reply"),
+    [
+        ("💧 Записать воду", "ask_water", "250", "save_water", "Записал 💧 250 мл"),
+        ("🚶‍♂️ Шаги/спорт", "ask_steps", "8000", "save_steps_handler", "Записал 8000 шагов"),
+    ],
+    ids=["water", "steps"],
+)
+def test_number_goes_to_pending_prompt(bot_env, user_id, button, asked, answer, saved, reply):
+    assert bot_env.message(user_id, button) == asked
+    since = len(bot_env.session.calls)
+    assert bot_env.message(user_id, answer) == saved
+    assert any(text.startswith(reply) for text in bot_env.session.texts(since))
+    assert bot_env.state(user_id) is None
+
+
+def test_menu_button_clears_pending_prompt(bot_env, user_id):
+    assert bot_env.message(user_id, "💧 Записать воду") == "ask_water"
+    assert bot_env.state(user_id) == "Prompt:water"
+    assert bot_env.message(user_id, "🧠 Душа") == "soul_menu"
+    assert bot_env.state(user_id) is None
+    # число после кнопки меню уже не считается ответом про воду
+    assert bot_env.message(user_id, "250") is None
+
+
+# ========= Матрица: каждая кнопка и каждый вопрос бота =========
+
+# текст кнопки → (хендлер, вопрос, который кнопка задаёт)
+BUTTONS = {
+    "🏃‍♂️ Тело": ("body_menu", None),
+    "🧠 Душа": ("soul_menu", None),
+    "🚀 Развитие": ("social_menu", None),
+    "⬅️ В меню": ("back_to_main", None),
+    "💧 Записать воду": ("ask_water", "Prompt:water"),
+    "😴 Сон": ("ask_sleep", "Prompt:sleep"),
+    "🚶‍♂️ Шаги/спорт": ("ask_steps", "Prompt:steps"),
+    "💡 Советы по телу": ("body_tips", None),
+    "📓 Дневник настроения": ("mood_diary", None),
+    "🆘 SOS (анти-стресс)": ("sos_menu", None),
+    "🧭 Навигатор помощи": ("help_navigator", None),
+    "⏱ Pomodoro 25 мин": ("pomodoro_menu", None),
+    "📝 Задачи на учебу": ("tasks_menu", None),
+    "🧪 Мини-тест интересов": ("test_interests", None),
+    "🗣 Софт-скиллы советы": ("soft_skills", None),
+}
+
+# вопрос бота → (хендлер ответа, ответы, после которых вопрос снят)
+PROMPTS = {
+    "Prompt:water": ("save_water", {"8000", "250"}),
+    "Prompt:sleep": ("save_sleep", {"7.5"}),
+    "Prompt:steps": ("save_steps_handler", {"8000", "250"}),
+    "Prompt:task_title": ("save_task_title", {"8000", "250", "7.5", "Выучить слова"}),
+    "Prompt:task_number": ("mark_task_done", {"8000", "250"}),
+}
+
+ANSWERS = ["8000", "250", "7.5", "Выучить слова"]
+
+
+def test_matrix_covers_every_button_and_prompt(bot_env):
+    main = bot_env.main
+    assert set(BUTTONS) == set(main.menu._buttons)
+    assert set(PROMPTS) == {state.state for state in main.Prompt.__states__}
+    keyboards = (main.main_menu_kb(), main.body_menu_kb(), main.soul_menu_kb(), main.social_menu_kb())
+    labels = {button.text for kb in keyboards for row in kb.keyboard for button in row}
+    assert labels <= set(BUTTONS)
+
+
+@pytest.mark.parametrize("current", [None, *PROMPTS])
+@pytest.mark.parametrize("button", list(BUTTONS))
+def test_button_wins_over_pending_prompt(bot_env, user_id, button, current):
+    handler, asks = BUTTONS[button]
+    bot_env.set_state(user_id, current)
+    assert bot_env.message(user_id, button) == handler
+    # незаконченный ввод сброшен; остаётся только вопрос, который задала сама кнопка
+    assert bot_env.state(user_id) == asks
+
+
+@pytest.mark.parametrize("answer", ANSWERS)
+@pytest.mark.parametrize("current", list(PROMPTS))
+def test_answer_goes_to_pending_prompt(bot_env, user_id, current, answer):
+    handler, accepted = PROMPTS[current]
+    bot_env.set_state(user_id, current)
+    assert bot_env.message(user_id, answer) == handler
+    assert bot_env.state(user_id) == (None if answer in accepted else current)
+
+
+@pytest.mark.parametrize("answer", ANSWERS)
+def test_answer_without_prompt_is_not_handled(bot_env, user_id, answer):
+    since = len(bot_env.session.calls)
+    assert bot_env.message(user_id, answer) is None
+    assert bot_env.session.calls[since:] == []
@@ -0,0 +1,58 @@
+"""Таймеры после перезапуска: прерванная отправка не повторяется."""
+import asyncio
+from datetime import timedelta
+
+from aiogram import Bot
+
+import db
+from conftest import StubSession
+from scheduler import TimerScheduler
+
+
+class HangingSession(StubSession):
+    """Запрос уходит, но ответа нет: процесс «падает», не узнав, дошло ли сообщение."""
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls.append(method)
+        await asyncio.Event().wait()
+
+
+async def _status(timer_id: int) -> str:
+    async with db._db().read() as conn:
+        cur = await conn.execute("SELECT status FROM timers WHERE id = ?", (timer_id,))
+        (status,) = await cur.fetchone()
+        await cur.close()
+    return status
+
+
+async def test_interrupted_send_is_not_repeated_after_restart(bot_env, user_id):
+    hanging = HangingSession()
+    crashed = TimerScheduler(Bot("123:abc", session=hanging))
+    await crashed.start()
+    timer_id = await crashed.schedule(user_id, user_id, "pomodoro", timedelta(0))
+    while not hanging.calls:
+        await asyncio.sleep(0.01)
+    # падение: ни цикл, ни отправка не доработали
+    for task in (crashed._task, *crashed._sending):
+        task.cancel()
+    await asyncio.gather(crashed._task, *crashed._sending, return_exceptions=True)
+    assert await _status(timer_id) == "sending"
+
+    session = StubSession()
+    restarted = TimerScheduler(Bot("123:abc", session=session))
+    await restarted.start()
+    await asyncio.sleep(0.05)
+    await restarted.stop()
+    assert [call for call in session.calls if call.chat_id == user_id] == []
+    assert await _status(timer_id) == "lost"
+
+
+async def test_due_timer_is_sent_once(bot_env, user_id):
+    session = StubSession()
+    scheduler = TimerScheduler(Bot("123:abc", session=session))
+    await scheduler.start()
+    timer_id = await scheduler.schedule(user_id, user_id, "pomodoro", timedelta(0))
+    while await _status(timer_id) != "fired":
+        await asyncio.sleep(0.01)
+    await scheduler.stop()
+    assert [call.chat_id for call in session.calls if call.chat_id == user_id] == [user_id]
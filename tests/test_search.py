@@ -0,0 +1,66 @@
+"""Дозаливка tasks_fts порциями после миграции, без пересборки всего индекса."""
+import db
+import migrations
+from db_pool import ConnectionPool
+
+USER_ID = 8_000_001
+
+
+async def _migrate(pool: ConnectionPool, monkeypatch, version: int):
+    monkeypatch.setattr(migrations, "MIGRATIONS", [m for m in migrations.MIGRATIONS if m.version <= version])
+    monkeypatch.setattr(migrations, "CURRENT_VERSION", version)
+    await migrations.migrate(pool)
+    monkeypatch.undo()
+
+
+async def _indexed(pool: ConnectionPool) -> int:
+    async with pool.read() as conn:
+        cur = await conn.execute("SELECT COUNT(*) FROM tasks_fts WHERE tasks_fts MATCH ?", (f'user_id:"{USER_ID}"',))
+        (count,) = await cur.fetchone()
+        await cur.close()
+    return count
+
+
+async def _execute(pool: ConnectionPool, sql: str, params=()):
+    async with pool.write() as conn:
+        await conn.execute(sql, params)
+
+
+async def test_backfill_indexes_old_tasks_in_batches(bot_env, tmp_path, monkeypatch):
+    pool = ConnectionPool(str(tmp_path / "search.db"), readers=1)
+    await pool.open()
+    try:
+        # задачи, созданные до появления поиска
+        await _migrate(pool, monkeypatch, 13)
+        async with pool.write() as conn:
+            await conn.executemany(
+                "INSERT INTO tasks (user_id, title) VALUES (?, ?)",
+                [(USER_ID, f"Старая задача {i}") for i in range(2500)],
+            )
+        await _migrate(pool, monkeypatch, 14)
+        # миграция только создала индекс и отметку, сами задачи ещё не проиндексированы
+        assert await _indexed(pool) == 0
+        # правки недозалитых задач не должны слать в FTS5 'delete' для строк, которых там нет
+        await _execute(pool, "DELETE FROM tasks WHERE id = 2000")
+        await _execute(pool, "UPDATE tasks SET title = 'Переименованная задача' WHERE id = 2001")
+        monkeypatch.setattr(db, "_pool", pool)
+        assert await db.backfill_search_batch(1000)
+        assert await _indexed(pool) == 1000
+        # после первой порции: новая задача идёт через триггер, а правка проиндексированной — через delete
+        await _execute(pool, "INSERT INTO tasks (user_id, title) VALUES (?, 'Новая задача')", (USER_ID,))
+        await _execute(pool, "DELETE FROM tasks WHERE id = 1")
+        assert await db.backfill_search_batch(1000)
+        assert await db.backfill_search_batch(1000)
+        assert not await db.backfill_search_batch(1000)
+        assert not await db.backfill_search_batch(1000)
+        assert await _indexed(pool) == 2499
+        async with pool.read() as conn:
+            cur = await conn.execute("SELECT key FROM meta WHERE key LIKE 'tasks_fts_backfill%'")
+            assert await cur.fetchall() == []
+            await cur.close()
+        # integrity-check бросает исключение, если индекс разошёлся с tasks
+        await _execute(pool, "INSERT INTO tasks_fts (tasks_fts, rank) VALUES ('integrity-check', 1)")
+        page = await db.search_tasks(USER_ID, "переименованная")
+        assert [task["id"] for task in page.items] == [2001]
+    finally:
+        await pool.close()
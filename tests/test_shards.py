@@ -0,0 +1,83 @@
+"""Супервизор сдвигает offset getUpdates только за подтверждёнными обновлениями."""
+import asyncio
+import queue
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import shards
+from shards import Supervisor
+
+
+def _update(update_id: int, user_id: int) -> dict:
+    return {"update_id": update_id, "message": {"message_id": update_id, "from": {"id": user_id}, "text": "…"}}
+
+
+def _supervisor() -> Supervisor:
+    supervisor = Supervisor(2)
+    # воркеров нет: очереди процессов заменяем обычными, чтобы видеть, что им раздали
+    supervisor._inboxes = [queue.Queue() for _ in range(2)]
+    return supervisor
+
+
+def _dispatched(supervisor: Supervisor) -> list[int]:
+    ids = []
+    for inbox in supervisor._inboxes:
+        while not inbox.empty():
+            ids.append(inbox.get()["update_id"])
+    return sorted(ids)
+
+
+def test_offset_waits_for_lowest_unacked(bot_env):
+    supervisor = _supervisor()
+    assert supervisor.confirmed_offset() is None
+    # 10 и 12 у шарда 1, 11 у шарда 0
+    for update_id, user_id in ((10, 1), (11, 2), (12, 3)):
+        supervisor.dispatch(_update(update_id, user_id))
+    assert supervisor.confirmed_offset() == 10
+    supervisor._ack(1, 12)
+    supervisor._ack(0, 11)
+    assert supervisor.confirmed_offset() == 10
+    supervisor._ack(1, 10)
+    assert supervisor.confirmed_offset() == 13
+
+
+async def test_poll_does_not_confirm_updates_in_flight(bot_env, monkeypatch):
+    updates = [_update(1, 1), _update(2, 2)]
+    offsets = []
+
+    async def get_updates(request: web.Request):
+        payload = await request.json()
+        offsets.append(payload.get("offset"))
+        offset = payload.get("offset") or 0
+        return web.json_response({"ok": True, "result": [raw for raw in updates if raw["update_id"] >= offset]})
+
+    async def delete_webhook(request: web.Request):
+        return web.json_response({"ok": True, "result": True})
+
+    app = web.Application()
+    app.router.add_post("/bot123:abc/getUpdates", get_updates)
+    app.router.add_post("/bot123:abc/deleteWebhook", delete_webhook)
+    server = TestServer(app)
+    await server.start_server()
+    monkeypatch.setattr(shards, "TELEGRAM_API", str(server.make_url("")).rstrip("/"))
+    supervisor = _supervisor()
+    polling = asyncio.create_task(supervisor.poll("123:abc", [], timeout=1))
+    try:
+        while supervisor._last_dispatched != 2:
+            await asyncio.sleep(0.01)
+        supervisor._ack(0, 2)
+        await asyncio.sleep(0.1)
+        # обновление 1 ещё у воркера: если супервизор сейчас упадёт, Telegram должен прислать его снова
+        assert max(offset or 0 for offset in offsets) == 1
+        supervisor._ack(1, 1)
+        while offsets[-1] != 3:
+            await asyncio.sleep(0.01)
+    finally:
+        polling.cancel()
+        await asyncio.gather(polling, return_exceptions=True)
+        await server.close()
+    # повторно полученные обновления воркерам второй раз не раздаются
+    assert _dispatched(supervisor) == [1, 2]
+    # пока обновления у воркеров, супервизор ждёт подтверждений, а не опрашивает Telegram в цикле
+    assert offsets.index(3) < 6
@@ -0,0 +1,202 @@
+"""Хранилища ведут себя одинаково: те же сценарии на MemoryStore и SQLiteStore."""
+import io
+import itertools
+import json
+
+import pytest
+
+from export import Exporter
+from paging import encode_cursor
+from rollups import day_value
+from storage import MemoryStore, SQLiteStore
+from timeutil import local_day, local_now
+
+# у каждого сценария свои пользователи, чтобы сценарии не влияли друг на друга
+_user_ids = itertools.count(9_000_001)
+
+
+@pytest.fixture(params=[MemoryStore, SQLiteStore], ids=["memory", "sqlite"])
+def storage(request, bot_env):
+    # SQLiteStore работает с временной базой, которую bot_env открыл при старте бота
+    return request.param()
+
+
+async def test_users(bot_env, storage):
+    user_id = next(_user_ids)
+    assert await storage.get_reminder_settings(user_id) is None
+    await storage.add_user_if_not_exists(user_id)
+    await storage.add_user_if_not_exists(user_id)
+    settings = await storage.get_reminder_settings(user_id)
+    assert (settings["reminders"], settings["quiet_from"], settings["quiet_to"]) == (1, 22, 8)
+    await storage.set_reminders(user_id, False)
+    await storage.set_quiet_hours(user_id, 23, 7)
+    settings = await storage.get_reminder_settings(user_id)
+    assert (settings["reminders"], settings["quiet_from"], settings["quiet_to"]) == (0, 23, 7)
+
+
+async def test_logs(bot_env, storage):
+    user_id = next(_user_ids)
+    await storage.add_user_if_not_exists(user_id)
+    assert await storage.get_stats(user_id, "water") is None
+    await storage.add_water(user_id, 250)
+    await storage.add_water(user_id, 500)
+    await storage.add_sleep(user_id, 7.5)
+    await storage.log_mood(user_id, 4)
+    await storage.log_mood(user_id, 2)
+    assert await storage.get_stats(user_id, "water") == (750.0, 2)
+    assert await storage.get_mood_stats(user_id) == (3.0, 2)
+    assert await storage.get_stats(user_id, "steps") is None
+    today = local_now().date().isoformat()
+    rows = await storage.get_daily_rollups(user_id, today, today)
+    assert [row["day"] for row in rows] == [today]
+    values = {metric: day_value(rows[0], metric) for metric in ("water", "sleep", "steps", "mood")}
+    assert values == {"water": 750, "sleep": 7.5, "steps": None, "mood": 3.0}
+    assert await storage.get_daily_rollups(user_id, "2000-01-01", "2000-01-31") == []
+
+
+async def test_tasks(bot_env, storage):
+    user_id, other_id = next(_user_ids), next(_user_ids)
+    for title in ("первая", "вторая", "третья"):
+        await storage.add_task(user_id, title)
+    await storage.add_task(other_id, "чужая")
+
+    first = await storage.list_tasks(user_id, limit=2)
+    assert [t["title"] for t in first.items] == ["третья", "вторая"]
+    assert (first.has_newer, first.has_older) == (False, True)
+    last = first.items[-1]
+    older = await storage.list_tasks(user_id, cursor=encode_cursor(last["created_at"], last["id"]), limit=2)
+    assert [t["title"] for t in older.items] == ["первая"]
+    assert (older.has_newer, older.has_older) == (True, False)
+    head = older.items[0]
+    back = await storage.list_tasks(user_id, cursor=encode_cursor(head["created_at"], head["id"]), newer=True, limit=2)
+    assert [t["title"] for t in back.items] == ["третья", "вторая"]
+    assert (back.has_newer, back.has_older) == (False, True)
+
+    task_id = older.items[0]["id"]
+    assert [rule.id for rule in await storage.complete_task(user_id, task_id)] == ["task_done_1"]
+    # повторное выполнение, чужая и несуществующая задача
+    assert await storage.complete_task(user_id, task_id) == []
+    assert await storage.complete_task(other_id, task_id) is None
+    assert await storage.complete_task(user_id, 10**9) is None
+    assert [t["title"] for t in (await storage.list_tasks(user_id, done=True)).items] == ["первая"]
+    assert [t["title"] for t in (await storage.list_tasks(user_id, done=False)).items] == ["третья", "вторая"]
+
+
+async def test_search(bot_env, storage):
+    user_id, other_id = next(_user_ids), next(_user_ids)
+    for title in ("Выучить 10 слов по английскому", "Английский", "Решить вариант по математике", "snake_case"):
+        await storage.add_task(user_id, title)
+    await storage.add_task(other_id, "английский язык")
+
+    found = await storage.search_tasks(user_id, "АНГЛ")
+    # короткое название с тем же словом релевантнее длинного
+    assert [t["title"] for t in found.items] == ["Английский", "Выучить 10 слов по английскому"]
+    assert [t["title"] for t in (await storage.search_tasks(user_id, "слов англ")).items] == [
+        "Выучить 10 слов по английскому"
+    ]
+    assert (await storage.search_tasks(user_id, "физика")).items == []
+    assert (await storage.search_tasks(user_id, "?!")).items == []
+    assert [t["title"] for t in (await storage.search_tasks(user_id, "case")).items] == ["snake_case"]
+    first = await storage.search_tasks(user_id, "англ", limit=1)
+    assert (len(first.items), first.has_newer, first.has_older) == (1, False, True)
+    second = await storage.search_tasks(user_id, "англ", offset=1, limit=1)
+    assert [t["title"] for t in second.items] == ["Выучить 10 слов по английскому"]
+    assert (second.has_newer, second.has_older) == (True, False)
+
+
+async def test_achievements(bot_env, storage):
+    user_id = next(_user_ids)
+    assert (await storage.list_achievements(user_id)).items == []
+    assert [r.id for r in await storage.record_progress(user_id, "steps", 6000)] == ["steps_5000"]
+    assert [r.id for r in await storage.record_progress(user_id, "steps", 3000)] == []
+    assert [r.id for r in await storage.record_progress(user_id, "steps", 12000)] == ["steps_10000"]
+    assert [r.id for r in await storage.record_progress(user_id, "steps", 15000)] == []
+    page = await storage.list_achievements(user_id, limit=1)
+    assert len(page.items) == 1
+    assert (page.has_newer, page.has_older) == (False, True)
+    assert len((await storage.list_achievements(user_id)).items) == 2
+
+
+async def test_export_rows(bot_env, storage):
+    user_id = next(_user_ids)
+    await storage.add_user_if_not_exists(user_id)
+    for amount in (250, 500, 300):
+        await storage.add_water(user_id, amount)
+    await storage.add_task(user_id, "первая")
+    await storage.add_task(user_id, "вторая")
+    await storage.add_water(next(_user_ids), 1000)
+
+    # порции по две строки, следующая — после ключа последней строки
+    columns, key = ("id", "amount_ml", "created_at"), ("created_at", "id")
+    first = await storage.export_rows("water_logs", columns, key, user_id, None, 2)
+    last = dict(zip(columns, first[-1]))
+    rest = await storage.export_rows("water_logs", columns, key, user_id, (last["created_at"], last["id"]), 2)
+    assert [row[1] for row in [*first, *rest]] == [250, 500, 300]
+    tasks = await storage.export_rows("tasks", ("title", "done"), ("created_at", "id"), user_id, None, 10)
+    assert [tuple(row) for row in tasks] == [("первая", 0), ("вторая", 0)]
+    today = local_now().date().isoformat()
+    days = await storage.export_rows("daily_rollups", ("day", "water_sum", "water_count"), ("day",), user_id, None, 10)
+    assert [tuple(row) for row in days] == [(today, 1050, 3)]
+    assert await storage.export_rows("mood_logs", ("id", "score"), key, user_id, None, 10) == []
+
+
+async def test_exporter_reads_through_storage(bot_env, storage):
+    user_id = next(_user_ids)
+    await storage.add_user_if_not_exists(user_id)
+    await storage.add_water(user_id, 250)
+    await storage.add_task(user_id, "выгрузка")
+    with io.BytesIO() as spool:
+        rows = await Exporter(storage)._build(spool, user_id, "json", compress=False)
+        tables = json.loads(spool.getvalue())["tables"]
+    assert rows == 3
+    assert [row["amount_ml"] for row in tables["water_logs"]] == [250]
+    assert [row["title"] for row in tables["tasks"]] == ["выгрузка"]
+    assert len(tables["daily_rollups"]) == 1
+
+
+async def test_search_ranks_newest_matches(bot_env, storage, monkeypatch):
+    # при совпадений больше MAX_MATCHES ранжируются самые новые задачи, а не самые старые
+    monkeypatch.setattr("db.MAX_MATCHES", 2)
+    monkeypatch.setattr("storage.MAX_MATCHES", 2)
+    user_id = next(_user_ids)
+    for n in range(5):
+        await storage.add_task(user_id, f"повторить тему {n}")
+    found = await storage.search_tasks(user_id, "тему")
+    assert [t["title"] for t in found.items] == ["повторить тему 4", "повторить тему 3"]
+
+
+async def _export_all(storage, table: str, columns: tuple[str, ...], key: tuple[str, ...], user_id: int) -> list:
+    # по одной строке за порцию: каждая следующая начинается от ключа предыдущей
+    exported, after = [], None
+    while rows := await storage.export_rows(table, columns, key, user_id, after, 1):
+        exported += rows
+        after = rows[-1]
+    return exported
+
+
+async def test_memory_keeps_export_and_filter_order(bot_env):
+    # тестовые данные пишутся не по порядку времени: MemoryStore держит ключи отсортированными сам
+    storage = MemoryStore()
+    user_id = next(_user_ids)
+    for created_at in ("2026-01-03T10:00:00", "2026-01-01T10:00:00", "2026-01-02T10:00:00", "2026-01-01T09:00:00"):
+        storage.add_log("water", user_id, 100, created_at)
+    logs = await _export_all(storage, "water_logs", ("created_at", "id"), ("created_at", "id"), user_id)
+    assert len(logs) == 4 and logs == sorted(logs)
+    days = [day for (day,) in await _export_all(storage, "daily_rollups", ("day",), ("day",), user_id)]
+    assert days == sorted({local_day(created_at) for created_at, _ in logs})
+    rollups = await storage.get_daily_rollups(user_id, days[1], days[-1])
+    assert [row["day"] for row in rollups] == days[1:]
+
+    for i in range(5):
+        await storage.add_task(user_id, f"задача {i}", f"2026-01-0{i + 1}T10:00:00")
+    tasks = (await storage.list_tasks(user_id, limit=5)).items
+    for task in tasks:
+        if task["title"] in ("задача 1", "задача 3"):
+            await storage.complete_task(user_id, task["id"])
+    page = await storage.list_tasks(user_id, done=True, limit=1)
+    assert [task["title"] for task in page.items] == ["задача 3"] and page.has_older
+    cursor = encode_cursor(page.items[0]["created_at"], page.items[0]["id"])
+    older = await storage.list_tasks(user_id, done=True, cursor=cursor, limit=1)
+    assert [task["title"] for task in older.items] == ["задача 1"] and not older.has_older
+    undone = (await storage.list_tasks(user_id, done=False)).items
+    assert [task["title"] for task in undone] == ["задача 4", "задача 2", "задача 0"]
@@ -0,0 +1,85 @@
+"""Очередь отложенной записи: чтение своих записей без сброса и поведение при ошибках базы."""
+import asyncio
+import contextlib
+import itertools
+import json
+
+import db
+from write_behind import LogEvent, WriteBehindQueue
+
+_user_ids = itertools.count(8_000_001)
+
+
+class BrokenPool:
+    """Пул, у которого каждая транзакция записи падает."""
+
+    def __init__(self, error: Exception):
+        self.error = error
+        self.attempts = 0
+
+    @contextlib.asynccontextmanager
+    async def write(self):
+        self.attempts += 1
+        raise self.error
+        yield
+
+
+def event(user_id: int, value: float = 250) -> LogEvent:
+    return LogEvent("water", user_id, value, "2026-01-01T12:00:00")
+
+
+async def test_read_after_write_does_not_flush(bot_env):
+    user_id = next(_user_ids)
+    await db.add_water(user_id, 250)
+    await db.add_water(user_id, 500)
+    assert await db.get_stats(user_id, "water") == (750.0, 2)
+    # события всё ещё ждут окна группировки, а чтение их уже видит
+    assert len(db._queue()._pending_of(user_id)) == 2
+    await db._queue().flush()
+    assert await db.get_stats(user_id, "water") == (750.0, 2)
+
+
+async def test_read_during_flush_counts_each_event_once(bot_env):
+    user_id = next(_user_ids)
+    for round_ in range(5):
+        await db.add_water(user_id, 100)
+        flushing = asyncio.create_task(db._queue().flush())
+        # чтение начинается, пока пачка пишется, и заканчивается после неё
+        stats = await db.get_stats(user_id, "water")
+        await flushing
+        assert stats == (100.0 * (round_ + 1), round_ + 1)
+    rows = await db.get_daily_rollups(user_id, "2000-01-01", "2999-12-31")
+    assert sum(row["water_count"] for row in rows) == 5
+
+
+async def test_failed_flush_requeues_then_dead_letters(bot_env, tmp_path):
+    path = tmp_path / "dead.jsonl"
+    pool = BrokenPool(ValueError("not an OperationalError"))
+    queue = WriteBehindQueue(pool, {"water": ""}, max_retries=3, dead_letter_path=str(path))
+    await queue.put(event(1))
+    await queue.put(event(2))
+    for attempt in range(2):
+        await queue.flush()
+        # любая ошибка возвращает пачку в очередь, и чтение по-прежнему видит события
+        assert [e.user_id for e in queue._pending] == [1, 2]
+        assert (await queue.read(1, lambda: asyncio.sleep(0)))[1] == [event(1)]
+    await queue.flush()
+    assert pool.attempts == 3
+    assert queue._pending == [] and not queue._pending_users
+    assert [json.loads(line)["user_id"] for line in path.read_text().splitlines()] == [1, 2]
+
+
+async def test_put_waits_for_space_when_buffer_is_full(bot_env, tmp_path):
+    queue = WriteBehindQueue(
+        BrokenPool(ValueError("down")), {"water": ""},
+        max_rows=2, max_pending=2, max_retries=1, dead_letter_path=str(tmp_path / "dead.jsonl"),
+    )
+    await queue.put(event(1))
+    await queue.put(event(2))
+    blocked = asyncio.create_task(queue.put(event(3)))
+    await asyncio.sleep(0)
+    assert not blocked.done() and len(queue._pending) == 2
+    # сброс не удался с последней попытки: пачка ушла в dead letter и освободила место
+    await queue.flush()
+    await asyncio.wait_for(blocked, 1)
+    assert queue._pending == [event(3)]
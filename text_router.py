@@ -0,0 +1,58 @@
+"""Маршрутизация текстовых сообщений без линейного перебора фильтров.
+
+Текст кнопки ищется в словаре за O(1). Всё остальное (числа, названия задач)
+уходит обработчику того вопроса, который бот задал последним, — он хранится
+как FSM-состояние пользователя.
+"""
+from typing import Any, Callable
+
+from aiogram import F, Router
+from aiogram.dispatcher.event.bases import SkipHandler
+from aiogram.dispatcher.event.handler import CallableObject
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.types import Message
+
+from metrics import set_handler_name
+
+
+class TextRouter:
+    def __init__(self, name: str = "text"):
+        self.router = Router(name=name)
+        self.router.message.register(self._dispatch, F.text)
+        self._buttons: dict[str, CallableObject] = {}
+        self._prompts: dict[str, CallableObject] = {}
+
+    def button(self, text: str) -> Callable:
+        def decorator(func: Callable) -> Callable:
+            if text in self._buttons:
+                raise ValueError(f"Кнопка {text!r} уже зарегистрирована")
+            self._buttons[text] = CallableObject(func)
+            return func
+        return decorator
+
+    def prompt(self, state: State) -> Callable:
+        def decorator(func: Callable) -> Callable:
+            self._prompts[state.state] = CallableObject(func)
+            return func
+        return decorator
+
+    def resolve(self, text: str, state: str | None) -> Callable | None:
+        handler = self._buttons.get(text)
+        if handler is None and state is not None:
+            handler = self._prompts.get(state)
+        return handler.callback if handler else None
+
+    async def _dispatch(self, message: Message, state: FSMContext, **data: Any) -> Any:
+        current = await state.get_state()
+        handler = self._buttons.get(message.text)
+        if handler is not None:
+            # нажатие кнопки меню отменяет незаконченный ввод
+            if current is not None:
+                await state.clear()
+        elif current is not None:
+            handler = self._prompts.get(current)
+        if handler is None:
+            raise SkipHandler()
+        set_handler_name(handler.callback.__name__)
+        return await handler.call(message, state=state, **data)
@@ -0,0 +1,22 @@
+"""Локальное время бота: календарные дни и часы тишины считаются в одном часовом поясе."""
+import os
+from datetime import date, datetime, time, timedelta, timezone
+
+# смещение от UTC в часах; по умолчанию Москва
+LOCAL_TZ = timezone(timedelta(hours=float(os.getenv("BOT_TZ_OFFSET", "3"))))
+
+
+def local_now() -> datetime:
+    return datetime.now(LOCAL_TZ)
+
+
+def local_day(created_at: str) -> str:
+    # created_at в базе — наивное UTC-время в ISO-формате
+    moment = datetime.fromisoformat(created_at).replace(tzinfo=timezone.utc)
+    return moment.astimezone(LOCAL_TZ).date().isoformat()
+
+
+def day_start_utc(day: str) -> str:
+    # начало локального дня в формате created_at: всё, что раньше, относится к прошлым дням
+    start = datetime.combine(date.fromisoformat(day), time(), LOCAL_TZ)
+    return start.astimezone(timezone.utc).replace(tzinfo=None).isoformat()
@@ -0,0 +1,67 @@
+"""Приём обновлений через вебхук на aiohttp вместо long polling."""
+import asyncio
+import logging
+from typing import Any
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class LimitedRequestHandler(SimpleRequestHandler):
+    """Отвечает Telegram сразу, а обрабатывает не больше max_concurrency обновлений одновременно."""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str, max_concurrency: int, **data: Any):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token, **data)
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._background_feed_update_tasks)
+
+    async def _background_feed_update(self, bot: Bot, update: dict[str, Any]):
+        async with self._slots:
+            await super()._background_feed_update(bot, update)
+
+
+async def run_webhook(
+    dispatcher: Dispatcher,
+    bot: Bot,
+    *,
+    base_url: str,
+    path: str,
+    secret_token: str,
+    host: str,
+    port: int,
+    max_concurrency: int,
+):
+    app = web.Application()
+    handler = LimitedRequestHandler(dispatcher, bot, secret_token, max_concurrency)
+    handler.register(app, path=path)
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok", "in_flight": handler.in_flight})
+
+    app.router.add_get("/healthz", health)
+    setup_application(app, dispatcher, bot=bot)
+
+    async def set_webhook(app: web.Application):
+        # при нескольких инстансах за прокси вызов идемпотентен: все регистрируют один и тот же URL
+        await bot.set_webhook(
+            base_url.rstrip("/") + path,
+            secret_token=secret_token,
+            allowed_updates=dispatcher.resolve_used_update_types(),
+        )
+
+    app.on_startup.append(set_webhook)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+        logger.info("Вебхук слушает %s:%d%s", host, port, path)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,199 @@
+"""Отложенная групповая запись логов трекинга (вода/сон/шаги/настроение)."""
+import asyncio
+import json
+import logging
+import time
+from collections import Counter
+from typing import Awaitable, Callable, NamedTuple, TypeVar
+
+import aiosqlite
+
+from db_pool import ConnectionPool
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+
+class LogEvent(NamedTuple):
+    kind: str
+    user_id: int
+    value: float
+    created_at: str
+
+
+# хук вызывается внутри транзакции сброса, после вставки строк пачки
+FlushHook = Callable[[aiosqlite.Connection, list[LogEvent]], Awaitable[None]]
+T = TypeVar("T")
+
+# пауза перед повтором неудачного сброса растёт вдвое, но не больше этой
+MAX_RETRY_DELAY = 30
+
+
+class WriteBehindQueue:
+    def __init__(
+        self,
+        pool: ConnectionPool,
+        statements: dict[str, str],
+        interval_ms: int = 200,
+        max_rows: int = 500,
+        max_pending: int | None = None,
+        max_retries: int = 5,
+        dead_letter_path: str | None = None,
+    ):
+        self.pool = pool
+        self.statements = statements
+        self.interval = interval_ms / 1000
+        self.max_rows = max_rows
+        # больше событий буфер не держит: put ждёт, пока сброс освободит место
+        self.max_pending = max_pending or max_rows * 100
+        # после стольких неудачных сбросов подряд пачка уходит в dead_letter_path
+        self.max_retries = max_retries
+        self.dead_letter_path = dead_letter_path
+        self._pending: list[LogEvent] = []
+        # сколько несохранённых событий у каждого пользователя (включая сбрасываемую пачку)
+        self._pending_users: Counter[int] = Counter()
+        self._hooks: list[FlushHook] = []
+        self._flush_lock = asyncio.Lock()
+        self._has_rows = asyncio.Event()
+        self._full = asyncio.Event()
+        self._has_space = asyncio.Event()
+        self._has_space.set()
+        # растёт на 1 в начале и в конце записи пачки: нечётное значение — запись идёт
+        self._generation = 0
+        self._failures = 0
+        self._task: asyncio.Task | None = None
+
+    def add_hook(self, hook: FlushHook):
+        self._hooks.append(hook)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # повторять некогда: пока база не примет записи, flush доведёт их до dead letter
+        while self._pending:
+            await self.flush()
+
+    async def put(self, event: LogEvent):
+        while len(self._pending) >= self.max_pending:
+            # база не успевает или недоступна: ждём сброса, а не копим события без предела
+            self._has_space.clear()
+            self._full.set()
+            await self._has_space.wait()
+        self._pending.append(event)
+        self._pending_users[event.user_id] += 1
+        self._has_rows.set()
+        if len(self._pending) >= self.max_rows:
+            self._full.set()
+
+    async def barrier(self, user_id: int):
+        # перед выгрузкой сбрасываем очередь, если в ней есть записи пользователя
+        if self._pending_users.get(user_id):
+            await self.flush()
+
+    async def read(self, user_id: int, query: Callable[[], Awaitable[T]]) -> tuple[T, list[LogEvent]]:
+        """Результат query и события пользователя, которых ещё нет в базе (read-your-writes без сброса).
+
+        Вызывающий сам прибавляет события к прочитанному. Если во время чтения писалась
+        пачка, неизвестно, попала ли она в снимок: тогда читаем ещё раз, дождавшись этой
+        записи и не давая начать следующую.
+        """
+        if not self._pending_users.get(user_id):
+            return await query(), []
+        generation = self._generation
+        if generation % 2 == 0:
+            result = await query()
+            if generation == self._generation:
+                return result, self._pending_of(user_id)
+        async with self._flush_lock:
+            return await query(), self._pending_of(user_id)
+
+    def _pending_of(self, user_id: int) -> list[LogEvent]:
+        return [event for event in self._pending if event.user_id == user_id]
+
+    async def flush(self):
+        async with self._flush_lock:
+            batch, self._pending = self._pending, []
+            self._has_rows.clear()
+            self._full.clear()
+            if not batch:
+                return
+            started = time.perf_counter()
+            self._generation += 1
+            try:
+                await self._write(batch)
+            except Exception:
+                self._failures += 1
+                METRICS.db_errors["write_behind_flush"] += 1
+                if self._failures < self.max_retries:
+                    # вернём пачку в начало очереди: порядок записей сохраняется
+                    logger.exception(
+                        "Не удалось сбросить %d записей (попытка %d из %d), повторим позже",
+                        len(batch), self._failures, self.max_retries,
+                    )
+                    self._pending[:0] = batch
+                    self._has_rows.set()
+                    return
+                logger.exception("Не удалось сбросить %d записей за %d попыток", len(batch), self._failures)
+                self._failures = 0
+                await self._dead_letter(batch)
+            else:
+                self._failures = 0
+                METRICS.observe_db("write_behind_flush", time.perf_counter() - started, len(batch))
+            finally:
+                self._generation += 1
+                if len(self._pending) < self.max_pending:
+                    self._has_space.set()
+            for event in batch:
+                self._pending_users[event.user_id] -= 1
+                if self._pending_users[event.user_id] <= 0:
+                    del self._pending_users[event.user_id]
+
+    async def _dead_letter(self, batch: list[LogEvent]):
+        # события не теряются молча: строки JSON можно разобрать и вставить вручную
+        METRICS.dead_letters += len(batch)
+        lines = "".join(json.dumps(event._asdict(), ensure_ascii=False) + "\n" for event in batch)
+        if self.dead_letter_path is not None:
+            try:
+                await asyncio.to_thread(_append, self.dead_letter_path, lines)
+                logger.error("%d записей логов сохранены в %s", len(batch), self.dead_letter_path)
+                return
+            except OSError:
+                logger.exception("Не удалось дописать %s", self.dead_letter_path)
+        logger.error("Потеряно %d записей логов:\n%s", len(batch), lines)
+
+    async def _write(self, batch: list[LogEvent]):
+        by_kind: dict[str, list[tuple]] = {}
+        for event in batch:
+            by_kind.setdefault(event.kind, []).append((event.user_id, event.value, event.created_at))
+        async with self.pool.write() as db:
+            for kind, rows in by_kind.items():
+                await db.executemany(self.statements[kind], rows)
+            for hook in self._hooks:
+                await hook(db, batch)
+
+    async def _run(self):
+        while True:
+            await self._has_rows.wait()
+            # ждём окно группировки или заполнения пачки, что наступит раньше
+            alarm = asyncio.get_running_loop().call_later(self.interval, self._full.set)
+            try:
+                await self._full.wait()
+            finally:
+                alarm.cancel()
+            await self.flush()
+            if self._failures:
+                # база отвечает ошибкой: повторяем с нарастающей паузой, а не в цикле
+                await asyncio.sleep(min(self.interval * 2 ** self._failures, MAX_RETRY_DELAY))
+
+
+def _append(path: str, text: str):
+    with open(path, "a", encoding="utf-8") as file:
+        file.write(text)